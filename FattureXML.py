@@ -1,18 +1,28 @@
 from excel_xml_manager import ExcelXmlManager
 from autocomplete_comuni import AutocompleteComune
+from instrumentation import span, timed, recent_timings
+from bounded_log import BoundedLog, DEBUG, INFO, WARNING
+from codici_fatturapa import CODE_TABLES, get_code_table, extract_code
+from p7m import parse_invoice, xml_filename
+from template_cache import new_document, template_structure
+from rendering import find_stylesheets, cached_html_path
+from anteprima import InvoicePreview
+from schema_fatture import MASTER_HEADERS, DETAIL_HEADERS, SUMMARY_HEADERS, STRUCTURE_HEADERS
+import registro_iva
+import esporta_colonnare
+import importlib.util
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext, ttk
+from tkinter import filedialog, messagebox, scrolledtext, ttk, simpledialog
 import os
-import tempfile
 import webbrowser
 from lxml import etree
 import sys
-import glob
 import copy
 import traceback
 import re
 from tkcalendar import DateEntry
 import datetime
+import multiprocessing
 
 class FatturaViewer(tk.Tk):
     def __init__(self):
@@ -25,7 +35,9 @@ class FatturaViewer(tk.Tk):
         self.xsl_files = []
         self.project_dir = os.path.dirname(os.path.abspath(__file__))
         self.xml_doc = None  # Documento XML caricato
+        self.current_invoice_id = None  # ID nel database Excel della fattura in modifica
         self.edit_widgets = []  # Widget dell'editor
+        self.edit_form_built = False  # True quando il form è pronto per essere riutilizzato
         # Dizionario per memorizzare le modifiche sui campi della linea di dettaglio:
         # chiave: indice della linea, valore: dict {xpath: nuovo_valore}
         self.line_modifications = {}
@@ -220,6 +232,34 @@ class FatturaViewer(tk.Tk):
                                 bg="#FF9800", fg="white", width=20, state=tk.DISABLED)
         self.excel_manage_btn.pack(anchor=tk.W, pady=(0, 5))
         
+        # Pulsante per importare in blocco una cartella di fatture XML
+        self.excel_import_btn = tk.Button(excel_section, text="Importa cartella XML", command=self.import_xml_folder,
+                                bg="#3F51B5", fg="white", width=20, state=tk.DISABLED)
+        self.excel_import_btn.pack(anchor=tk.W, pady=(0, 5))
+        
+        # Pulsante per la generazione in serie delle fatture da un elenco di clienti
+        self.excel_batch_btn = tk.Button(excel_section, text="Fatturazione periodica", command=self.generate_invoice_batch,
+                                bg="#00796B", fg="white", width=20, state=tk.DISABLED)
+        self.excel_batch_btn.pack(anchor=tk.W, pady=(0, 5))
+        
+        # Pulsante per il registro IVA
+        self.excel_register_btn = tk.Button(excel_section, text="Registro IVA", command=self.show_vat_register,
+                                bg="#795548", fg="white", width=20, state=tk.DISABLED)
+        self.excel_register_btn.pack(anchor=tk.W, pady=(0, 5))
+        
+        # Pulsante per l'esportazione in formato colonnare per l'analisi dei dati
+        self.excel_columnar_btn = tk.Button(excel_section, text="Esporta Parquet/Arrow", command=self.export_columnar,
+                                bg="#455A64", fg="white", width=20, state=tk.DISABLED)
+        self.excel_columnar_btn.pack(anchor=tk.W, pady=(0, 5))
+        
+        # Sezione Diagnostica
+        diag_section = tk.LabelFrame(left_frame, text="Diagnostica", padx=5, pady=5)
+        diag_section.pack(fill=tk.X, padx=0, pady=(0, 10))
+        
+        timings_btn = tk.Button(diag_section, text="Tempi operazioni", command=self.show_timings_panel,
+                                bg="#607D8B", fg="white", width=20)
+        timings_btn.pack(anchor=tk.W, pady=(0, 5))
+        
         # Informazioni sui file
         info_frame = tk.LabelFrame(self.content_frame, text="Informazioni sui file")
         info_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -241,9 +281,22 @@ class FatturaViewer(tk.Tk):
         self.log_text = scrolledtext.ScrolledText(self.log_frame, height=10)
         self.log_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
+        # Log con limite di righe e scrittura a blocchi; i messaggi di debug sono nascosti di default
+        self.log_buffer = BoundedLog(self.log_text, max_lines=2000, flush_interval_ms=200, level=INFO)
+        
+        self.log_debug_var = tk.BooleanVar(value=False)
+        log_debug_check = tk.Checkbutton(self.log_frame, text="Mostra messaggi di debug",
+                                         variable=self.log_debug_var,
+                                         command=lambda: self.log_buffer.set_level(
+                                             DEBUG if self.log_debug_var.get() else INFO))
+        log_debug_check.pack(anchor=tk.W, padx=5, pady=(0, 5))
+        
         self.editor_frame = tk.LabelFrame(self.content_frame, text="Modifica Fattura")
         # L'editor viene mostrato solo in modalità modifica
         
+        # Anteprima della fattura accanto all'editor, mostrata su richiesta
+        self.preview = InvoicePreview(self.content_frame, self.preview_document, lambda: self.xsl_path, self.log)
+        
         self.editor_canvas = tk.Canvas(self.editor_frame)
         editor_scrollbar = ttk.Scrollbar(self.editor_frame, orient="vertical", command=self.editor_canvas.yview)
         self.editor_scrollable_frame = ttk.Frame(self.editor_canvas)
@@ -284,13 +337,7 @@ class FatturaViewer(tk.Tk):
             
     def find_xsl_files(self):
         try:
-            xsl_pattern = os.path.join(self.project_dir, "*.xsl")
-            self.xsl_files = glob.glob(xsl_pattern)
-            
-            xsl_dir = os.path.join(self.project_dir, "xsl")
-            if os.path.exists(xsl_dir) and os.path.isdir(xsl_dir):
-                xsl_pattern = os.path.join(xsl_dir, "*.xsl")
-                self.xsl_files.extend(glob.glob(xsl_pattern))
+            self.xsl_files = find_stylesheets(self.project_dir)
             
             if self.xsl_files:
                 self.xsl_dropdown["values"] = [os.path.basename(f) for f in self.xsl_files]
@@ -305,14 +352,17 @@ class FatturaViewer(tk.Tk):
     def select_xml(self):
         filepath = filedialog.askopenfilename(
             title="Seleziona il file XML della fattura",
-            filetypes=[("File XML", "*.xml")]
+            filetypes=[("Fatture XML", "*.xml *.p7m"), ("File XML", "*.xml"), ("File firmati p7m", "*.p7m")]
         )
         if filepath:
             self.xml_path = filepath
+            self.current_invoice_id = None
             self.xml_label.config(text=os.path.basename(filepath))
             self.log(f"File XML selezionato: {filepath}")
             try:
-                self.xml_doc = etree.parse(filepath)
+                with span("xml.parse", file=os.path.basename(filepath)):
+                    # Le fatture firmate (.xml.p7m) vengono estratte dalla busta
+                    self.xml_doc = parse_invoice(filepath)
                 self.log("File XML caricato con successo")
                 # Aggiorna lo stato dei pulsanti
                 self.update_button_states()
@@ -333,6 +383,7 @@ class FatturaViewer(tk.Tk):
             self.log(f"Foglio di stile selezionato: {self.xsl_path}")
             # Aggiorna lo stato dei pulsanti
             self.update_button_states()
+            self.preview.schedule()
     
     def update_xsl_labels(self, filepath):
         self.xsl_label.config(text=os.path.basename(filepath))
@@ -346,14 +397,11 @@ class FatturaViewer(tk.Tk):
             messagebox.showerror("Errore", "Seleziona un foglio di stile XSL")
             return
         try:
-            xml_doc = etree.parse(self.xml_path)
-            xsl_doc = etree.parse(self.xsl_path)
-            transformer = etree.XSLT(xsl_doc)
-            result = transformer(xml_doc)
-            fd, temp_path = tempfile.mkstemp(suffix='.html')
-            with os.fdopen(fd, 'wb') as f:
-                f.write(etree.tostring(result, pretty_print=True))
-            webbrowser.open('file://' + temp_path)
+            with span("xml.parse", file=os.path.basename(self.xml_path)):
+                xml_doc = parse_invoice(self.xml_path)
+            # Una fattura già visualizzata con lo stesso foglio di stile non viene ritrasformata
+            html_path = cached_html_path(xml_doc, self.xsl_path)
+            webbrowser.open('file://' + html_path)
             self.log("Trasformazione completata. Visualizzazione nel browser.")
         except Exception as e:
             self.log(f"Errore durante la trasformazione: {str(e)}")
@@ -366,29 +414,36 @@ class FatturaViewer(tk.Tk):
             messagebox.showerror("Errore", "Seleziona prima un file XML valido")
             return
         
-        for widget in self.edit_widgets:
-            if widget.winfo_exists():
-                widget.destroy()
-        self.edit_widgets = []
+        # Il form viene costruito una sola volta e poi ricollegato al nuovo documento
+        reuse_form = self.edit_form_built and self.editor_scrollable_frame.winfo_exists()
+        
         self.line_modifications = {}
         
+        if not reuse_form:
+            for widget in self.edit_widgets:
+                if widget.winfo_exists():
+                    widget.destroy()
+            self.edit_widgets = []
+        
         self.log_frame.pack_forget()
         
         # Riconfigura il frame dell'editor per una migliore visualizzazione
         self.editor_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
-        # Rimuovi i vecchi pulsanti dell'editor se esistono
-        if hasattr(self, 'editor_buttons_frame') and self.editor_buttons_frame.winfo_exists():
-            self.editor_buttons_frame.destroy()
-        
-        # Riconfigura il canvas e la scrollbar
-        self.editor_canvas.delete("all")
-        self.editor_scrollable_frame = ttk.Frame(self.editor_canvas)
-        self.editor_scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.editor_canvas.configure(scrollregion=self.editor_canvas.bbox("all"))
-        )
-        self.editor_canvas.create_window((0, 0), window=self.editor_scrollable_frame, anchor="nw")
+        if not reuse_form:
+            # Rimuovi i vecchi pulsanti dell'editor se esistono
+            if hasattr(self, 'editor_buttons_frame') and self.editor_buttons_frame.winfo_exists():
+                self.editor_buttons_frame.destroy()
+            
+            # Riconfigura il canvas e la scrollbar
+            self.editor_canvas.delete("all")
+            self.editor_scrollable_frame.destroy()
+            self.editor_scrollable_frame = ttk.Frame(self.editor_canvas)
+            self.editor_scrollable_frame.bind(
+                "<Configure>",
+                lambda e: self.editor_canvas.configure(scrollregion=self.editor_canvas.bbox("all"))
+            )
+            self.editor_canvas.create_window((0, 0), window=self.editor_scrollable_frame, anchor="nw")
         
         # Funzione per gestire lo scrolling con rotellina del mouse da qualunque widget figlio
         def _on_mousewheel(event):
@@ -407,8 +462,13 @@ class FatturaViewer(tk.Tk):
         except Exception as e:
             self.log(f"Errore nell'analisi del documento XML: {str(e)}")
         
-        # Crea i campi di modifica con il nuovo layout
-        self.create_edit_fields()
+        if reuse_form:
+            # Aggiorna valori e riferimenti agli elementi nei widget esistenti
+            self.rebind_edit_fields()
+        else:
+            # Crea i campi di modifica con il nuovo layout
+            self.create_edit_fields()
+            self.edit_form_built = True
         
         # Aggiorna i totali nel riepilogo
         self.update_riepilogo_totals()        
@@ -416,6 +476,10 @@ class FatturaViewer(tk.Tk):
         excel_db_enabled = self.excel_manager.excel_path is not None and os.path.exists(self.excel_manager.excel_path)
         if hasattr(self, 'save_to_excel_btn'):
             self.save_to_excel_btn.config(state=tk.NORMAL if excel_db_enabled else tk.DISABLED)
+        
+        # Nuovo documento: l'anteprima, se visibile, viene ritrasformata
+        self.preview.invalidate()
+        self.preview.schedule()
             
         self.log("Modalità modifica attivata")
 
@@ -427,7 +491,7 @@ class FatturaViewer(tk.Tk):
                 element = elements[0]
                 return element, element.text or ""
             else:
-                self.log(f"Elemento non trovato con il percorso: {path}")
+                self.log(f"Elemento non trovato con il percorso: {path}", level=DEBUG)
                 return None, ""
         except Exception as e:
             self.log(f"Errore nel trovare il campo {path}: {str(e)}")
@@ -435,6 +499,7 @@ class FatturaViewer(tk.Tk):
 
 
 
+    @timed("editor.crea_campi")
     def create_edit_fields(self):
         root = self.xml_doc.getroot()
         ns = self.NS
@@ -446,138 +511,6 @@ class FatturaViewer(tk.Tk):
         ]
         
 
-        # Dizionario di valori per i menu a tendina
-        combobox_values = {
-            # TipoDocumento
-            "//p:FatturaElettronica/FatturaElettronicaBody/DatiGenerali/DatiGeneraliDocumento/TipoDocumento": [
-                "TD01 - Fattura",
-                "TD02 - Acconto/anticipo su fattura",
-                "TD03 - Acconto/anticipo su parcella",
-                "TD04 - Nota di credito",
-                "TD05 - Nota di debito",
-                "TD06 - Parcella",
-                "TD16 - Integrazione fattura reverse charge interno",
-                "TD17 - Integrazione/autofattura acquisto servizi estero",
-                "TD18 - Integrazione acquisto beni intracomunitari",
-                "TD19 - Integrazione/autofattura art.17 c.2 DPR 633/72",
-                "TD20 - Autofattura per regolarizzazione",
-                "TD21 - Autofattura per splafonamento",
-                "TD22 - Estrazione beni da Deposito IVA",
-                "TD23 - Estrazione beni da Deposito IVA con versamento IVA",
-                "TD24 - Fattura differita art.21 c.4 lett. a",
-                "TD25 - Fattura differita art.21 c.4 terzo periodo lett. b",
-                "TD26 - Cessione beni ammortizzabili/passaggi interni",
-                "TD27 - Fattura per autoconsumo/cessioni gratuite"
-            ],
-            
-            # RegimeFiscale
-            "//p:FatturaElettronica/FatturaElettronicaHeader/CedentePrestatore/DatiAnagrafici/RegimeFiscale": [
-                "RF01 - Ordinario",
-                "RF02 - Contribuenti minimi",
-                "RF04 - Agricoltura e attività connesse e pesca",
-                "RF05 - Vendita sali e tabacchi",
-                "RF06 - Commercio fiammiferi",
-                "RF07 - Editoria",
-                "RF08 - Gestione servizi telefonia pubblica",
-                "RF09 - Rivendita documenti di trasporto pubblico e di sosta",
-                "RF10 - Intrattenimenti, giochi e altre attività",
-                "RF11 - Agenzie viaggi e turismo",
-                "RF12 - Agriturismo",
-                "RF13 - Vendite a domicilio",
-                "RF14 - Rivendita beni usati, oggetti d'arte",
-                "RF15 - Agenzie di vendite all'asta",
-                "RF16 - IVA per cassa P.A.",
-                "RF17 - IVA per cassa art.32-bis DL 83/2012",
-                "RF18 - Altro",
-                "RF19 - Regime forfettario"
-            ],
-            
-            # StatoLiquidazione
-            "//p:FatturaElettronica/FatturaElettronicaHeader/CedentePrestatore/IscrizioneREA/StatoLiquidazione": [
-                "LS - In liquidazione",
-                "LN - Non in liquidazione"
-            ],
-            
-            # SocioUnico
-            "//p:FatturaElettronica/FatturaElettronicaHeader/CedentePrestatore/IscrizioneREA/SocioUnico": [
-                "SU - Socio unico",
-                "SM - Più soci"
-            ],
-            
-            # ModalitaPagamento
-            "//p:FatturaElettronica/FatturaElettronicaBody/DatiPagamento/DettaglioPagamento/ModalitaPagamento": [
-                "MP01 - Contanti",
-                "MP02 - Assegno",
-                "MP03 - Assegno circolare",
-                "MP04 - Contanti presso Tesoreria",
-                "MP05 - Bonifico",
-                "MP06 - Vaglia cambiario",
-                "MP07 - Bollettino bancario",
-                "MP08 - Carta di pagamento",
-                "MP09 - RID",
-                "MP10 - RID utenze",
-                "MP11 - RID veloce",
-                "MP12 - RIBA",
-                "MP13 - MAV",
-                "MP14 - Quietanza erario",
-                "MP15 - Giroconto su conti di contabilità speciale",
-                "MP16 - Domiciliazione bancaria",
-                "MP17 - Domiciliazione postale",
-                "MP18 - Bollettino di c/c postale",
-                "MP19 - SEPA Direct Debit",
-                "MP20 - SEPA Direct Debit CORE",
-                "MP21 - SEPA Direct Debit B2B",
-                "MP22 - Trattenuta su somme già riscosse",
-                "MP23 - PagoPA"
-            ],
-            
-            # CondizioniPagamento
-            "//p:FatturaElettronica/FatturaElettronicaBody/DatiPagamento/CondizioniPagamento": [
-                "TP01 - Pagamento a rate",
-                "TP02 - Pagamento completo",
-                "TP03 - Anticipo"
-            ],
-            
-            # EsigibilitaIVA
-            "//p:FatturaElettronica/FatturaElettronicaBody/DatiBeniServizi/DatiRiepilogo/EsigibilitaIVA": [
-                "I - Esigibilità immediata",
-                "D - Esigibilità differita",
-                "S - Scissione dei pagamenti"
-            ],
-            
-            # Natura
-            "//p:FatturaElettronica/FatturaElettronicaBody/DatiBeniServizi/DatiRiepilogo/Natura": [
-                "N1 - Escluse ex art. 15",
-                "N2 - Non soggette",
-                "N2.1 - Non soggette ad IVA artt. da 7 a 7-septies",
-                "N2.2 - Non soggette - altri casi",
-                "N3 - Non imponibili",
-                "N3.1 - Non imponibili - esportazioni",
-                "N3.2 - Non imponibili - cessioni intracomunitarie",
-                "N3.3 - Non imponibili - cessioni verso S.Marino",
-                "N3.4 - Non imponibili - operazioni assimilate alle cessioni all'esportazione",
-                "N3.5 - Non imponibili - a seguito di dichiarazioni d'intento",
-                "N3.6 - Non imponibili - altre operazioni",
-                "N4 - Esenti",
-                "N5 - Regime del margine / IVA non esposta in fattura",
-                "N6 - Inversione contabile",
-                "N7 - IVA assolta in altro stato UE"
-            ],
-            
-            # Valori possibili per Aliquota IVA
-            "//p:FatturaElettronica/FatturaElettronicaBody/DatiBeniServizi/DatiRiepilogo/AliquotaIVA": [
-                "4.00", "5.00", "10.00", "22.00"
-            ]
-        }
-
-        # Funzione per estrarre il codice da una stringa descrittiva come "MP01 - Contanti"
-        def extract_code(value):
-            if " - " in value:
-                return value.split(" - ")[0].strip()
-            return value                
-        # Valori possibili per Aliquota IVA
-        aliquote_iva = ["4.00", "5.00", "10.00", "22.00"]
-        
         # Definizione delle sezioni
         left_sections = [
             ("Dati Intestazione", [
@@ -679,6 +612,9 @@ class FatturaViewer(tk.Tk):
                 string_var = tk.StringVar(value=value)
                 self.string_vars[xpath] = string_var
                 
+                # Tabella dei codici per i campi con valori predefiniti (None per gli altri)
+                code_table = get_code_table(xpath)
+                
                 # Verifica se è un campo data
                 if xpath in date_fields:
                     # Usa il metodo create_date_field per creare il campo data
@@ -686,31 +622,28 @@ class FatturaViewer(tk.Tk):
                     date_frame.grid(row=i, column=1, sticky="ew", padx=5, pady=2)
 
                 # Verifica se è un campo con valori predefiniti per combobox
-                elif xpath in combobox_values:
+                elif code_table is not None:
                     # Crea un combobox invece di un entry
                     entry_widget = ttk.Combobox(section_frame, width=29, textvariable=string_var)
-                    entry_widget['values'] = combobox_values[xpath]
+                    entry_widget['values'] = code_table.display_values
                     
                     # Trova il valore corrente nel combobox o imposta il primo valore
                     if value:
-                        # Cerca un'opzione che contiene il valore corrente (per gestire sia codici che descrizioni complete)
-                        matching = [opt for opt in combobox_values[xpath] if opt.startswith(value) or value in opt]
-                        if matching:
-                            entry_widget.set(matching[0])
-                        else:
-                            # Se non c'è un match, imposta il valore così com'è
-                            entry_widget.set(value)
+                        entry_widget.set(code_table.display_for(value))
                     
                     entry_widget.grid(row=i, column=1, sticky="ew", padx=5, pady=2)
                     
                     # Aggiungi una traccia per aggiornare il valore quando cambia la selezione
-                    def update_element_from_combobox(event, element=element, var=string_var, xpath=xpath):
+                    def update_element_from_combobox(event, var=string_var, xpath=xpath, table=code_table):
+                        # L'elemento viene letto al momento dell'evento: il form può essere
+                        # ricollegato a un documento diverso da quello di creazione
+                        element = self.edit_fields[xpath]["element"]
                         if element is not None:
                             # Estrae solo il codice dalla selezione (es. "MP01" da "MP01 - Contanti")
                             selected_value = var.get()
-                            code = extract_code(selected_value)
+                            code = table.code_for(selected_value, extract_code(selected_value))
                             element.text = code
-                            self.log(f"Aggiornato {xpath} con valore {code}")
+                            self.log(f"Aggiornato {xpath} con valore {code}", level=DEBUG)
                             
                             # Alcuni campi potrebbero richiedere aggiornamenti aggiuntivi
                             if "AliquotaIVA" in xpath and hasattr(self, 'calcola_imposta'):
@@ -769,7 +702,7 @@ class FatturaViewer(tk.Tk):
                 self.edit_widgets.append(autocomplete.frame)
                 
                 # Log per debug
-                self.log(f"Abilitato autocompletamento comuni per la sezione {section_title}")
+                self.log(f"Abilitato autocompletamento comuni per la sezione {section_title}", level=DEBUG)
         
         # Popola la colonna destra
         for section_title, fields in right_sections:
@@ -787,33 +720,31 @@ class FatturaViewer(tk.Tk):
                 label_widget = tk.Label(section_frame, text=label + ":")
                 label_widget.grid(row=i, column=0, sticky="w", padx=5, pady=2)
                 
+                # Tabella dei codici per i campi con valori predefiniti (None per gli altri)
+                code_table = get_code_table(xpath)
+                
                 # Per AliquotaIVA creiamo un Combobox invece di un Entry
                 # Verifica se è un campo con valori predefiniti per combobox
-                if xpath in combobox_values:
+                if code_table is not None:
                     # Crea un combobox invece di un entry
                     entry_widget = ttk.Combobox(section_frame, width=29)
-                    entry_widget['values'] = combobox_values[xpath]
+                    entry_widget['values'] = code_table.display_values
                     
                     # Trova il valore corrente nel combobox o imposta il primo valore
                     if value:
-                        # Cerca un'opzione che contiene il valore corrente (per gestire sia codici che descrizioni complete)
-                        matching = [opt for opt in combobox_values[xpath] if opt.startswith(value) or value in opt]
-                        if matching:
-                            entry_widget.set(matching[0])
-                        else:
-                            # Se non c'è un match, imposta il valore così com'è
-                            entry_widget.set(value)
+                        entry_widget.set(code_table.display_for(value))
                     
                     entry_widget.grid(row=i, column=1, sticky="ew", padx=5, pady=2)
                     
                     # Aggiungi una traccia per aggiornare il valore quando cambia la selezione
-                    def update_element_from_combobox(event, e=element, widget=entry_widget, xp=xpath):
+                    def update_element_from_combobox(event, widget=entry_widget, xp=xpath, table=code_table):
+                        e = self.edit_fields[xp]["element"]
                         if e is not None:
                             # Estrae solo il codice dalla selezione (es. "MP01" da "MP01 - Contanti")
                             selected_value = widget.get()
-                            code = extract_code(selected_value)
+                            code = table.code_for(selected_value, extract_code(selected_value))
                             e.text = code
-                            self.log(f"Aggiornato {xp} con valore {code}")
+                            self.log(f"Aggiornato {xp} con valore {code}", level=DEBUG)
                             
                             # Alcuni campi potrebbero richiedere aggiornamenti aggiuntivi
                             if "AliquotaIVA" in xp and hasattr(self, 'calcola_imposta'):
@@ -899,6 +830,7 @@ class FatturaViewer(tk.Tk):
         details_full_width = tk.Frame(self.editor_scrollable_frame)
         details_full_width.grid(row=detail_row, column=0, sticky="ew", padx=10, pady=5)
         self.edit_widgets.append(details_full_width)
+        self.details_full_width = details_full_width
         
         # Crea i campi per la linea di dettaglio corrente
         self.update_line_fields(details_full_width)
@@ -1016,6 +948,12 @@ class FatturaViewer(tk.Tk):
         tree_btn.pack(side=tk.BOTTOM, pady=(10, 0))
         self.edit_widgets.append(tree_btn)
         
+        # Pulsante per l'anteprima integrata, aggiornata durante la modifica
+        preview_btn = tk.Button(buttons_frame, text="Mostra/nascondi anteprima",
+                                command=self.toggle_preview, bg="#4CAF50", fg="white", padx=10, pady=5)
+        preview_btn.pack(side=tk.BOTTOM, pady=(10, 0))
+        self.edit_widgets.append(preview_btn)
+        
         # Aggiorna i totali nel riepilogo
         self.update_riepilogo_totals()
         
@@ -1024,6 +962,41 @@ class FatturaViewer(tk.Tk):
 
 
         
+    def rebind_edit_fields(self):
+        """
+        Ricollega il form di modifica già costruito al documento XML corrente,
+        aggiornando valori e riferimenti agli elementi senza ricreare i widget
+        """
+        header_fields = [(xpath, field_data) for xpath, field_data in self.edit_fields.items()
+                         if not xpath.startswith("current_line.")]
+        
+        # Il comune va impostato per primo: l'autocompletamento aggiorna CAP e provincia
+        header_fields.sort(key=lambda item: not item[0].endswith("/Sede/Comune"))
+        
+        for xpath, field_data in header_fields:
+            element, value = self.try_find_element(xpath, self.NS)
+            field_data["element"] = element
+            widget = field_data["widget"]
+            
+            try:
+                table = get_code_table(xpath)
+                if isinstance(widget, ttk.Combobox) and table is not None:
+                    widget.set(table.display_for(value) if value else "")
+                else:
+                    widget.delete(0, tk.END)
+                    widget.insert(0, value)
+            except tk.TclError as e:
+                self.log(f"Errore nell'aggiornamento del campo {xpath}: {str(e)}")
+        
+        # Le linee di dettaglio vengono ricaricate partendo dalla prima
+        self.current_line_index = 0
+        self.refresh_lines_data()
+        self.update_line_fields(self.details_full_width)
+        self.update_nav_buttons()
+        
+        self.editor_canvas.yview_moveto(0)
+        self.log("Form di modifica aggiornato con il nuovo documento")
+
     def on_line_field_change(self, event, xpath):
         if self.current_line_index not in self.line_modifications:
             self.line_modifications[self.current_line_index] = {}
@@ -1054,26 +1027,18 @@ class FatturaViewer(tk.Tk):
         if hasattr(self, 'save_current_line_data'):
             self.save_current_line_data()
         
-        # Funzione per estrarre il codice da una stringa descrittiva come "MP01 - Contanti"
-        def extract_code(value):
-            if isinstance(value, str) and " - " in value:
-                return value.split(" - ")[0].strip()
-            return value
-        
         modifiche_effettuate = []
         for xpath, field_data in list(self.edit_fields.items()):
             widget = field_data["widget"]
             element = field_data["element"]
             try:
-                # Gestione diversa in base al tipo di widget
-                if isinstance(widget, ttk.Combobox):
-                    # Per i combobox, estrai solo il codice
-                    new_value = extract_code(widget.get())
-                else:
-                    # Per gli altri widget, ottieni il valore normalmente
-                    new_value = widget.get()
+                new_value = self.edit_field_value(xpath, widget)
             except (tk.TclError, AttributeError):
                 continue
+            
+            table = get_code_table(xpath) if isinstance(widget, ttk.Combobox) else None
+            if table is not None and new_value and new_value not in table:
+                self.log(f"Attenzione: codice '{new_value}' non previsto per {table.name}", level=WARNING)
                 
             if element is not None:
                 old_value = element.text or ""
@@ -1087,21 +1052,22 @@ class FatturaViewer(tk.Tk):
                 elements = self.xml_doc.getroot().xpath(xpath, namespaces=self.NS)
                 if elements:
                     # Se il valore proviene da un combobox, estrai solo il codice
-                    if isinstance(new_value, str) and " - " in new_value:
-                        new_value = extract_code(new_value)
+                    new_value = extract_code(new_value)
                     elements[0].text = new_value
         
         output_path = filedialog.asksaveasfilename(
             title="Salva XML modificato",
             defaultextension=".xml",
             filetypes=[("File XML", "*.xml")],
-            initialfile=os.path.basename(self.xml_path)
+            # Una fattura firmata modificata non è più firmata: si salva come XML semplice
+            initialfile=os.path.basename(xml_filename(self.xml_path))
         )
         
         if output_path:
             try:
                 self.indent(self.xml_doc.getroot())
-                new_xml = etree.tostring(self.xml_doc, pretty_print=True, encoding="UTF-8", xml_declaration=True).decode("utf-8")
+                with span("xml.serializza"):
+                    new_xml = etree.tostring(self.xml_doc, pretty_print=True, encoding="UTF-8", xml_declaration=True).decode("utf-8")
                 new_xml = re.sub(r'(</DettaglioLinee>)(\r?\n)+(<(?:\w+:)?DatiRiepilogo>)', r'\1\n      \3', new_xml)
                 new_xml = re.sub(r'(</DettaglioLinee>)(<(?:\w+:)?DatiRiepilogo>)', r'\1\n      \2', new_xml)
                 
@@ -1134,15 +1100,13 @@ class FatturaViewer(tk.Tk):
                 self.log(f"File salvato con successo: {output_path}")
                 messagebox.showinfo("Salvataggio completato", f"Il file XML è stato salvato con successo.")
                 
-                # Verifica se il file salvato era un file temporaneo
-                # e chiedi all'utente se vuole aggiornare il database Excel
-                is_temp_file = "temp_invoice_" in os.path.basename(self.xml_path).lower()
-                
-                if is_temp_file and self.excel_manager.excel_path:
+                # Se la fattura proviene dal database Excel
+                # chiedi all'utente se vuole aggiornarla con le modifiche
+                if self.current_invoice_id and self.excel_manager.excel_path:
                     update_excel = messagebox.askyesno("Aggiornamento Excel", 
                                                     "Vuoi aggiornare anche il database Excel con le modifiche apportate?")
                     if update_excel:
-                        success = self.excel_manager.export_xml_to_excel(self.xml_doc)
+                        success = self.excel_manager.update_invoice(self.current_invoice_id, self.xml_doc)
                         if success:
                             messagebox.showinfo("Aggiornamento Excel", 
                                             "Il database Excel è stato aggiornato con successo.")
@@ -1158,17 +1122,133 @@ class FatturaViewer(tk.Tk):
                 self.log(f"Errore nel salvataggio del file: {str(e)}")
                 messagebox.showerror("Errore", f"Errore nel salvataggio del file:\n{str(e)}")
                 
+    def edit_field_value(self, xpath, widget):
+        """
+        Restituisce il valore da scrivere nell'XML per un campo del form
+        
+        Args:
+            xpath: Percorso del campo
+            widget: Widget del campo
+        
+        Returns:
+            str: Valore del campo (per i combobox solo il codice, es. "MP01" da "MP01 - Contanti")
+        """
+        if isinstance(widget, ttk.Combobox):
+            selected_value = widget.get()
+            code = extract_code(selected_value)
+            table = get_code_table(xpath)
+            return table.code_for(selected_value, code) if table is not None else code
+        return widget.get()
+
+    def preview_document(self):
+        """
+        Restituisce una copia del documento in modifica con i valori attuali dei campi,
+        senza modificare il documento
+        
+        Returns:
+            etree._ElementTree: Documento da visualizzare, None se non c'è una fattura in modifica
+        """
+        if not self.xml_doc:
+            return None
+        
+        values = {}
+        for xpath, field_data in list(self.edit_fields.items()):
+            element = field_data["element"]
+            if element is None:
+                continue
+            try:
+                values[element] = self.edit_field_value(xpath, field_data["widget"])
+            except (tk.TclError, AttributeError):
+                continue
+        
+        # La copia ha la stessa struttura: gli elementi si corrispondono in ordine di documento
+        preview_doc = copy.deepcopy(self.xml_doc)
+        for original, duplicate in zip(self.xml_doc.iter(), preview_doc.iter()):
+            value = values.get(original)
+            if value is not None:
+                duplicate.text = value
+        
+        for line_data in self.line_modifications.values():
+            for xpath, new_value in line_data.items():
+                elements = preview_doc.getroot().xpath(xpath, namespaces=self.NS)
+                if elements:
+                    elements[0].text = extract_code(new_value)
+        return preview_doc
+
+    def toggle_preview(self):
+        """Mostra o nasconde l'anteprima integrata"""
+        if self.preview.frame.winfo_ismapped():
+            self.hide_preview()
+        else:
+            self.show_preview()
+
+    def show_preview(self):
+        """Mostra l'anteprima accanto all'editor e la aggiorna a ogni modifica dei campi"""
+        self.preview.frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=5, pady=5,
+                                before=self.editor_frame)
+        for sequence in ("<KeyRelease>", "<<ComboboxSelected>>", "<ButtonRelease-1>"):
+            self.bind_all(sequence, self.preview.schedule, add="+")
+        self.preview.invalidate()
+        self.update_idletasks()
+        self.preview.refresh()
+
+    def hide_preview(self):
+        """Nasconde l'anteprima integrata"""
+        self.preview.cancel()
+        for sequence in ("<KeyRelease>", "<<ComboboxSelected>>", "<ButtonRelease-1>"):
+            self.unbind_all(sequence)
+        self.preview.frame.pack_forget()
+
     def cancel_edit(self):
         # Rimuovi il binding della rotellina del mouse
         self.unbind_all("<MouseWheel>")
         
+        self.hide_preview()
         self.editor_frame.pack_forget()
         self.log_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         self.log("Modalità modifica disattivata")
     
-    def log(self, message):
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
+    def log(self, message, level=INFO):
+        self.log_buffer.write(message, level)
+
+    def show_timings_panel(self, max_entries=100):
+        """Mostra una finestra con i tempi delle ultime operazioni misurate"""
+        panel = tk.Toplevel(self)
+        panel.title("Tempi operazioni")
+        panel.geometry("640x400")
+        
+        frame = tk.Frame(panel)
+        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        scrollbar = tk.Scrollbar(frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        columns = ("ora", "operazione", "durata", "esito")
+        tree = ttk.Treeview(frame, columns=columns, show='headings', yscrollcommand=scrollbar.set)
+        tree.heading("ora", text="Ora")
+        tree.heading("operazione", text="Operazione")
+        tree.heading("durata", text="Durata (ms)")
+        tree.heading("esito", text="Esito")
+        tree.column("ora", width=110, anchor="w")
+        tree.column("operazione", width=260, anchor="w")
+        tree.column("durata", width=100, anchor="e")
+        tree.column("esito", width=80, anchor="w")
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=tree.yview)
+        
+        def refresh():
+            if not panel.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            for entry in recent_timings(max_entries):
+                tree.insert("", tk.END, values=(
+                    entry["ts"].split("T")[-1], entry["operazione"],
+                    f"{entry['durata_ms']:.1f}", entry["esito"]
+                ))
+            # Aggiornamento periodico finché la finestra resta aperta
+            panel.after(1000, refresh)
+        
+        refresh()
     
 
 
@@ -1297,7 +1377,7 @@ class FatturaViewer(tk.Tk):
         ]
         
         # Valori possibili per Aliquota IVA
-        aliquote_iva = ["4.00", "5.00", "10.00", "22.00"]
+        aliquote_iva = CODE_TABLES["AliquotaIVA"].display_values
         
         # Crea un frame a griglia per i campi di dettaglio per una migliore organizzazione
         line_grid = tk.Frame(self.line_frame)
@@ -1605,7 +1685,7 @@ class FatturaViewer(tk.Tk):
                     # Aggiorna l'elemento XML
                     if element is not None:
                         element.text = value
-                        self.log(f"Aggiornato campo {field_name}: {value}")
+                        self.log(f"Aggiornato campo {field_name}: {value}", level=DEBUG)
                     
                 except Exception as e:
                     self.log(f"Errore nel salvataggio del campo {field_name}: {str(e)}")
@@ -1726,7 +1806,7 @@ class FatturaViewer(tk.Tk):
                 else:
                     etree.SubElement(linea, "NumeroLinea").text = str(i)
             
-            self.log(f"Numeri delle linee aggiornati (1-{len(linee)})")
+            self.log(f"Numeri delle linee aggiornati (1-{len(linee)})", level=DEBUG)
         except Exception as e:
             self.log(f"Errore nell'aggiornamento dei numeri delle linee: {str(e)}")
             traceback.print_exc()
@@ -1760,7 +1840,7 @@ class FatturaViewer(tk.Tk):
             # Assicurati che l'indice corrente sia valido
             if self.current_line_index >= self.total_lines:
                 self.current_line_index = max(0, self.total_lines - 1)
-            self.log(f"Aggiornati dati: {self.total_lines} linee normali, CONAI: {'presente' if self.conai_line is not None else 'assente'}")    
+            self.log(f"Aggiornati dati: {self.total_lines} linee normali, CONAI: {'presente' if self.conai_line is not None else 'assente'}", level=DEBUG)
         except Exception as e:
             self.log(f"Errore nell'aggiornamento dei dati delle linee: {str(e)}")
             traceback.print_exc()
@@ -1774,6 +1854,7 @@ class FatturaViewer(tk.Tk):
             self.log("Rimozione linea CONTRIBUTO CONAI ASSOLTO")
             self.remove_conai_line()
 
+    @timed("totali.riepilogo")
     def update_riepilogo_totals(self):
         """
         Aggiorna automaticamente i totali nei dati di riepilogo basati sulle linee di dettaglio.
@@ -1791,7 +1872,7 @@ class FatturaViewer(tk.Tk):
                 if prezzo_totale_elem is not None and prezzo_totale_elem.text:
                     try:
                         total_amount += float(prezzo_totale_elem.text)
-                        self.log(f"Aggiunto prezzo: {prezzo_totale_elem.text}, totale parziale: {total_amount}")
+                        self.log(f"Aggiunto prezzo: {prezzo_totale_elem.text}, totale parziale: {total_amount}", level=DEBUG)
                     except ValueError:
                         self.log(f"Errore nel convertire il prezzo totale: {prezzo_totale_elem.text}")
             
@@ -1804,12 +1885,12 @@ class FatturaViewer(tk.Tk):
                 if "ImponibileImporto" in xpath and field_data["widget"].winfo_exists():
                     field_data["widget"].delete(0, tk.END)
                     field_data["widget"].insert(0, total_amount_formatted)
-                    self.log(f"Aggiornato campo UI imponibile: {total_amount_formatted}")
+                    self.log(f"Aggiornato campo UI imponibile: {total_amount_formatted}", level=DEBUG)
                     
                     # Aggiorna anche l'elemento XML
                     if field_data["element"] is not None:
                         field_data["element"].text = total_amount_formatted
-                        self.log(f"Aggiornato elemento XML imponibile: {total_amount_formatted}")
+                        self.log(f"Aggiornato elemento XML imponibile: {total_amount_formatted}", level=DEBUG)
             
             # Calcola anche l'imposta e il totale documento
             aliquota_iva = 22.0  # Valore predefinito se non troviamo l'elemento
@@ -1819,7 +1900,7 @@ class FatturaViewer(tk.Tk):
                 if "AliquotaIVA" in xpath and "DatiRiepilogo" in xpath and field_data["widget"].winfo_exists():
                     try:
                         aliquota_iva = float(field_data["widget"].get())
-                        self.log(f"Trovata aliquota IVA: {aliquota_iva}%")
+                        self.log(f"Trovata aliquota IVA: {aliquota_iva}%", level=DEBUG)
                         break
                     except ValueError:
                         pass
@@ -1833,12 +1914,12 @@ class FatturaViewer(tk.Tk):
                 if "Imposta" in xpath and field_data["widget"].winfo_exists():
                     field_data["widget"].delete(0, tk.END)
                     field_data["widget"].insert(0, imposta_formatted)
-                    self.log(f"Aggiornato campo UI imposta: {imposta_formatted}")
+                    self.log(f"Aggiornato campo UI imposta: {imposta_formatted}", level=DEBUG)
                     
                     # Aggiorna anche l'elemento XML
                     if field_data["element"] is not None:
                         field_data["element"].text = imposta_formatted
-                        self.log(f"Aggiornato elemento XML imposta: {imposta_formatted}")
+                        self.log(f"Aggiornato elemento XML imposta: {imposta_formatted}", level=DEBUG)
             
             # Calcola e aggiorna l'importo totale documento
             importo_totale = total_amount + imposta
@@ -1848,24 +1929,24 @@ class FatturaViewer(tk.Tk):
                 if "ImportoTotaleDocumento" in xpath and field_data["widget"].winfo_exists():
                     field_data["widget"].delete(0, tk.END)
                     field_data["widget"].insert(0, importo_totale_formatted)
-                    self.log(f"Aggiornato campo UI importo totale: {importo_totale_formatted}")
+                    self.log(f"Aggiornato campo UI importo totale: {importo_totale_formatted}", level=DEBUG)
                     
                     # Aggiorna anche l'elemento XML
                     if field_data["element"] is not None:
                         field_data["element"].text = importo_totale_formatted
-                        self.log(f"Aggiornato elemento XML importo totale: {importo_totale_formatted}")
+                        self.log(f"Aggiornato elemento XML importo totale: {importo_totale_formatted}", level=DEBUG)
             
             # Aggiorna anche il campo ImportoPagamento nei dati pagamento
             for xpath, field_data in self.edit_fields.items():
                 if "ImportoPagamento" in xpath and field_data["widget"].winfo_exists():
                     field_data["widget"].delete(0, tk.END)
                     field_data["widget"].insert(0, importo_totale_formatted)
-                    self.log(f"Aggiornato campo UI importo pagamento: {importo_totale_formatted}")
+                    self.log(f"Aggiornato campo UI importo pagamento: {importo_totale_formatted}", level=DEBUG)
                     
                     # Aggiorna anche l'elemento XML
                     if field_data["element"] is not None:
                         field_data["element"].text = importo_totale_formatted
-                        self.log(f"Aggiornato elemento XML importo pagamento: {importo_totale_formatted}")
+                        self.log(f"Aggiornato elemento XML importo pagamento: {importo_totale_formatted}", level=DEBUG)
             
         except Exception as e:
             self.log(f"Errore nell'aggiornamento dei totali: {str(e)}")
@@ -1889,7 +1970,7 @@ class FatturaViewer(tk.Tk):
             imponibile_str = self.imponibile_widget.get().replace(',', '.')
             
             # Log per debug
-            self.log(f"Calcolando imposta con aliquota: {aliquota_str}, imponibile: {imponibile_str}")
+            self.log(f"Calcolando imposta con aliquota: {aliquota_str}, imponibile: {imponibile_str}", level=DEBUG)
             
             # Verifica che i valori non siano vuoti
             if aliquota_str and imponibile_str:
@@ -1933,11 +2014,13 @@ class FatturaViewer(tk.Tk):
                 
             # Carica il file modello
             self.xml_path = template_path
+            self.current_invoice_id = None
             self.xml_label.config(text=os.path.basename(template_path))
             self.log(f"File modello caricato: {template_path}")
             
             try:
-                self.xml_doc = etree.parse(template_path)
+                # Il modello è analizzato una volta e poi copiato per ogni nuova fattura
+                self.xml_doc = new_document(template_path)
                 self.log("File modello XML caricato con successo")
                 # Aggiorna lo stato dei pulsanti
                 self.update_button_states()
@@ -2040,16 +2123,17 @@ class FatturaViewer(tk.Tk):
                                 f"Il file Excel non esiste.\nCrea prima una fattura in Excel.")
                 return
             
-            # Ottieni l'elenco delle fatture
-            invoices = self.excel_manager.list_invoices()
-            if not invoices:
+            # Prima pagina dell'elenco (i dati arrivano dall'indice, non dal workbook)
+            page_size = 200
+            first_page, total = self.excel_manager.query_invoices(limit=page_size)
+            if not total:
                 messagebox.showinfo("Informazione", "Nessuna fattura trovata nel file Excel")
                 return
             
             # Crea una finestra di dialogo per la gestione
             manager = tk.Toplevel(self)
             manager.title("Gestione Fatture in Excel")
-            manager.geometry("800x500")
+            manager.geometry("960x560")
             manager.transient(self)
             manager.grab_set()
             
@@ -2061,6 +2145,34 @@ class FatturaViewer(tk.Tk):
             header = tk.Label(main_frame, text="Fatture salvate in Excel", font=("", 12, "bold"))
             header.pack(fill=tk.X, pady=(0, 10))
             
+            # Ricerca full-text su descrizioni, soggetti e note
+            search_frame = tk.Frame(main_frame)
+            search_frame.pack(fill=tk.X, pady=(0, 5))
+            
+            tk.Label(search_frame, text="Cerca:").pack(side=tk.LEFT)
+            search_var = tk.StringVar()
+            search_entry = tk.Entry(search_frame, textvariable=search_var)
+            search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+            search_status = tk.Label(search_frame, text="", fg="gray")
+            search_status.pack(side=tk.RIGHT)
+            
+            # Filtri dell'elenco
+            filter_frame = tk.Frame(main_frame)
+            filter_frame.pack(fill=tk.X, pady=(0, 10))
+            
+            filter_vars = {}
+            for key, label, width in (("data_da", "Dal (AAAA-MM-GG):", 11), ("data_a", "Al:", 11),
+                                      ("controparte", "Controparte:", 18),
+                                      ("importo_min", "Importo da:", 9), ("importo_max", "a:", 9)):
+                tk.Label(filter_frame, text=label).pack(side=tk.LEFT, padx=(0, 2))
+                filter_vars[key] = tk.StringVar()
+                tk.Entry(filter_frame, textvariable=filter_vars[key], width=width).pack(side=tk.LEFT, padx=(0, 8))
+            
+            tk.Label(filter_frame, text="Tipo:").pack(side=tk.LEFT, padx=(0, 2))
+            tipo_var = tk.StringVar()
+            ttk.Combobox(filter_frame, textvariable=tipo_var, state="readonly", width=12,
+                         values=("",) + CODE_TABLES["TipoDocumento"].display_values).pack(side=tk.LEFT, padx=(0, 8))
+            
             # Frame per la tabella con scrollbar
             table_frame = tk.Frame(main_frame)
             table_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
@@ -2070,28 +2182,77 @@ class FatturaViewer(tk.Tk):
             scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
             
             # Treeview per visualizzare le fatture
-            columns = ("id", "numero", "data", "cedente", "cessionario")
-            tree = ttk.Treeview(table_frame, columns=columns, show='headings', yscrollcommand=scrollbar.set)
+            columns = ("id", "numero", "data", "tipo", "importo", "cedente", "cessionario", "estratto")
+            tree = ttk.Treeview(table_frame, columns=columns, show='headings')
             
             # Configurazione colonne
             tree.heading("id", text="ID")
             tree.heading("numero", text="Numero Fattura")
             tree.heading("data", text="Data")
+            tree.heading("tipo", text="Tipo")
+            tree.heading("importo", text="Importo")
             tree.heading("cedente", text="Cedente")
             tree.heading("cessionario", text="Cessionario")
+            tree.heading("estratto", text="Testo trovato")
             
             tree.column("id", width=80, anchor="w")
-            tree.column("numero", width=100, anchor="w")
-            tree.column("data", width=100, anchor="w")
-            tree.column("cedente", width=200, anchor="w")
-            tree.column("cessionario", width=200, anchor="w")
+            tree.column("numero", width=90, anchor="w")
+            tree.column("data", width=90, anchor="w")
+            tree.column("tipo", width=50, anchor="w")
+            tree.column("importo", width=90, anchor="e")
+            tree.column("cedente", width=180, anchor="w")
+            tree.column("cessionario", width=180, anchor="w")
+            tree.column("estratto", width=220, anchor="w")
             
             # Nascondi la colonna ID
             tree.column("id", width=0, stretch=tk.NO)
             
-            # Popola la tabella
-            for invoice in invoices:
-                tree.insert("", tk.END, values=invoice)
+            # Stato dell'elenco: le pagine vengono caricate durante lo scorrimento
+            listing = {"filters": {}, "sort_by": "data", "descending": True,
+                       "loaded": 0, "total": total, "loading": False}
+            
+            def insert_rows(rows):
+                for row in rows:
+                    importo = f"{row[4]:.2f}" if row[4] is not None else ""
+                    # L'estratto può contenere più righe di descrizione
+                    tree.insert("", tk.END, values=row[:4] + (importo,) + row[5:7] + (row[7].replace("\n", " | "),))
+                listing["loaded"] += len(rows)
+                search_status.config(text=f"{listing['loaded']} di {listing['total']} fatture")
+            
+            def load_page(reset=False):
+                """Carica la pagina successiva dell'elenco, o la prima se reset è True"""
+                if reset:
+                    tree.delete(*tree.get_children())
+                    listing["loaded"] = 0
+                rows, listing["total"] = self.excel_manager.query_invoices(
+                    listing["filters"], listing["sort_by"], listing["descending"],
+                    offset=listing["loaded"], limit=page_size)
+                insert_rows(rows)
+                listing["loading"] = False
+            
+            def on_tree_scroll(first, last):
+                scrollbar.set(first, last)
+                # Vicino al fondo dell'elenco carica la pagina successiva
+                if float(last) > 0.9 and listing["loaded"] < listing["total"] and not listing["loading"]:
+                    listing["loading"] = True
+                    manager.after_idle(load_page)
+            
+            def sort_by_column(column):
+                # Un secondo clic sulla stessa colonna inverte l'ordinamento
+                if listing["sort_by"] == column:
+                    listing["descending"] = not listing["descending"]
+                else:
+                    listing["sort_by"] = column
+                    listing["descending"] = column in ("data", "importo")
+                load_page(reset=True)
+            
+            for column in ("numero", "data", "tipo", "importo", "cedente", "cessionario"):
+                tree.heading(column, command=lambda c=column: sort_by_column(c))
+            
+            tree.configure(yscrollcommand=on_tree_scroll)
+            
+            # Popola la tabella con la prima pagina
+            insert_rows(first_page)
             
             tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
             scrollbar.config(command=tree.yview)
@@ -2128,6 +2289,7 @@ class FatturaViewer(tk.Tk):
                     if result:
                         # Carica il nuovo file XML
                         self.xml_path = new_xml_path
+                        self.current_invoice_id = None
                         self.xml_label.config(text=os.path.basename(new_xml_path))
                         self.log(f"File XML creato e caricato: {new_xml_path}")
                         
@@ -2219,6 +2381,7 @@ class FatturaViewer(tk.Tk):
                 
                 # Carica il file XML appena creato
                 self.xml_path = xml_path
+                self.current_invoice_id = invoice_id
                 self.xml_label.config(text=f"Temp: {os.path.basename(xml_path)}")
                 self.log(f"File XML temporaneo creato per modifica: {xml_path}")
                 
@@ -2261,10 +2424,16 @@ class FatturaViewer(tk.Tk):
                 success = self.excel_manager.delete_invoice(invoice_id)
                 
                 if success:
+                    # La fattura in modifica non esiste più nel database
+                    if self.current_invoice_id == invoice_id:
+                        self.current_invoice_id = None
                     messagebox.showinfo("Eliminazione completata", 
                                     f"La fattura {invoice_numero} è stata eliminata con successo")
                     # Rimuovi dalla tabella
                     tree.delete(selection[0])
+                    listing["loaded"] -= 1
+                    listing["total"] -= 1
+                    search_status.config(text=f"{listing['loaded']} di {listing['total']} fatture")
                 else:
                     messagebox.showerror("Errore", 
                                     f"Si è verificato un errore durante l'eliminazione della fattura")
@@ -2281,11 +2450,52 @@ class FatturaViewer(tk.Tk):
                     messagebox.showerror("Errore", f"Impossibile aprire il file Excel:\n{str(e)}")
             
             def refresh_list():
-                # Aggiorna l'elenco delle fatture
-                tree.delete(*tree.get_children())
-                invoices = self.excel_manager.list_invoices()
-                for invoice in invoices:
-                    tree.insert("", tk.END, values=invoice)
+                # Ricarica l'elenco con i filtri correnti
+                load_page(reset=True)
+            
+            def read_filters():
+                """Legge e valida i filtri, restituisce None se un valore non è valido"""
+                filters = {"testo": search_var.get().strip(),
+                           "controparte": filter_vars["controparte"].get().strip(),
+                           "tipo_documento": extract_code(tipo_var.get())}
+                try:
+                    for key in ("data_da", "data_a"):
+                        text = filter_vars[key].get().strip()
+                        if text:
+                            datetime.datetime.strptime(text, "%Y-%m-%d")
+                            filters[key] = text
+                    for key in ("importo_min", "importo_max"):
+                        text = filter_vars[key].get().strip()
+                        if text:
+                            filters[key] = float(text.replace(",", "."))
+                except ValueError:
+                    search_status.config(text="Filtro non valido: date AAAA-MM-GG, importi numerici")
+                    return None
+                return filters
+            
+            search_job = [None]
+            
+            def run_search():
+                """Applica ricerca e filtri all'elenco"""
+                search_job[0] = None
+                filters = read_filters()
+                if filters is None:
+                    return
+                listing["filters"] = filters
+                load_page(reset=True)
+            
+            def schedule_search(*args):
+                # Attende una breve pausa nella digitazione prima di cercare
+                if search_job[0] is not None:
+                    manager.after_cancel(search_job[0])
+                search_job[0] = manager.after(300, run_search)
+            
+            search_var.trace_add("write", schedule_search)
+            tipo_var.trace_add("write", schedule_search)
+            for var in filter_vars.values():
+                var.trace_add("write", schedule_search)
+            search_entry.bind("<Return>", lambda e: run_search())
+            search_entry.focus_set()
             
             # Pulsanti azioni
             create_btn = tk.Button(button_frame, text="Crea XML", command=create_xml,
@@ -2362,6 +2572,7 @@ class FatturaViewer(tk.Tk):
                 
             # Aggiorna il percorso del file Excel nel manager
             self.excel_manager.excel_path = filepath
+            self.current_invoice_id = None
             
             # Verifica che il file Excel abbia i fogli necessari
             try:
@@ -2394,6 +2605,15 @@ class FatturaViewer(tk.Tk):
                         return
                 else:
                     wb.close()  # Chiudi il file read-only
+                
+                # Salva le modifiche rimaste nel giornale dopo un'interruzione
+                recovered = self.excel_manager.recover_journal()
+                if recovered:
+                    self.log(f"Recuperate {recovered} modifiche non salvate nella sessione precedente", WARNING)
+                
+                # Allinea le intestazioni dei fogli allo schema corrente
+                if self.excel_manager.migrate_database():
+                    self.log("Intestazioni del database aggiornate allo schema corrente")
                     
                 self.log(f"Database Excel caricato: {filepath}")
                 messagebox.showinfo("Database Excel", f"Database Excel caricato con successo:\n{os.path.basename(filepath)}")
@@ -2441,6 +2661,7 @@ class FatturaViewer(tk.Tk):
             
             # Aggiorna il percorso del file Excel nel manager
             self.excel_manager.excel_path = filepath
+            self.current_invoice_id = None
             
             self.log(f"Nuovo database Excel creato: {filepath}")
             messagebox.showinfo("Database Excel", f"Nuovo database Excel creato con successo:\n{os.path.basename(filepath)}")
@@ -2468,13 +2689,20 @@ class FatturaViewer(tk.Tk):
         import openpyxl
         from openpyxl.styles import Font, PatternFill, Alignment
         
+        # Caricamento e salvataggio passano dal manager, che registra l'impronta del file
+        # e al salvataggio rileva le modifiche fatte nel frattempo da altre postazioni
+        manager = self.excel_manager
+        manager.excel_path = filepath
+        
         # Verifica se il file esiste già
         file_exists = os.path.exists(filepath)
         
         if file_exists:
             # Apri il file esistente
-            wb = openpyxl.load_workbook(filepath)
+            wb = manager._load_workbook()
         else:
+            manager._loaded_state = None
+            manager._loaded_etag = manager._database_etag()
             # Crea un nuovo workbook
             wb = openpyxl.Workbook()
             # Rimuovi il foglio di default
@@ -2496,39 +2724,13 @@ class FatturaViewer(tk.Tk):
             
             # Aggiungi le intestazioni in base al tipo di foglio
             if sheet_name == self.excel_manager.master_sheet_name:
-                headers = [
-                    "ID_Fattura", "NumeroFattura", "DataFattura", "TipoDocumento", 
-                    "ImportoTotale", 
-                    
-                    # Dati del cedente prestatore (aggiunti per risolvere il problema)
-                    "CedenteIdPaese", "CedentePartitaIVA", "CedenteCodiceFiscale",
-                    "CedenteDenominazione", "CedenteNome", "CedenteCognome",
-                    "CedenteRegimeFiscale", "CedenteIndirizzo", "CedenteCAP", 
-                    "CedenteComune", "CedenteProvincia", "CedenteNazione",
-                    
-                    # Dati del cessionario committente (aggiunti per risolvere il problema)
-                    "CessionarioIdPaese", "CessionarioPartitaIVA", "CessionarioCodiceFiscale",
-                    "CessionarioDenominazione", "CessionarioNome", "CessionarioCognome",
-                    "CessionarioIndirizzo", "CessionarioCAP", "CessionarioComune", 
-                    "CessionarioProvincia", "CessionarioNazione",
-                    
-                    "NotaFattura",
-                    "ProgressivoInvio"
-                ]
+                headers = MASTER_HEADERS
             elif sheet_name == self.excel_manager.details_sheet_name:
-                headers = [
-                    "ID_Fattura", "NumeroLinea", "Descrizione", "Quantita", 
-                    "UnitaMisura", "PrezzoUnitario", "PrezzoTotale", "AliquotaIVA", "Note"
-                ]
+                headers = DETAIL_HEADERS
             elif sheet_name == self.excel_manager.summary_sheet_name:
-                headers = [
-                    "ID_Fattura", "AliquotaIVA", "ImponibileImporto", "Imposta", 
-                    "EsigibilitaIVA", "Natura"
-                ]
+                headers = SUMMARY_HEADERS
             elif sheet_name == self.excel_manager.structure_sheet_name:
-                headers = [
-                    "TagXML", "Percorso", "Descrizione"
-                ]
+                headers = STRUCTURE_HEADERS
             else:
                 # Foglio generico senza intestazioni specifiche
                 headers = []
@@ -2548,8 +2750,10 @@ class FatturaViewer(tk.Tk):
         if self.excel_manager.structure_sheet_name in sheet_names:
             self.populate_structure_sheet(wb, filepath)
         
-        # Salva il workbook
-        wb.save(filepath)
+        # Salva il workbook (sostituzione atomica del file, con il blocco del database condiviso);
+        # se un'altra postazione lo ha salvato nel frattempo, i fogli sono ricreati sulla
+        # versione più recente invece di sovrascriverla
+        manager._save_workbook(wb)
 
     def populate_structure_sheet(self, wb, filepath):
         """
@@ -2568,10 +2772,9 @@ class FatturaViewer(tk.Tk):
                 self.log(f"Modello fattura non trovato: {model_path}")
                 return
             
-            # Carica il modello
+            # Struttura del modello (tag e percorsi), calcolata una volta per versione del file
             try:
-                model_doc = etree.parse(model_path)
-                root = model_doc.getroot()
+                structure = template_structure(model_path)
                 self.log("Modello fattura caricato per estrarre la struttura")
             except Exception as e:
                 self.log(f"Errore nel caricamento del modello di fattura: {str(e)}")
@@ -2584,51 +2787,9 @@ class FatturaViewer(tk.Tk):
             
             sheet = wb[self.excel_manager.structure_sheet_name]
             
-            # Ottieni il dizionario delle descrizioni dal manager Excel
+            # Aggiungi la descrizione di ogni tag dal dizionario del manager Excel
             tag_descriptions = self.excel_manager._get_tag_descriptions()
-            
-            # Lista che conterrà tutti i percorsi XML da inserire nel foglio
-            structure_entries = []
-            
-            # Tieni traccia dei percorsi già aggiunti per evitare duplicati
-            added_paths = set()
-            
-            # Funzione ricorsiva per esplorare l'albero XML
-            def explore_xml_tree(element, path=""):
-                # Ottieni il tag senza namespace
-                if '}' in element.tag:
-                    tag = element.tag.split('}')[1]
-                else:
-                    tag = element.tag
-                    
-                # Costruisci il percorso completo
-                current_path = f"{path}/{tag}" if path else f"/{tag}"
-                
-                # Se questo percorso non è già stato aggiunto
-                if current_path not in added_paths:
-                    # Ottieni la descrizione dal dizionario
-                    description = tag_descriptions.get(tag, "")
-                    
-                    # Aggiungi alla lista
-                    structure_entries.append((tag, current_path, description))
-                    added_paths.add(current_path)
-                    
-                    # Debug log
-                    self.log(f"Aggiunto elemento: {tag} - {current_path}")
-                    
-                # Esplora tutti i figli in modo ricorsivo
-                for child in element:
-                    explore_xml_tree(child, current_path)
-            
-            # Avvia l'esplorazione dall'elemento radice
-            # Pulisci il namespace dall'elemento radice se necessario
-            if '}' in root.tag:
-                root_tag = root.tag.split('}')[1]
-            else:
-                root_tag = root.tag
-                
-            self.log(f"Inizio esplorazione albero XML partendo da elemento radice: {root_tag}")
-            explore_xml_tree(root)
+            structure_entries = [(tag, path, tag_descriptions.get(tag, "")) for tag, path in structure]
             
             # Log del numero totale di elementi trovati
             self.log(f"Trovati {len(structure_entries)} elementi nella struttura XML")
@@ -2655,15 +2816,261 @@ class FatturaViewer(tk.Tk):
             
             # Abilita il pulsante Gestisci Fatture
             self.excel_manage_btn.config(state=tk.NORMAL)
+            self.excel_import_btn.config(state=tk.NORMAL)
+            self.excel_batch_btn.config(state=tk.NORMAL)
+            self.excel_register_btn.config(state=tk.NORMAL)
+            self.excel_columnar_btn.config(state=tk.NORMAL)
         else:
             # Nessun database specificato o il file non esiste
             self.excel_db_label.config(text="Non specificato", fg="gray")
             
             # Disabilita il pulsante Gestisci Fatture
             self.excel_manage_btn.config(state=tk.DISABLED)
+            self.excel_import_btn.config(state=tk.DISABLED)
+            self.excel_batch_btn.config(state=tk.DISABLED)
+            self.excel_register_btn.config(state=tk.DISABLED)
+            self.excel_columnar_btn.config(state=tk.DISABLED)
 
 
 
+    def show_vat_register(self):
+        """Mostra il registro IVA del database Excel, con esportazione in CSV o Excel"""
+        if not self.excel_manager.excel_path or not os.path.exists(self.excel_manager.excel_path):
+            messagebox.showerror("Errore", "Carica o crea prima un database Excel")
+            return
+        
+        window = tk.Toplevel(self)
+        window.title("Registro IVA")
+        window.geometry("860x480")
+        window.transient(self)
+        
+        options_frame = tk.Frame(window)
+        options_frame.pack(fill=tk.X, padx=10, pady=10)
+        
+        tk.Label(options_frame, text="Anno:").pack(side=tk.LEFT)
+        year_var = tk.StringVar(value=str(datetime.date.today().year))
+        tk.Entry(options_frame, textvariable=year_var, width=6).pack(side=tk.LEFT, padx=(2, 15))
+        
+        period_var = tk.StringVar(value=registro_iva.PERIOD_MONTH)
+        tk.Radiobutton(options_frame, text="Mensile", variable=period_var,
+                       value=registro_iva.PERIOD_MONTH).pack(side=tk.LEFT)
+        tk.Radiobutton(options_frame, text="Trimestrale", variable=period_var,
+                       value=registro_iva.PERIOD_QUARTER).pack(side=tk.LEFT, padx=(0, 15))
+        
+        table_frame = tk.Frame(window)
+        table_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        
+        scrollbar = tk.Scrollbar(table_frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        columns = ("registro", "periodo", "aliquota", "natura", "esigibilita", "documenti", "imponibile", "imposta")
+        tree = ttk.Treeview(table_frame, columns=columns, show='headings', yscrollcommand=scrollbar.set)
+        for column, header in zip(columns, registro_iva.REGISTER_HEADERS):
+            tree.heading(column, text=header)
+            tree.column(column, width=95, anchor="e" if column in ("aliquota", "documenti", "imponibile", "imposta") else "w")
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=tree.yview)
+        
+        status_label = tk.Label(window, text="", anchor="w")
+        status_label.pack(fill=tk.X, padx=10, pady=5)
+        
+        register = {"rows": []}
+        
+        def calculate():
+            year_text = year_var.get().strip()
+            if year_text and not year_text.isdigit():
+                messagebox.showwarning("Registro IVA", "Indica un anno valido (o lascia vuoto per tutti gli anni)", parent=window)
+                return
+            try:
+                self.config(cursor="watch")
+                self.update_idletasks()
+                rows, skipped = self.excel_manager.vat_register(
+                    period_var.get(), int(year_text) if year_text else None)
+            except Exception as e:
+                self.log(f"Errore nel calcolo del registro IVA: {str(e)}")
+                traceback.print_exc()
+                messagebox.showerror("Errore", f"Errore nel calcolo del registro IVA:\n{str(e)}", parent=window)
+                return
+            finally:
+                self.config(cursor="")
+            
+            register["rows"] = rows
+            tree.delete(*tree.get_children())
+            for row in rows:
+                tree.insert("", tk.END, values=(row.registro, row.periodo, row.aliquota, row.natura,
+                                                row.esigibilita, row.documenti, row.imponibile, row.imposta))
+            
+            # Liquidazione: IVA delle vendite meno IVA degli acquisti
+            settlement = registro_iva.totals_by_period(rows)
+            sales_tax = sum((item[1] for item in settlement), registro_iva.Decimal("0.00"))
+            purchases_tax = sum((item[2] for item in settlement), registro_iva.Decimal("0.00"))
+            status = (f"IVA vendite: {sales_tax}   IVA acquisti: {purchases_tax}   "
+                      f"Saldo: {sales_tax - purchases_tax}")
+            if skipped:
+                status += f"   ({skipped} righe di riepilogo con data o importi non validi escluse)"
+            status_label.config(text=status)
+            self.log(f"Registro IVA calcolato: {len(rows)} righe")
+        
+        def export(extension):
+            if not register["rows"]:
+                messagebox.showinfo("Registro IVA", "Nessun dato da esportare", parent=window)
+                return
+            filetypes = [("File CSV", "*.csv")] if extension == ".csv" else [("File Excel", "*.xlsx")]
+            path = filedialog.asksaveasfilename(title="Esporta registro IVA", defaultextension=extension,
+                                                filetypes=filetypes, initialfile=f"registro_iva{extension}",
+                                                parent=window)
+            if not path:
+                return
+            try:
+                if extension == ".csv":
+                    registro_iva.export_csv(register["rows"], path)
+                else:
+                    registro_iva.export_xlsx(register["rows"], path)
+                self.log(f"Registro IVA esportato: {path}")
+                messagebox.showinfo("Registro IVA", f"Registro esportato in:\n{path}", parent=window)
+            except Exception as e:
+                self.log(f"Errore nell'esportazione del registro IVA: {str(e)}")
+                traceback.print_exc()
+                messagebox.showerror("Errore", f"Errore nell'esportazione del registro IVA:\n{str(e)}", parent=window)
+        
+        tk.Button(options_frame, text="Calcola", command=calculate, width=10).pack(side=tk.LEFT)
+        tk.Button(options_frame, text="Esporta Excel", command=lambda: export(".xlsx"), width=12).pack(side=tk.RIGHT)
+        tk.Button(options_frame, text="Esporta CSV", command=lambda: export(".csv"), width=12).pack(side=tk.RIGHT, padx=5)
+        
+        calculate()
+
+    def export_columnar(self):
+        """Esporta il database Excel in file Parquet o Arrow per gli strumenti di analisi"""
+        if importlib.util.find_spec("pyarrow") is None:
+            messagebox.showerror("Esportazione", "Per questa esportazione è necessario installare pyarrow:\n"
+                                 "pip install pyarrow")
+            return
+        
+        choice = messagebox.askyesnocancel("Esportazione",
+                                           "Esportare in formato Parquet?\n\n"
+                                           "Seleziona 'No' per il formato Arrow IPC (Feather).")
+        if choice is None:
+            return
+        file_format = esporta_colonnare.FORMAT_PARQUET if choice else esporta_colonnare.FORMAT_ARROW
+        
+        output_dir = filedialog.askdirectory(title="Seleziona la cartella di destinazione")
+        if not output_dir:
+            return
+        
+        try:
+            self.config(cursor="watch")
+            self.update_idletasks()
+            written = self.excel_manager.export_columnar(output_dir, file_format)
+        finally:
+            self.config(cursor="")
+        
+        if written is None:
+            messagebox.showerror("Errore", "Esportazione non riuscita, controlla il log per i dettagli")
+            return
+        
+        summary = "\n".join(f"{filename}: {rows} righe" for filename, rows in written.items())
+        messagebox.showinfo("Esportazione completata", f"File scritti in {output_dir}:\n\n{summary}")
+
+    def import_xml_folder(self):
+        """Importa nel database Excel tutte le fatture XML di una cartella"""
+        if not self.excel_manager.excel_path:
+            messagebox.showerror("Errore", "Carica o crea prima un database Excel")
+            return
+        
+        folder = filedialog.askdirectory(title="Seleziona la cartella con le fatture XML o p7m")
+        if not folder:
+            return
+        
+        recursive = messagebox.askyesno("Importazione cartella", "Vuoi includere anche le sottocartelle?")
+        
+        try:
+            self.config(cursor="watch")
+            self.update_idletasks()
+            report = self.excel_manager.import_xml_folder(folder, recursive=recursive)
+        except Exception as e:
+            self.log(f"Errore nell'importazione della cartella: {str(e)}")
+            traceback.print_exc()
+            messagebox.showerror("Errore", f"Errore nell'importazione della cartella:\n{str(e)}")
+            return
+        finally:
+            self.config(cursor="")
+        
+        summary = (f"File trovati: {report['file']}\n"
+                   f"Fatture importate: {report['importate']}\n"
+                   f"Fatture aggiornate: {report['aggiornate']}\n"
+                   f"Già presenti (ignorate): {report['duplicate']}\n"
+                   f"Errori: {len(report['errori'])}")
+        if report["errori"]:
+            # Mostra solo i primi errori per non rendere illeggibile la finestra
+            details = "\n".join(f"- {os.path.basename(path)}: {message}"
+                                for path, message in report["errori"][:10])
+            summary += f"\n\n{details}"
+            if len(report["errori"]) > 10:
+                summary += f"\n... e altri {len(report['errori']) - 10} errori (vedi log)"
+            messagebox.showwarning("Importazione completata", summary)
+        else:
+            messagebox.showinfo("Importazione completata", summary)
+
+    def generate_invoice_batch(self):
+        """Genera dal modello le fatture di un elenco di clienti (fatturazione periodica)"""
+        if not self.excel_manager.excel_path:
+            messagebox.showerror("Errore", "Carica o crea prima un database Excel")
+            return
+        
+        template_path = os.path.join(self.project_dir, "modelloFattura.xml")
+        if not os.path.exists(template_path):
+            messagebox.showerror("Errore", f"File modello non trovato.\nPercorso cercato: {template_path}")
+            return
+        
+        list_path = filedialog.askopenfilename(
+            title="Seleziona l'elenco dei clienti",
+            filetypes=[("Elenco clienti", "*.csv *.xlsx"), ("File CSV", "*.csv"), ("File Excel", "*.xlsx")]
+        )
+        if not list_path:
+            return
+        
+        output_dir = filedialog.askdirectory(title="Seleziona la cartella in cui salvare le fatture")
+        if not output_dir:
+            return
+        
+        # Proposta: il prossimo numero della sequenza dell'anno. Se l'utente la accetta i
+        # numeri sono riservati dalla sequenza al momento della generazione (un'altra
+        # postazione potrebbe averne usati nel frattempo); un numero diverso vale come scelta esplicita
+        proposed = self.excel_manager.next_invoice_number(datetime.date.today().year)
+        first_number = simpledialog.askinteger("Fatturazione periodica", "Numero della prima fattura:",
+                                               initialvalue=proposed, minvalue=1, parent=self)
+        if first_number is None:
+            return
+        if first_number == proposed:
+            first_number = None
+        
+        try:
+            self.config(cursor="watch")
+            self.update_idletasks()
+            report = self.excel_manager.generate_invoice_batch(list_path, output_dir, template_path,
+                                                               first_number=first_number)
+        except Exception as e:
+            self.log(f"Errore nella fatturazione periodica: {str(e)}")
+            traceback.print_exc()
+            messagebox.showerror("Errore", f"Errore nella fatturazione periodica:\n{str(e)}")
+            return
+        finally:
+            self.config(cursor="")
+        
+        summary = (f"Clienti nell'elenco: {report['clienti']}\n"
+                   f"Fatture generate: {report['generate']}\n"
+                   f"Salvate nel database: {report['importate']}\n"
+                   f"Errori: {len(report['errori'])}")
+        if report["errori"]:
+            # Mostra solo i primi errori per non rendere illeggibile la finestra
+            details = "\n".join(f"- {cliente}: {message}" for cliente, message in report["errori"][:10])
+            summary += f"\n\n{details}"
+            if len(report["errori"]) > 10:
+                summary += f"\n... e altri {len(report['errori']) - 10} errori (vedi log)"
+            messagebox.showwarning("Fatturazione periodica completata", summary)
+        else:
+            messagebox.showinfo("Fatturazione periodica completata", summary)
+
     def save_to_excel_db(self):
         """Salva la fattura corrente nel database Excel direttamente dal form di modifica"""
         if not self.xml_doc:
@@ -2719,10 +3126,15 @@ class FatturaViewer(tk.Tk):
                     elements[0].text = new_value
         
         try:
-            # Esporta l'XML aggiornato nel database Excel
-            success = self.excel_manager.export_xml_to_excel(self.xml_doc)
+            # Una fattura aperta dal database viene aggiornata, altrimenti esportata
+            if self.current_invoice_id:
+                success = self.excel_manager.update_invoice(self.current_invoice_id, self.xml_doc)
+            else:
+                success = self.excel_manager.export_xml_to_excel(self.xml_doc)
             
             if success:
+                # I salvataggi successivi aggiornano la stessa fattura
+                self.current_invoice_id = self.excel_manager.last_invoice_id
                 messagebox.showinfo("Salvataggio completato", 
                                 "La fattura è stata salvata con successo nel database Excel.")
                 
@@ -2744,5 +3156,7 @@ class FatturaViewer(tk.Tk):
             messagebox.showerror("Errore", f"Errore nel salvataggio nel database Excel:\n{str(e)}")
                                 
 if __name__ == "__main__":
+    # Necessario per il pool di processi dell'importazione nell'eseguibile PyInstaller
+    multiprocessing.freeze_support()
     app = FatturaViewer()
     app.mainloop()
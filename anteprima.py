@@ -0,0 +1,175 @@
+"""
+Anteprima della fattura integrata nell'editor.
+
+Il riquadro mostra la fattura trasformata con il foglio di stile selezionato
+mentre i campi vengono modificati, senza salvare né aprire il browser. Ogni
+modifica (tasto, selezione, clic) riprogramma un timer: la trasformazione parte
+solo quando l'utente si ferma per PREVIEW_DELAY_MS millisecondi, e solo se il
+documento o il foglio di stile sono cambiati dall'ultima anteprima (stessa
+chiave di rendering.render_key). Il foglio di stile compilato resta in cache
+(vedi rendering.py), quindi un aggiornamento costa una copia del documento, il
+suo hash e una trasformazione.
+
+Se è installato tkhtmlview la pagina viene mostrata come HTML; altrimenti il
+riquadro mostra il testo della pagina, con righe e celle delle tabelle separate.
+"""
+import re
+import time
+import tkinter as tk
+from tkinter import scrolledtext
+
+import lxml.html
+
+from rendering import render_html, render_key
+from instrumentation import span
+from bounded_log import DEBUG
+
+try:
+    from tkhtmlview import HTMLScrolledText
+except ImportError:
+    HTMLScrolledText = None
+
+
+# Attesa dopo l'ultima modifica prima di aggiornare l'anteprima (millisecondi)
+PREVIEW_DELAY_MS = 250
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Elementi HTML seguiti da un a capo nella versione testuale
+_BLOCK_TAGS = {"p", "div", "br", "tr", "table", "h1", "h2", "h3", "h4", "h5", "h6", "li", "ul", "ol"}
+
+
+def html_to_text(html):
+    """
+    Converte una pagina HTML in testo semplice per il riquadro senza tkhtmlview
+
+    Args:
+        html: Pagina HTML (byte)
+
+    Returns:
+        str: Testo della pagina, una riga per blocco o riga di tabella
+    """
+    document = lxml.html.fromstring(html)
+    for element in document.xpath("//script|//style|//head"):
+        element.drop_tree()
+    for element in document.iter():
+        # Gli a capo del sorgente non contano: restano solo quelli dei blocchi
+        if element.text:
+            element.text = _WHITESPACE.sub(" ", element.text)
+        tail = _WHITESPACE.sub(" ", element.tail) if element.tail else ""
+        if isinstance(element.tag, str) and element.tag in ("td", "th"):
+            tail = "\t" + tail
+        elif isinstance(element.tag, str) and element.tag in _BLOCK_TAGS:
+            tail = "\n" + tail
+        element.tail = tail
+
+    lines = (line.strip(" \t").replace(" \t", "\t") for line in document.text_content().split("\n"))
+    return "\n".join(line for line in lines if line.strip())
+
+
+class InvoicePreview:
+    """
+    Riquadro di anteprima aggiornato con ritardo durante la modifica
+    """
+
+    def __init__(self, parent, document_provider, stylesheet_provider, log=None, delay_ms=PREVIEW_DELAY_MS):
+        """
+        Args:
+            parent: Widget contenitore
+            document_provider: Funzione senza argomenti che restituisce il documento da
+                               visualizzare (None se non disponibile)
+            stylesheet_provider: Funzione senza argomenti che restituisce il percorso del
+                                 foglio di stile (None se non selezionato)
+            log: Funzione di log (messaggio, livello)
+            delay_ms: Attesa dopo l'ultima modifica
+        """
+        self.document_provider = document_provider
+        self.stylesheet_provider = stylesheet_provider
+        self.log = log or (lambda message, level=None: None)
+        self.delay_ms = delay_ms
+
+        self.frame = tk.LabelFrame(parent, text="Anteprima")
+        if HTMLScrolledText is not None:
+            self.view = HTMLScrolledText(self.frame, html="")
+        else:
+            self.view = scrolledtext.ScrolledText(self.frame, wrap=tk.WORD, width=60)
+        self.view.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.view.config(state=tk.DISABLED)
+
+        # Chiave dell'ultima anteprima mostrata e timer in attesa
+        self._last_key = None
+        self._job = None
+
+    def schedule(self, event=None):
+        """Riprogramma l'aggiornamento dopo una modifica"""
+        if not self.frame.winfo_ismapped():
+            return
+        if self._job is not None:
+            self.frame.after_cancel(self._job)
+        self._job = self.frame.after(self.delay_ms, self.refresh)
+
+    def cancel(self):
+        """Annulla l'aggiornamento in attesa"""
+        if self._job is not None:
+            self.frame.after_cancel(self._job)
+            self._job = None
+
+    def invalidate(self):
+        """Forza la trasformazione al prossimo aggiornamento (ad esempio con un nuovo documento)"""
+        self._last_key = None
+
+    def refresh(self):
+        """
+        Aggiorna l'anteprima se documento o foglio di stile sono cambiati
+
+        Returns:
+            bool: True se l'anteprima è stata ritrasformata
+        """
+        self._job = None
+        xsl_path = self.stylesheet_provider()
+        if not xsl_path:
+            self._show_text("Seleziona un foglio di stile XSL per l'anteprima")
+            self._last_key = None
+            return False
+
+        start = time.perf_counter()
+        try:
+            xml_doc = self.document_provider()
+            if xml_doc is None:
+                return False
+
+            key = render_key(xml_doc, xsl_path)
+            if key == self._last_key:
+                return False
+
+            with span("anteprima.aggiorna"):
+                html = render_html(xml_doc, xsl_path)
+                self._show_html(html)
+            self._last_key = key
+        except Exception as e:
+            self._show_text(f"Anteprima non disponibile:\n{str(e)}")
+            self._last_key = None
+            return False
+
+        self.log(f"Anteprima aggiornata in {(time.perf_counter() - start) * 1000:.0f} ms", DEBUG)
+        return True
+
+    def _show_html(self, html):
+        """Mostra la pagina mantenendo la posizione di scorrimento"""
+        if HTMLScrolledText is not None:
+            position = self.view.yview()[0]
+            self.view.config(state=tk.NORMAL)
+            self.view.set_html(html.decode("utf-8"))
+            self.view.config(state=tk.DISABLED)
+            self.view.yview_moveto(position)
+        else:
+            self._show_text(html_to_text(html))
+
+    def _show_text(self, text):
+        """Sostituisce il contenuto del riquadro mantenendo la posizione di scorrimento"""
+        position = self.view.yview()[0]
+        self.view.config(state=tk.NORMAL)
+        self.view.delete("1.0", tk.END)
+        self.view.insert("1.0", text)
+        self.view.config(state=tk.DISABLED)
+        self.view.yview_moveto(position)
@@ -0,0 +1,473 @@
+"""
+Fatturazione periodica: generazione in serie delle fatture di un elenco di clienti.
+
+L'elenco (CSV o Excel) ha una riga per linea di fattura; le righe dello stesso
+cliente (colonna "Cliente" oppure, se assente, stessi dati anagrafici) formano
+una fattura. Le colonne del cessionario hanno gli stessi nomi del foglio Fatture
+del database (CessionarioDenominazione, CessionarioPartitaIVA, ...), quelle delle
+linee gli stessi nomi del foglio DettaglioLinee (Descrizione, Quantita, ...).
+
+Ogni fattura è una copia del modello XML (vedi template_cache): cedente, dati di
+trasmissione, condizioni di pagamento e le altre parti fisse restano quelle del
+modello, mentre cessionario, numero, data, linee, riepiloghi e totali vengono
+sostituiti. Gli importi sono calcolati con Decimal e arrotondati al centesimo.
+
+Esempio di elenco (CSV con separatore ";"): la seconda riga è una linea in
+inversione contabile, con aliquota zero e natura N6.3 (subappalto edile).
+
+    Cliente;CessionarioDenominazione;CessionarioPartitaIVA;CessionarioIndirizzo;CessionarioCAP;CessionarioComune;Descrizione;Quantita;PrezzoUnitario;AliquotaIVA;Natura
+    ROSSI;Rossi Srl;01234567890;Via Roma 1;00100;Roma;Canone mensile;1;100,00;22;
+    EDIL;Edil Spa;09876543210;Via Milano 2;20100;Milano;Lavori in subappalto;1;1.500,00;0;N6.3
+"""
+import csv
+import datetime
+import collections
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+import openpyxl
+from lxml import etree
+
+from codici_fatturapa import CODE_TABLES, normalize_code
+
+
+# Colonna opzionale che identifica il cliente (righe con lo stesso valore = una fattura)
+GROUP_COLUMN = "Cliente"
+
+# Dati del cessionario e di trasmissione, uguali su tutte le righe del cliente
+CUSTOMER_COLUMNS = [
+    "CessionarioDenominazione", "CessionarioNome", "CessionarioCognome",
+    "CessionarioIdPaese", "CessionarioPartitaIVA", "CessionarioCodiceFiscale",
+    "CessionarioIndirizzo", "CessionarioCAP", "CessionarioComune",
+    "CessionarioProvincia", "CessionarioNazione",
+    "CodiceDestinatario", "PECDestinatario",
+]
+
+# Dati della linea di fattura
+LINE_COLUMNS = ["Descrizione", "Quantita", "UnitaMisura", "PrezzoUnitario",
+                "AliquotaIVA", "Natura", "RiferimentoNormativo"]
+
+# Colonne che identificano il cliente quando manca la colonna "Cliente"
+_IDENTITY_COLUMNS = ("CessionarioPartitaIVA", "CessionarioCodiceFiscale", "CessionarioDenominazione",
+                     "CessionarioNome", "CessionarioCognome")
+
+_CENT = Decimal("0.01")
+
+
+class _SemicolonDialect(csv.excel):
+    """CSV con separatore ";" (Excel in italiano)"""
+    delimiter = ";"
+
+
+# Schemi XSD già caricati nel processo, per percorso
+_schemas = {}
+
+# Fattura da generare: riga dell'elenco in cui inizia, cliente, dati del cessionario, linee
+InvoiceSpec = collections.namedtuple("InvoiceSpec", "riga cliente cessionario linee")
+
+
+def _clean(value):
+    """Converte una cella dell'elenco in testo senza spazi (stringa vuota se vuota)"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def to_decimal(value):
+    """
+    Converte un importo dell'elenco in Decimal
+
+    Accetta numeri e testi sia nel formato "1234.56" sia in quello italiano "1.234,56".
+
+    Args:
+        value: Valore della cella
+
+    Returns:
+        Decimal: Importo, None se vuoto o non valido
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    text = str(value).strip().replace("€", "").replace(" ", "")
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    try:
+        return Decimal(text)
+    except InvalidOperation:
+        return None
+
+
+def _amount(value, places=2):
+    """Formatta un importo con il numero di decimali indicato"""
+    return str(value.quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP))
+
+
+def _price(value):
+    """Formatta un prezzo o una quantità con almeno due e al massimo otto decimali"""
+    places = min(max(-value.normalize().as_tuple().exponent, 2), 8)
+    return _amount(value, places)
+
+
+def read_rows(path):
+    """
+    Legge l'elenco dei clienti da un file CSV (separatore ";" o ",") o Excel (primo foglio)
+
+    Args:
+        path: Percorso del file
+
+    Returns:
+        list: Tuple (numero di riga, dizionario colonna -> valore)
+    """
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            headers = [_clean(name) for name in next(rows, ())]
+            return [(number, dict(zip(headers, values)))
+                    for number, values in enumerate(rows, 2)
+                    if any(value not in (None, "") for value in values)]
+        finally:
+            wb.close()
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+        except csv.Error:
+            dialect = _SemicolonDialect
+        reader = csv.reader(f, dialect)
+        headers = [_clean(name) for name in next(reader, [])]
+        return [(number, dict(zip(headers, values)))
+                for number, values in enumerate(reader, 2)
+                if any(value.strip() for value in values)]
+
+
+def group_invoices(rows):
+    """
+    Raggruppa le righe dell'elenco in fatture, nell'ordine in cui compaiono i clienti
+
+    Args:
+        rows: Righe restituite da read_rows()
+
+    Returns:
+        list: InvoiceSpec, una per cliente
+    """
+    groups = collections.OrderedDict()
+    for number, row in rows:
+        if _clean(row.get(GROUP_COLUMN)):
+            key = _clean(row.get(GROUP_COLUMN))
+        else:
+            key = tuple(_clean(row.get(name)).upper() for name in _IDENTITY_COLUMNS)
+
+        spec = groups.get(key)
+        if spec is None:
+            customer = {name: _clean(row.get(name)) for name in CUSTOMER_COLUMNS}
+            label = (_clean(row.get(GROUP_COLUMN)) or customer["CessionarioDenominazione"]
+                     or f"{customer['CessionarioNome']} {customer['CessionarioCognome']}".strip()
+                     or f"riga {number}")
+            spec = groups[key] = InvoiceSpec(number, label, customer, [])
+        spec.linee.append({name: row.get(name) for name in LINE_COLUMNS})
+    return list(groups.values())
+
+
+def validate_spec(spec):
+    """
+    Controlla i dati di una fattura prima della generazione
+
+    Args:
+        spec: InvoiceSpec
+
+    Returns:
+        list: Messaggi di errore (vuota se la fattura è valida)
+    """
+    errors = []
+    customer = spec.cessionario
+    foreign = customer["CessionarioNazione"].upper() not in ("", "IT")
+
+    partita_iva = customer["CessionarioPartitaIVA"]
+    codice_fiscale = customer["CessionarioCodiceFiscale"]
+    if not partita_iva and not codice_fiscale:
+        errors.append("partita IVA o codice fiscale del cessionario mancante")
+    if partita_iva and not foreign and not (len(partita_iva) == 11 and partita_iva.isdigit()):
+        errors.append(f"partita IVA non valida: {partita_iva}")
+    if codice_fiscale and not (len(codice_fiscale) in (11, 16) and codice_fiscale.isalnum()):
+        errors.append(f"codice fiscale non valido: {codice_fiscale}")
+    if not customer["CessionarioDenominazione"] and not (customer["CessionarioNome"]
+                                                         and customer["CessionarioCognome"]):
+        errors.append("denominazione (o nome e cognome) del cessionario mancante")
+
+    for name in ("CessionarioIndirizzo", "CessionarioCAP", "CessionarioComune"):
+        if not customer[name]:
+            errors.append(f"{name} mancante")
+    cap = customer["CessionarioCAP"]
+    if cap and not foreign and not (len(cap) == 5 and cap.isdigit()):
+        errors.append(f"CAP non valido: {cap}")
+    provincia = customer["CessionarioProvincia"]
+    if provincia and not (len(provincia) == 2 and provincia.isalpha()):
+        errors.append(f"provincia non valida: {provincia}")
+    codice_destinatario = customer["CodiceDestinatario"]
+    if codice_destinatario and not (len(codice_destinatario) == 7 and codice_destinatario.isalnum()):
+        errors.append(f"codice destinatario non valido: {codice_destinatario}")
+
+    if not spec.linee:
+        errors.append("nessuna linea di fattura")
+    for number, line in enumerate(spec.linee, 1):
+        if not _clean(line.get("Descrizione")):
+            errors.append(f"linea {number}: descrizione mancante")
+        if to_decimal(line.get("PrezzoUnitario")) is None:
+            errors.append(f"linea {number}: prezzo unitario non valido")
+        if _clean(line.get("Quantita")) and to_decimal(line.get("Quantita")) is None:
+            errors.append(f"linea {number}: quantità non valida")
+
+        rate = to_decimal(line.get("AliquotaIVA"))
+        natura = _clean(line.get("Natura"))
+        if rate is None or not 0 <= rate < 100:
+            errors.append(f"linea {number}: aliquota IVA non valida")
+        elif rate == 0 and not normalize_code("Natura", natura):
+            errors.append(f"linea {number}: aliquota zero senza natura valida")
+        elif rate == 0 and CODE_TABLES["Natura"].is_legacy(natura):
+            errors.append(f"linea {number}: natura {natura} non più ammessa, indicare il sottocodice "
+                          f"(es. {normalize_code('Natura', natura)}.1)")
+        elif rate > 0 and natura:
+            errors.append(f"linea {number}: natura indicata con aliquota diversa da zero")
+    return errors
+
+
+def compute_lines(lines):
+    """
+    Calcola prezzi totali, riepiloghi IVA e totale documento
+
+    Args:
+        lines: Linee della fattura (già validate)
+
+    Returns:
+        tuple: (linee con i valori formattati, riepiloghi per (aliquota, natura), totale)
+    """
+    computed = []
+    summary = collections.OrderedDict()
+
+    for number, line in enumerate(lines, 1):
+        price = to_decimal(line.get("PrezzoUnitario"))
+        quantity = to_decimal(line.get("Quantita"))
+        rate = to_decimal(line.get("AliquotaIVA")).quantize(_CENT)
+        natura = normalize_code("Natura", _clean(line.get("Natura"))) if rate == 0 else None
+        total = (price * quantity if quantity is not None else price).quantize(_CENT, ROUND_HALF_UP)
+
+        computed.append({
+            "NumeroLinea": str(number),
+            "Descrizione": _clean(line.get("Descrizione")),
+            "Quantita": _price(quantity) if quantity is not None else None,
+            "UnitaMisura": _clean(line.get("UnitaMisura")) or None,
+            "PrezzoUnitario": _price(price),
+            "PrezzoTotale": _amount(total),
+            "AliquotaIVA": _amount(rate),
+            "Natura": natura,
+        })
+
+        key = (rate, natura)
+        item = summary.get(key)
+        if item is None:
+            item = summary[key] = {"imponibile": Decimal(0),
+                                   "riferimento": _clean(line.get("RiferimentoNormativo")) or None}
+        item["imponibile"] += total
+
+    document_total = Decimal(0)
+    for (rate, natura), item in summary.items():
+        item["imposta"] = (item["imponibile"] * rate / 100).quantize(_CENT, ROUND_HALF_UP)
+        document_total += item["imponibile"] + item["imposta"]
+
+    return computed, summary, document_total
+
+
+def _child(parent, tag, text=None):
+    """Aggiunge un elemento figlio nello stesso namespace del padre"""
+    namespace = etree.QName(parent).namespace
+    element = etree.SubElement(parent, f"{{{namespace}}}{tag}" if namespace else tag)
+    if text is not None:
+        element.text = text
+    return element
+
+
+def _find(parent, path):
+    """Trova un discendente per percorso di nomi locali (namespace ignorato)"""
+    element = parent
+    for tag in path.split("/"):
+        element = next((child for child in element.iterchildren(tag=etree.Element)
+                        if etree.QName(child).localname == tag), None)
+        if element is None:
+            return None
+    return element
+
+
+def _set(parent, path, text):
+    """Imposta il testo di un elemento, creando in coda gli elementi mancanti"""
+    element = parent
+    for tag in path.split("/"):
+        child = _find(element, tag)
+        element = child if child is not None else _child(element, tag)
+    element.text = text
+    return element
+
+
+def _replace_children(parent, tag):
+    """Rimuove i figli con il nome indicato e restituisce la posizione del primo"""
+    children = [child for child in parent.iterchildren(tag=etree.Element)
+                if etree.QName(child).localname == tag]
+    position = parent.index(children[0]) if children else len(parent)
+    for child in children:
+        parent.remove(child)
+    return position
+
+
+def _to_date(element):
+    """Legge la data di un elemento (None se assente o non valida)"""
+    if element is None or not element.text:
+        return None
+    try:
+        return datetime.datetime.strptime(element.text.strip()[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def fill_template(tree, spec, numero, data, progressivo):
+    """
+    Compila una copia del modello con i dati di una fattura
+
+    Args:
+        tree: Copia del modello (viene modificata)
+        spec: InvoiceSpec già validata
+        numero: Numero della fattura
+        data: Data della fattura (datetime.date)
+        progressivo: Progressivo di invio
+
+    Returns:
+        etree._ElementTree: Il documento compilato
+    """
+    root = tree.getroot()
+    header = _find(root, "FatturaElettronicaHeader")
+    body = _find(root, "FatturaElettronicaBody")
+    customer = spec.cessionario
+
+    # Dati di trasmissione
+    trasmissione = _find(header, "DatiTrasmissione")
+    _set(trasmissione, "ProgressivoInvio", progressivo)
+    if customer["CodiceDestinatario"]:
+        _set(trasmissione, "CodiceDestinatario", customer["CodiceDestinatario"].upper())
+    pec = _find(trasmissione, "PECDestinatario")
+    if customer["PECDestinatario"]:
+        _set(trasmissione, "PECDestinatario", customer["PECDestinatario"])
+    elif pec is not None:
+        trasmissione.remove(pec)
+
+    # Cessionario, ricostruito nell'ordine dello schema
+    old = _find(header, "CessionarioCommittente")
+    cessionario = header.makeelement(old.tag, {})
+    header.replace(old, cessionario)
+
+    anagrafici = _child(cessionario, "DatiAnagrafici")
+    if customer["CessionarioPartitaIVA"]:
+        id_fiscale = _child(anagrafici, "IdFiscaleIVA")
+        _child(id_fiscale, "IdPaese", (customer["CessionarioIdPaese"] or "IT").upper())
+        _child(id_fiscale, "IdCodice", customer["CessionarioPartitaIVA"])
+    if customer["CessionarioCodiceFiscale"]:
+        _child(anagrafici, "CodiceFiscale", customer["CessionarioCodiceFiscale"].upper())
+    anagrafica = _child(anagrafici, "Anagrafica")
+    if customer["CessionarioDenominazione"]:
+        _child(anagrafica, "Denominazione", customer["CessionarioDenominazione"])
+    else:
+        _child(anagrafica, "Nome", customer["CessionarioNome"])
+        _child(anagrafica, "Cognome", customer["CessionarioCognome"])
+
+    sede = _child(cessionario, "Sede")
+    _child(sede, "Indirizzo", customer["CessionarioIndirizzo"])
+    _child(sede, "CAP", customer["CessionarioCAP"])
+    _child(sede, "Comune", customer["CessionarioComune"])
+    if customer["CessionarioProvincia"]:
+        _child(sede, "Provincia", customer["CessionarioProvincia"].upper())
+    _child(sede, "Nazione", (customer["CessionarioNazione"] or "IT").upper())
+
+    # Dati generali del documento
+    lines, summary, total = compute_lines(spec.linee)
+    documento = _find(body, "DatiGenerali/DatiGeneraliDocumento")
+    template_date = _to_date(_find(documento, "Data"))
+    _set(documento, "Data", data.isoformat())
+    _set(documento, "Numero", str(numero))
+    _set(documento, "ImportoTotaleDocumento", _amount(total))
+
+    # Linee e riepiloghi, al posto di quelli del modello
+    beni_servizi = _find(body, "DatiBeniServizi")
+    template_esigibilita = _find(beni_servizi, "DatiRiepilogo/EsigibilitaIVA")
+    esigibilita = (template_esigibilita.text if template_esigibilita is not None else None) or "I"
+
+    position = _replace_children(beni_servizi, "DettaglioLinee")
+    _replace_children(beni_servizi, "DatiRiepilogo")
+    new_elements = []
+    for line in lines:
+        element = _child(beni_servizi, "DettaglioLinee")
+        for tag in ("NumeroLinea", "Descrizione", "Quantita", "UnitaMisura",
+                    "PrezzoUnitario", "PrezzoTotale", "AliquotaIVA", "Natura"):
+            if line[tag] is not None:
+                _child(element, tag, line[tag])
+        new_elements.append(element)
+    for (rate, natura), item in summary.items():
+        element = _child(beni_servizi, "DatiRiepilogo")
+        _child(element, "AliquotaIVA", _amount(rate))
+        if natura:
+            _child(element, "Natura", natura)
+        _child(element, "ImponibileImporto", _amount(item["imponibile"]))
+        _child(element, "Imposta", _amount(item["imposta"]))
+        _child(element, "EsigibilitaIVA", esigibilita)
+        if item["riferimento"]:
+            _child(element, "RiferimentoNormativo", item["riferimento"])
+        new_elements.append(element)
+    for offset, element in enumerate(new_elements):
+        beni_servizi.insert(position + offset, element)
+
+    # Pagamento: stesso termine del modello rispetto alla data del documento
+    for dettaglio in body.iter("{*}DettaglioPagamento"):
+        scadenza = _find(dettaglio, "DataScadenzaPagamento")
+        due = _to_date(scadenza)
+        if due is not None and template_date is not None:
+            scadenza.text = (data + (due - template_date)).isoformat()
+        if _find(dettaglio, "ImportoPagamento") is not None:
+            _set(dettaglio, "ImportoPagamento", _amount(total))
+
+    etree.indent(root, space="  ")
+    return tree
+
+
+def invoice_filename(tree, progressivo):
+    """
+    Nome del file della fattura secondo la convenzione SdI (IT + codice trasmittente + progressivo)
+
+    Args:
+        tree: Documento della fattura
+        progressivo: Progressivo di invio
+
+    Returns:
+        str: Nome del file
+    """
+    root = tree.getroot()
+    paese = _find(root, "FatturaElettronicaHeader/DatiTrasmissione/IdTrasmittente/IdPaese")
+    codice = _find(root, "FatturaElettronicaHeader/DatiTrasmissione/IdTrasmittente/IdCodice")
+    prefix = ((paese.text if paese is not None else "IT") or "IT").strip()
+    return f"{prefix}{(codice.text or '').strip() if codice is not None else ''}_{progressivo}.xml"
+
+
+def load_schema(xsd_path):
+    """
+    Carica uno schema XSD, una volta per processo
+
+    Args:
+        xsd_path: Percorso del file XSD
+
+    Returns:
+        etree.XMLSchema: Schema compilato
+    """
+    schema = _schemas.get(xsd_path)
+    if schema is None:
+        schema = _schemas[xsd_path] = etree.XMLSchema(etree.parse(xsd_path))
+    return schema
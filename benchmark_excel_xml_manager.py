@@ -0,0 +1,280 @@
+"""
+Benchmark delle operazioni di ExcelXmlManager su database Excel di dimensione crescente.
+
+Lo script è eseguibile senza interfaccia grafica: le finestre di dialogo di tkinter
+vengono sostituite da stub che non aprono nulla. Per ogni dimensione del database
+misura tempo medio, throughput e picco di memoria di ciascuna operazione.
+
+Esempio:
+    python benchmark_excel_xml_manager.py --dimensioni 100 1000 5000 --ripetizioni 3
+    python benchmark_excel_xml_manager.py --dimensioni 100 --elenco 50000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import types
+import copy
+
+from lxml import etree
+import openpyxl
+
+import excel_xml_manager
+from excel_xml_manager import ExcelXmlManager
+
+
+NS = {"p": "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"}
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class _SilentParent:
+    """Parent fittizio che scarta i messaggi di log del manager"""
+
+    def log(self, message, level=None):
+        pass
+
+
+def _stub_tkinter_dialogs():
+    """Sostituisce messagebox e filedialog con stub che non richiedono un display"""
+    def _noop(*args, **kwargs):
+        return None
+
+    excel_xml_manager.messagebox = types.SimpleNamespace(
+        showinfo=_noop, showerror=_noop, showwarning=_noop,
+        askyesno=lambda *a, **k: False, askquestion=lambda *a, **k: "no"
+    )
+    excel_xml_manager.filedialog = types.SimpleNamespace(
+        askopenfilename=_noop, asksaveasfilename=_noop
+    )
+
+
+def build_database(manager, xml_doc, excel_path, num_invoices):
+    """
+    Crea un database Excel con num_invoices fatture sintetiche ricavate da xml_doc
+
+    Args:
+        manager: ExcelXmlManager usato per l'estrazione dei dati
+        xml_doc: Documento XML di partenza
+        excel_path: Percorso del file Excel da creare
+        num_invoices: Numero di fatture da inserire
+
+    Returns:
+        list: ID delle fatture inserite
+    """
+    # La prima esportazione crea fogli e intestazioni con il codice di produzione
+    manager.export_xml_to_excel(xml_doc, excel_path)
+
+    wb = openpyxl.load_workbook(excel_path)
+    master_sheet = wb[manager.master_sheet_name]
+    details_sheet = wb[manager.details_sheet_name]
+    summary_sheet = wb[manager.summary_sheet_name]
+
+    root = xml_doc.getroot()
+    invoice_ids = [master_sheet.cell(row=2, column=1).value]
+
+    for i in range(1, num_invoices):
+        invoice_id = f"bench-{i:08d}"
+        invoice_ids.append(invoice_id)
+
+        invoice_data = manager._extract_invoice_data(root, invoice_id)
+        invoice_data[1] = str(i)
+        master_sheet.append(invoice_data)
+
+        for line in manager._extract_detail_lines(root, invoice_id):
+            details_sheet.append(line)
+
+        for item in manager._extract_summary_data(root, invoice_id):
+            summary_sheet.append(item)
+
+    wb.save(excel_path)
+    return invoice_ids
+
+
+def measure(func, repetitions, setup=None):
+    """
+    Misura tempo medio e picco di memoria di una funzione
+
+    Args:
+        func: Funzione da misurare (senza argomenti)
+        repetitions: Numero di ripetizioni
+        setup: Funzione eseguita prima di ogni ripetizione, esclusa dalla misura
+
+    Returns:
+        tuple: (secondi medi, picco di memoria in byte)
+    """
+    elapsed = 0.0
+
+    # Le misure di tempo avvengono senza tracemalloc, che rallenta molto le allocazioni
+    for _ in range(repetitions):
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        elapsed += time.perf_counter() - start
+
+    # Un'esecuzione aggiuntiva, tracciata, per il picco di memoria
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed / repetitions, peak
+
+
+def run_benchmark(sizes, repetitions, xml_path):
+    """
+    Esegue il benchmark per ciascuna dimensione del database
+
+    Args:
+        sizes: Lista di dimensioni (numero di fatture)
+        repetitions: Ripetizioni per ciascuna operazione
+        xml_path: Fattura XML usata come modello per i dati
+
+    Returns:
+        list: Righe di risultato (dimensione, operazione, secondi, op/s, picco MB)
+    """
+    _stub_tkinter_dialogs()
+
+    manager = ExcelXmlManager(_SilentParent(), NS)
+    xml_doc = etree.parse(xml_path)
+    results = []
+    
+    # Fattura con numero diverso: l'esportazione misura un inserimento, non un duplicato
+    new_doc = copy.deepcopy(xml_doc)
+    for numero in new_doc.getroot().xpath("//DatiGeneraliDocumento/Numero"):
+        numero.text = "bench-nuova"
+
+    work_dir = tempfile.mkdtemp(prefix="bench_fatturexml_")
+    try:
+        for size in sizes:
+            base_path = os.path.join(work_dir, f"db_{size}.xlsx")
+            work_path = os.path.join(work_dir, f"work_{size}.xlsx")
+            output_xml = os.path.join(work_dir, f"out_{size}.xml")
+
+            invoice_ids = build_database(manager, xml_doc, base_path, size)
+            target_id = invoice_ids[-1]  # Caso peggiore per le scansioni lineari
+
+            def restore_copy():
+                shutil.copyfile(base_path, work_path)
+
+            restore_copy()
+            manager.excel_path = work_path
+            wb = openpyxl.load_workbook(work_path)
+            invoice_data = manager._get_invoice_data_by_id(wb, target_id)
+
+            operations = [
+                ("export_xml_to_excel",
+                 lambda: manager.export_xml_to_excel(new_doc, work_path), restore_copy),
+                ("list_invoices",
+                 lambda: manager.list_invoices(), None),
+                ("_get_invoice_data_by_id",
+                 lambda: manager._get_invoice_data_by_id(wb, target_id), None),
+                ("delete_invoice",
+                 lambda: manager.delete_invoice(target_id), restore_copy),
+                ("_generate_xml_from_invoice_data",
+                 lambda: manager._generate_xml_from_invoice_data(invoice_data), None),
+                ("create_xml_from_excel_by_id",
+                 lambda: manager.create_xml_from_excel_by_id(target_id, output_xml), None),
+            ]
+
+            for name, func, setup in operations:
+                restore_copy()
+                manager.excel_path = work_path
+                seconds, peak = measure(func, repetitions, setup)
+                ops_per_second = 1.0 / seconds if seconds > 0 else float("inf")
+                results.append((size, name, seconds, ops_per_second, peak / (1024 * 1024)))
+                print(f"{size:>8} {name:<34} {seconds * 1000:>10.2f} ms "
+                      f"{ops_per_second:>10.2f} op/s {peak / (1024 * 1024):>9.2f} MB")
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def build_listing_database(manager, xml_doc, excel_path, num_rows):
+    """
+    Crea un database con num_rows righe nel solo foglio principale.
+    Serve a misurare l'elenco delle fatture su fogli grandi senza generare dettagli e riepiloghi.
+
+    Args:
+        manager: ExcelXmlManager usato per l'estrazione dei dati
+        xml_doc: Documento XML di partenza
+        excel_path: Percorso del file Excel da creare
+        num_rows: Numero di righe del foglio principale
+    """
+    # La prima esportazione crea fogli e intestazioni con il codice di produzione.
+    # Il workbook non è in modalità write-only, che non scrive le dimensioni del foglio
+    # e renderebbe il file diverso da quelli salvati dall'applicazione.
+    manager.export_xml_to_excel(xml_doc, excel_path)
+    wb = openpyxl.load_workbook(excel_path)
+    master_sheet = wb[manager.master_sheet_name]
+    master_sheet.delete_rows(2, master_sheet.max_row)
+
+    invoice_data = manager._extract_invoice_data(xml_doc.getroot(), "")
+    for i in range(num_rows):
+        invoice_data[0] = f"bench-{i:08d}"
+        invoice_data[1] = str(i)
+        master_sheet.append(invoice_data)
+    wb.save(excel_path)
+
+
+def run_listing_benchmark(num_rows, repetitions, xml_path):
+    """
+    Misura l'elenco delle fatture su un foglio principale di num_rows righe
+
+    Args:
+        num_rows: Numero di righe del foglio principale
+        repetitions: Ripetizioni per ciascuna misura
+        xml_path: Fattura XML usata come modello
+    """
+    _stub_tkinter_dialogs()
+
+    manager = ExcelXmlManager(_SilentParent(), NS)
+    work_dir = tempfile.mkdtemp(prefix="bench_fatturexml_")
+    try:
+        excel_path = os.path.join(work_dir, f"elenco_{num_rows}.xlsx")
+        build_listing_database(manager, etree.parse(xml_path), excel_path, num_rows)
+        manager.excel_path = excel_path
+
+        def first_row():
+            invoices = manager.iter_invoices()
+            next(invoices)
+            invoices.close()
+
+        for name, func in (("list_invoices", manager.list_invoices),
+                           ("iter_invoices (prima riga)", first_row)):
+            seconds, peak = measure(func, repetitions)
+            print(f"{num_rows:>8} {name:<34} {seconds * 1000:>10.2f} ms "
+                  f"{1.0 / seconds:>10.2f} op/s {peak / (1024 * 1024):>9.2f} MB")
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark delle operazioni di ExcelXmlManager")
+    parser.add_argument("--dimensioni", type=int, nargs="+", default=[100, 1000, 5000],
+                        help="Numero di fatture nei database di prova")
+    parser.add_argument("--ripetizioni", type=int, default=3,
+                        help="Ripetizioni per ciascuna operazione")
+    parser.add_argument("--xml", default=os.path.join(PROJECT_DIR, "Fatt_28_del_18-10-2022.xml"),
+                        help="Fattura XML usata come modello")
+    parser.add_argument("--elenco", type=int, default=0,
+                        help="Righe del foglio principale per il benchmark dell'elenco (0 per saltarlo)")
+    args = parser.parse_args(argv)
+
+    print(f"{'Fatture':>8} {'Operazione':<34} {'Tempo medio':>13} {'Throughput':>15} {'Picco mem.':>12}")
+    run_benchmark(args.dimensioni, args.ripetizioni, args.xml)
+    if args.elenco:
+        run_listing_benchmark(args.elenco, args.ripetizioni, args.xml)
+
+
+if __name__ == "__main__":
+    main()
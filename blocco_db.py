@@ -0,0 +1,248 @@
+"""
+Blocco consultivo del database Excel condiviso tra più postazioni.
+
+Più operatori possono aprire lo stesso file .xlsx da una cartella di rete. La
+lettura non richiede il blocco: ogni client carica il workbook e prepara le
+proprie modifiche. Solo la scrittura (registrazione nel giornale e salvataggio
+atomico) avviene mentre si possiede il blocco, quindi la sezione critica è breve.
+
+Il blocco è un file accanto al database, creato con O_CREAT | O_EXCL: la
+creazione esclusiva funziona anche sulle cartelle condivise, dove i lock di
+fcntl/msvcrt non sono affidabili. Il file contiene postazione, processo, ora di
+acquisizione e un token casuale che identifica il proprietario.
+
+Finché il blocco è posseduto, un thread ne aggiorna la data di modifica ogni
+STALE_AFTER / 4 secondi: un blocco non aggiornato da più di STALE_AFTER secondi
+è considerato abbandonato (processo terminato durante il salvataggio), anche se
+il salvataggio di un database grande dura più di STALE_AFTER. Per rimuoverlo, il
+client in attesa lo rinomina con un nome solo suo (operazione atomica: un solo
+client ci riesce) e controlla che il file spostato sia proprio quello visto
+vecchio; se nel frattempo era stato sostituito da un blocco nuovo lo rimette al
+suo posto. Il rilascio elimina il file solo se contiene ancora il proprio token.
+
+Prima di salvare, il client confronta l'impronta del file (file_state, data di
+modifica e dimensione) con quella letta al caricamento: se un altro client ha
+salvato nel frattempo, il workbook viene ricaricato e le modifiche riapplicate
+alla versione più recente (vedi ExcelXmlManager._save_workbook).
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import getpass
+import datetime
+import threading
+
+from instrumentation import span
+
+
+# Attesa massima del blocco (secondi)
+LOCK_TIMEOUT = 30
+
+# Età oltre la quale un blocco è considerato abbandonato (secondi)
+STALE_AFTER = 120
+
+# Intervallo iniziale e massimo tra due tentativi (secondi)
+_POLL_START = 0.05
+_POLL_MAX = 0.5
+
+
+class DatabaseLockedError(TimeoutError):
+    """Il database è bloccato da un'altra postazione oltre il tempo di attesa"""
+
+
+def lock_path(excel_path):
+    """
+    Restituisce il percorso del file di blocco associato a un file Excel
+
+    Args:
+        excel_path: Percorso del database Excel
+
+    Returns:
+        str: Percorso del file di blocco
+    """
+    return os.path.splitext(excel_path)[0] + ".lock"
+
+
+def _owner(token):
+    """Descrive chi possiede il blocco"""
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = ""
+    return {"postazione": socket.gethostname(), "utente": user, "pid": os.getpid(),
+            "ora": datetime.datetime.now().isoformat(timespec="seconds"), "token": token}
+
+
+def _read_lock(path):
+    """Legge il contenuto di un file di blocco (None se assente o non leggibile)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class DatabaseLock:
+    """
+    Blocco esclusivo del database Excel, da usare come context manager
+    """
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT, stale_after=STALE_AFTER):
+        """
+        Args:
+            path: Percorso del file di blocco (vedi lock_path)
+            timeout: Attesa massima in secondi
+            stale_after: Secondi senza aggiornamenti oltre i quali il blocco è considerato abbandonato
+        """
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self._token = None
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    def holder(self):
+        """
+        Restituisce chi possiede il blocco
+
+        Returns:
+            dict: Postazione, utente, processo e ora di acquisizione; None se il
+                  database non è bloccato o il file non è leggibile
+        """
+        return _read_lock(self.path)
+
+    def owned(self):
+        """
+        Indica se il file di blocco è ancora quello creato da questo oggetto
+
+        Returns:
+            bool: True se il blocco è posseduto
+        """
+        holder = _read_lock(self.path) if self._token else None
+        return holder is not None and holder.get("token") == self._token
+
+    def check(self):
+        """
+        Verifica di possedere ancora il blocco (da chiamare prima di scrivere il database)
+
+        Raises:
+            DatabaseLockedError: Se il blocco è stato rimosso o preso da un'altra postazione
+        """
+        if not self.owned():
+            holder = self.holder() or {}
+            raise DatabaseLockedError(
+                f"Blocco del database perso: ora è di {holder.get('utente', '?')}@{holder.get('postazione', '?')}")
+
+    def _try_acquire(self):
+        """Crea il file di blocco se non esiste"""
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(_owner(token), f)
+        self._token = token
+        return True
+
+    def _remove_if_stale(self):
+        """Rimuove il blocco lasciato da un processo terminato"""
+        try:
+            age = time.time() - os.stat(self.path).st_mtime
+        except OSError:
+            # Rilasciato o rimosso da un altro client nel frattempo
+            return
+        if age <= self.stale_after:
+            return
+
+        stale = _read_lock(self.path)
+        # Il blocco vecchio viene spostato con un nome solo nostro: se un altro client
+        # lo ha già rimosso (o sostituito) la rinomina fallisce o sposta il blocco nuovo
+        moved = f"{self.path}.{uuid.uuid4().hex}.abbandonato"
+        try:
+            os.rename(self.path, moved)
+        except OSError:
+            return
+
+        if stale is not None and _read_lock(moved) == stale:
+            try:
+                os.remove(moved)
+            except OSError:
+                pass
+            return
+
+        # Tra la lettura e la rinomina il blocco è stato sostituito: torna al suo posto
+        try:
+            os.link(moved, self.path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # File system senza collegamenti: la rinomina non sovrascrive un blocco già ricreato
+            if not os.path.exists(self.path):
+                os.rename(moved, self.path)
+                return
+        try:
+            os.remove(moved)
+        except OSError:
+            pass
+
+    def _keep_alive(self):
+        """Aggiorna la data di modifica del blocco finché è posseduto"""
+        interval = max(self.stale_after / 4, 0.05)
+        while not self._stop.wait(interval):
+            if not self.owned():
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def acquire(self):
+        """
+        Acquisisce il blocco, attendendo al massimo timeout secondi
+
+        Raises:
+            DatabaseLockedError: Se il blocco non si libera in tempo
+        """
+        deadline = time.monotonic() + self.timeout
+        delay = _POLL_START
+        with span("excel.blocco.attesa"):
+            while not self._try_acquire():
+                self._remove_if_stale()
+                if time.monotonic() >= deadline:
+                    holder = self.holder() or {}
+                    raise DatabaseLockedError(
+                        f"Database in uso da {holder.get('utente', '?')}@{holder.get('postazione', '?')} "
+                        f"dalle {holder.get('ora', '?')}")
+                time.sleep(delay)
+                delay = min(delay * 2, _POLL_MAX)
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._keep_alive, name="blocco-db", daemon=True)
+        self._heartbeat.start()
+
+    def release(self):
+        """Rilascia il blocco, solo se il file è ancora il nostro"""
+        if self._token is None:
+            return
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            if self.owned():
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        finally:
+            self._token = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
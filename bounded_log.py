@@ -0,0 +1,99 @@
+"""
+Log a livelli per il widget di testo dell'applicazione.
+
+I messaggi vengono accodati in un buffer circolare di dimensione fissa e scritti
+nel widget a blocchi, su un timer after(), invece di un insert per messaggio.
+Il widget non supera mai il numero massimo di righe configurato.
+"""
+import logging
+import collections
+import tkinter as tk
+
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+
+class BoundedLog:
+    """
+    Gestisce la scrittura dei messaggi di log in un widget Text con limite di righe
+    """
+
+    def __init__(self, text_widget, max_lines=2000, flush_interval_ms=200, level=INFO):
+        """
+        Inizializza il log
+
+        Args:
+            text_widget: Widget Text (o ScrolledText) di destinazione
+            max_lines: Numero massimo di righe mantenute nel widget
+            flush_interval_ms: Intervallo tra due scritture nel widget
+            level: Livello minimo dei messaggi mostrati (DEBUG è escluso di default)
+        """
+        self.text_widget = text_widget
+        self.max_lines = max_lines
+        self.flush_interval_ms = flush_interval_ms
+        self.level = level
+
+        # Buffer circolare: se arrivano più messaggi del limite tra due flush,
+        # i più vecchi verrebbero comunque tagliati dal widget
+        self._pending = collections.deque(maxlen=max_lines)
+        self._flush_id = None
+        self._line_count = int(self.text_widget.index("end-1c").split(".")[0]) - 1
+
+    def set_level(self, level):
+        """Imposta il livello minimo dei messaggi mostrati"""
+        self.level = level
+
+    def write(self, message, level=INFO):
+        """
+        Accoda un messaggio per la scrittura nel widget
+
+        Args:
+            message: Testo del messaggio
+            level: Livello del messaggio (DEBUG, INFO, WARNING, ERROR)
+        """
+        if level < self.level:
+            return
+
+        self._pending.append(message)
+
+        if self._flush_id is None:
+            self._flush_id = self.text_widget.after(self.flush_interval_ms, self.flush)
+
+    def flush(self):
+        """Scrive nel widget tutti i messaggi in attesa e applica il limite di righe"""
+        self._flush_id = None
+
+        if not self._pending:
+            return
+
+        try:
+            if not self.text_widget.winfo_exists():
+                self._pending.clear()
+                return
+
+            lines = list(self._pending)
+            self._pending.clear()
+
+            self.text_widget.insert(tk.END, "\n".join(lines) + "\n")
+            # Righe di testo, non messaggi: un messaggio può occupare più righe (es. traceback)
+            self._line_count += sum(line.count("\n") + 1 for line in lines)
+
+            # Rimuove le righe più vecchie oltre il limite
+            excess = self._line_count - self.max_lines
+            if excess > 0:
+                self.text_widget.delete("1.0", f"{excess + 1}.0")
+                self._line_count -= excess
+
+            self.text_widget.see(tk.END)
+        except tk.TclError:
+            # Il widget è stato distrutto durante la chiusura dell'applicazione
+            self._pending.clear()
+
+    def clear(self):
+        """Svuota il widget e il buffer"""
+        self._pending.clear()
+        self.text_widget.delete("1.0", tk.END)
+        self._line_count = 0
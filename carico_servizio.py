@@ -0,0 +1,195 @@
+"""
+Generatore di carico per il servizio HTTP delle fatture (servizio_http.py).
+
+Crea un database Excel di prova, avvia il servizio su una porta locale libera e
+lo interroga con più client concorrenti che mescolano elenchi, letture XML,
+visualizzazioni HTML e salvataggi di nuove fatture. Per ogni operazione riporta
+numero di richieste, errori, latenza mediana e 95° percentile e throughput.
+Alla fine verifica che tutte le fatture salvate dai client siano presenti nel
+database: una scrittura persa fa terminare lo script con codice di errore.
+
+Esempio:
+    python carico_servizio.py --fatture 200 --client 8 --richieste 50 --scritture 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import collections
+import http.client
+
+from lxml import etree
+
+import benchmark_excel_xml_manager as benchmark
+from excel_xml_manager import ExcelXmlManager
+from servizio_http import create_server
+
+
+# Peso relativo delle operazioni di lettura
+READ_MIX = (("elenco", 4), ("xml", 2), ("html", 3), ("dati", 1))
+
+
+def _percentile(values, fraction):
+    """Restituisce il percentile indicato di una lista di valori"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _invoice_with_number(xml_doc, number):
+    """Restituisce la fattura di prova con un altro numero, serializzata"""
+    doc = etree.ElementTree(etree.fromstring(etree.tostring(xml_doc)))
+    for element in doc.getroot().iter("{*}Numero", "Numero"):
+        if element.getparent().tag.endswith("DatiGeneraliDocumento"):
+            element.text = number
+    return etree.tostring(doc, xml_declaration=True, encoding="UTF-8")
+
+
+class _Client(threading.Thread):
+    """
+    Client che esegue una sequenza casuale di richieste su una connessione persistente
+    """
+
+    def __init__(self, number, port, ids, xml_doc, requests, write_fraction, results, seed):
+        super().__init__(name=f"client-{number}")
+        self.number = number
+        self.port = port
+        self.ids = ids
+        self.xml_doc = xml_doc
+        self.requests = requests
+        self.write_fraction = write_fraction
+        self.results = results
+        self.random = random.Random(seed)
+        self.created = []
+
+    def _request(self, method, path, body=None):
+        conn = self.conn
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def _operation(self, index):
+        if self.random.random() < self.write_fraction:
+            number = f"CARICO-{self.number}-{index}"
+            status, body = self._request("POST", "/fatture", _invoice_with_number(self.xml_doc, number))
+            if status == 201:
+                self.created.append(json.loads(body)["id"])
+            return "salvataggio", status in (200, 201)
+
+        operation = self.random.choices([name for name, _ in READ_MIX], [w for _, w in READ_MIX])[0]
+        invoice_id = self.random.choice(self.ids)
+        if operation == "elenco":
+            status, _ = self._request("GET", f"/fatture?limit=50&offset={self.random.randrange(0, 100)}")
+        elif operation == "xml":
+            status, _ = self._request("GET", f"/fatture/{invoice_id}/xml")
+        elif operation == "html":
+            status, _ = self._request("GET", f"/fatture/{invoice_id}/html")
+        else:
+            status, _ = self._request("GET", f"/fatture/{invoice_id}")
+        return operation, status == 200
+
+    def run(self):
+        self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        try:
+            for index in range(self.requests):
+                start = time.perf_counter()
+                try:
+                    operation, ok = self._operation(index)
+                except (OSError, http.client.HTTPException):
+                    operation, ok = "connessione", False
+                    self.conn.close()
+                    self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+                self.results.append((operation, time.perf_counter() - start, ok))
+        finally:
+            self.conn.close()
+
+
+def run_load(num_invoices, clients, requests, write_fraction, xml_path, seed=0):
+    """
+    Esegue la prova di carico
+
+    Args:
+        num_invoices: Fatture del database di prova
+        clients: Client concorrenti
+        requests: Richieste per client
+        write_fraction: Frazione delle richieste che salvano una nuova fattura
+        xml_path: Fattura XML usata come modello
+        seed: Seme dei generatori casuali
+
+    Returns:
+        bool: True se nessuna fattura salvata dai client è andata persa
+    """
+    benchmark._stub_tkinter_dialogs()
+    xml_doc = etree.parse(xml_path)
+    work_dir = tempfile.mkdtemp(prefix="carico_servizio_")
+    excel_path = os.path.join(work_dir, "carico.xlsx")
+
+    try:
+        manager = ExcelXmlManager(benchmark._SilentParent(), benchmark.NS)
+        ids = benchmark.build_database(manager, xml_doc, excel_path, num_invoices)
+
+        server = create_server(excel_path, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.server_address[1]
+
+        results = []
+        workers = [_Client(n, port, ids, xml_doc, requests, write_fraction, results, seed + n)
+                   for n in range(clients)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        server.server_close()
+        server.service.close()
+
+        by_operation = collections.defaultdict(list)
+        errors = collections.Counter()
+        for operation, duration, ok in results:
+            by_operation[operation].append(duration)
+            if not ok:
+                errors[operation] += 1
+
+        print(f"{'Operazione':<14} {'Richieste':>10} {'Errori':>8} {'p50':>10} {'p95':>10}")
+        for operation, durations in sorted(by_operation.items()):
+            print(f"{operation:<14} {len(durations):>10} {errors[operation]:>8} "
+                  f"{_percentile(durations, 0.5) * 1000:>8.1f}ms {_percentile(durations, 0.95) * 1000:>8.1f}ms")
+        print(f"Totale: {len(results)} richieste in {elapsed:.2f} s ({len(results) / elapsed:.1f} richieste/s)")
+
+        # Verifica delle scritture: ogni fattura salvata deve essere nel database
+        created = [invoice_id for worker in workers for invoice_id in worker.created]
+        stored = {row[0] for row in manager.list_invoices()}
+        lost = [invoice_id for invoice_id in created if invoice_id not in stored]
+        print(f"Fatture salvate dai client: {len(created)}, perse: {len(lost)}")
+        return not lost
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prova di carico del servizio HTTP delle fatture")
+    parser.add_argument("--fatture", type=int, default=200, help="Fatture del database di prova")
+    parser.add_argument("--client", type=int, default=8, help="Client concorrenti")
+    parser.add_argument("--richieste", type=int, default=50, help="Richieste per client")
+    parser.add_argument("--scritture", type=float, default=0.1,
+                        help="Frazione delle richieste che salvano una nuova fattura")
+    parser.add_argument("--xml", default=os.path.join(benchmark.PROJECT_DIR, "Fatt_28_del_18-10-2022.xml"),
+                        help="Fattura XML usata come modello")
+    args = parser.parse_args(argv)
+
+    if not run_load(args.fatture, args.client, args.richieste, args.scritture, args.xml):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
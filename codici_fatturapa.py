@@ -0,0 +1,268 @@
+"""
+Tabelle dei codici FatturaPA (TipoDocumento, RegimeFiscale, ModalitaPagamento, Natura, ...).
+
+Le tabelle sono costruite una sola volta per processo e sono immutabili: ogni tabella
+espone sia la mappa codice → descrizione sia la mappa inversa testo → codice, per
+ricavare in O(1) il codice da una voce del menu a tendina (es. "MP05 - Bonifico").
+Sono condivise dall'editor, dai controlli di validazione e da ExcelXmlManager.
+
+I codici dismessi (le nature generiche N2, N3 e N6, sostituite dai sottocodici dal
+2021) restano nelle tabelle per leggere le fatture già emesse, ma non compaiono
+nei menu e non sono accettati nelle nuove fatture (vedi CodeTable.is_legacy).
+"""
+from types import MappingProxyType
+
+
+# Separatore tra codice e descrizione nelle voci dei menu a tendina
+DISPLAY_SEPARATOR = " - "
+
+
+class CodeTable:
+    """
+    Tabella immutabile di codici con le relative descrizioni
+    """
+
+    __slots__ = ("name", "labels", "codes", "displays", "display_values", "legacy")
+
+    def __init__(self, name, entries, legacy=()):
+        """
+        Costruisce la tabella
+
+        Args:
+            name: Nome del campo XML a cui si riferisce la tabella
+            entries: Sequenza di coppie (codice, descrizione)
+            legacy: Codici non più ammessi nelle nuove fatture, riconosciuti solo
+                    per leggere i documenti già emessi
+        """
+        self.name = name
+        self.legacy = frozenset(legacy)
+
+        # codice → descrizione
+        self.labels = MappingProxyType({code: label for code, label in entries})
+
+        # codice → voce del menu a tendina ("TD01 - Fattura")
+        self.displays = MappingProxyType({
+            code: f"{code}{DISPLAY_SEPARATOR}{label}" if label else code
+            for code, label in entries
+        })
+
+        # Voce del menu, descrizione o codice → codice
+        codes = {}
+        for code, label in entries:
+            codes[code] = code
+            if label:
+                codes.setdefault(label, code)
+                codes[self.displays[code]] = code
+        self.codes = MappingProxyType(codes)
+
+        # Voci proposte nei menu: i codici dismessi non si scelgono più
+        self.display_values = tuple(self.displays[code] for code, _ in entries if code not in self.legacy)
+
+    def __contains__(self, code):
+        return code in self.labels
+
+    def is_legacy(self, value):
+        """
+        Indica se un valore corrisponde a un codice non più ammesso
+
+        Args:
+            value: Codice o voce del menu
+
+        Returns:
+            bool: True se il codice è dismesso
+        """
+        return self.code_for(value) in self.legacy
+
+    def code_for(self, value, default=None):
+        """
+        Restituisce il codice corrispondente a una voce del menu, una descrizione o un codice
+
+        Args:
+            value: Testo da convertire
+            default: Valore restituito se il testo non corrisponde a nessun codice
+
+        Returns:
+            str: Codice della tabella o default
+        """
+        if value is None:
+            return default
+        return self.codes.get(str(value).strip(), default)
+
+    def display_for(self, value):
+        """
+        Restituisce la voce del menu a tendina per un codice (o per una voce già completa)
+
+        Args:
+            value: Codice o testo letto dal documento
+
+        Returns:
+            str: Voce del menu o il valore così com'è se non appartiene alla tabella
+        """
+        code = self.code_for(value)
+        return self.displays[code] if code is not None else value
+
+
+CODE_TABLES = MappingProxyType({
+    "TipoDocumento": CodeTable("TipoDocumento", (
+        ("TD01", "Fattura"),
+        ("TD02", "Acconto/anticipo su fattura"),
+        ("TD03", "Acconto/anticipo su parcella"),
+        ("TD04", "Nota di credito"),
+        ("TD05", "Nota di debito"),
+        ("TD06", "Parcella"),
+        ("TD16", "Integrazione fattura reverse charge interno"),
+        ("TD17", "Integrazione/autofattura acquisto servizi estero"),
+        ("TD18", "Integrazione acquisto beni intracomunitari"),
+        ("TD19", "Integrazione/autofattura art.17 c.2 DPR 633/72"),
+        ("TD20", "Autofattura per regolarizzazione"),
+        ("TD21", "Autofattura per splafonamento"),
+        ("TD22", "Estrazione beni da Deposito IVA"),
+        ("TD23", "Estrazione beni da Deposito IVA con versamento IVA"),
+        ("TD24", "Fattura differita art.21 c.4 lett. a"),
+        ("TD25", "Fattura differita art.21 c.4 terzo periodo lett. b"),
+        ("TD26", "Cessione beni ammortizzabili/passaggi interni"),
+        ("TD27", "Fattura per autoconsumo/cessioni gratuite"),
+        ("TD28", "Acquisti da San Marino con IVA (fattura cartacea)"),
+        ("TD29", "Comunicazione per omessa o irregolare fatturazione"),
+    )),
+    "RegimeFiscale": CodeTable("RegimeFiscale", (
+        ("RF01", "Ordinario"),
+        ("RF02", "Contribuenti minimi"),
+        ("RF04", "Agricoltura e attività connesse e pesca"),
+        ("RF05", "Vendita sali e tabacchi"),
+        ("RF06", "Commercio fiammiferi"),
+        ("RF07", "Editoria"),
+        ("RF08", "Gestione servizi telefonia pubblica"),
+        ("RF09", "Rivendita documenti di trasporto pubblico e di sosta"),
+        ("RF10", "Intrattenimenti, giochi e altre attività"),
+        ("RF11", "Agenzie viaggi e turismo"),
+        ("RF12", "Agriturismo"),
+        ("RF13", "Vendite a domicilio"),
+        ("RF14", "Rivendita beni usati, oggetti d'arte"),
+        ("RF15", "Agenzie di vendite all'asta"),
+        ("RF16", "IVA per cassa P.A."),
+        ("RF17", "IVA per cassa art.32-bis DL 83/2012"),
+        ("RF18", "Altro"),
+        ("RF19", "Regime forfettario"),
+    )),
+    "StatoLiquidazione": CodeTable("StatoLiquidazione", (
+        ("LS", "In liquidazione"),
+        ("LN", "Non in liquidazione"),
+    )),
+    "SocioUnico": CodeTable("SocioUnico", (
+        ("SU", "Socio unico"),
+        ("SM", "Più soci"),
+    )),
+    "ModalitaPagamento": CodeTable("ModalitaPagamento", (
+        ("MP01", "Contanti"),
+        ("MP02", "Assegno"),
+        ("MP03", "Assegno circolare"),
+        ("MP04", "Contanti presso Tesoreria"),
+        ("MP05", "Bonifico"),
+        ("MP06", "Vaglia cambiario"),
+        ("MP07", "Bollettino bancario"),
+        ("MP08", "Carta di pagamento"),
+        ("MP09", "RID"),
+        ("MP10", "RID utenze"),
+        ("MP11", "RID veloce"),
+        ("MP12", "RIBA"),
+        ("MP13", "MAV"),
+        ("MP14", "Quietanza erario"),
+        ("MP15", "Giroconto su conti di contabilità speciale"),
+        ("MP16", "Domiciliazione bancaria"),
+        ("MP17", "Domiciliazione postale"),
+        ("MP18", "Bollettino di c/c postale"),
+        ("MP19", "SEPA Direct Debit"),
+        ("MP20", "SEPA Direct Debit CORE"),
+        ("MP21", "SEPA Direct Debit B2B"),
+        ("MP22", "Trattenuta su somme già riscosse"),
+        ("MP23", "PagoPA"),
+    )),
+    "CondizioniPagamento": CodeTable("CondizioniPagamento", (
+        ("TP01", "Pagamento a rate"),
+        ("TP02", "Pagamento completo"),
+        ("TP03", "Anticipo"),
+    )),
+    "EsigibilitaIVA": CodeTable("EsigibilitaIVA", (
+        ("I", "Esigibilità immediata"),
+        ("D", "Esigibilità differita"),
+        ("S", "Scissione dei pagamenti"),
+    )),
+    "Natura": CodeTable("Natura", (
+        ("N1", "Escluse ex art. 15"),
+        ("N2", "Non soggette"),
+        ("N2.1", "Non soggette ad IVA artt. da 7 a 7-septies"),
+        ("N2.2", "Non soggette - altri casi"),
+        ("N3", "Non imponibili"),
+        ("N3.1", "Non imponibili - esportazioni"),
+        ("N3.2", "Non imponibili - cessioni intracomunitarie"),
+        ("N3.3", "Non imponibili - cessioni verso S.Marino"),
+        ("N3.4", "Non imponibili - operazioni assimilate alle cessioni all'esportazione"),
+        ("N3.5", "Non imponibili - a seguito di dichiarazioni d'intento"),
+        ("N3.6", "Non imponibili - altre operazioni"),
+        ("N4", "Esenti"),
+        ("N5", "Regime del margine / IVA non esposta in fattura"),
+        ("N6", "Inversione contabile"),
+        ("N6.1", "Inversione contabile - cessione di rottami e altri materiali di recupero"),
+        ("N6.2", "Inversione contabile - cessione di oro e argento"),
+        ("N6.3", "Inversione contabile - subappalto nel settore edile"),
+        ("N6.4", "Inversione contabile - cessione di fabbricati"),
+        ("N6.5", "Inversione contabile - cessione di telefoni cellulari"),
+        ("N6.6", "Inversione contabile - cessione di prodotti elettronici"),
+        ("N6.7", "Inversione contabile - prestazioni comparto edile e settori connessi"),
+        ("N6.8", "Inversione contabile - operazioni settore energetico"),
+        ("N6.9", "Inversione contabile - altri casi"),
+        ("N7", "IVA assolta in altro stato UE"),
+    ), legacy=("N2", "N3", "N6")),
+    "AliquotaIVA": CodeTable("AliquotaIVA", (
+        ("4.00", ""),
+        ("5.00", ""),
+        ("10.00", ""),
+        ("22.00", ""),
+    )),
+})
+
+
+def get_code_table(path_or_tag):
+    """
+    Restituisce la tabella dei codici per un campo XML
+
+    Args:
+        path_or_tag: Nome del tag o percorso XPath terminante con il tag
+
+    Returns:
+        CodeTable: Tabella del campo o None se il campo non ha codici predefiniti
+    """
+    return CODE_TABLES.get(path_or_tag.rsplit("/", 1)[-1])
+
+
+def extract_code(value):
+    """
+    Estrae il codice da una voce descrittiva come "MP01 - Contanti"
+
+    Args:
+        value: Voce del menu o codice
+
+    Returns:
+        str: Codice estratto
+    """
+    if isinstance(value, str) and DISPLAY_SEPARATOR in value:
+        return value.split(DISPLAY_SEPARATOR, 1)[0].strip()
+    return value
+
+
+def normalize_code(table_name, value, default=None):
+    """
+    Converte un valore (codice o voce descrittiva) nel codice della tabella
+
+    Args:
+        table_name: Nome della tabella (es. "TipoDocumento")
+        value: Valore da normalizzare
+        default: Valore restituito se il valore è vuoto o non valido
+
+    Returns:
+        str: Codice valido o default
+    """
+    if value in (None, ""):
+        return default
+    return CODE_TABLES[table_name].code_for(value, default)
@@ -0,0 +1,226 @@
+"""
+Esportazione del database Excel delle fatture in formato colonnare tipizzato
+(Parquet o Arrow IPC) per gli strumenti di analisi.
+
+Vengono scritti tre file (fatture, linee, riepiloghi) con date di tipo date32 e
+importi decimal128. I fogli sono letti in streaming e scritti a blocchi
+(row group), così la memoria resta limitata anche su archivi grandi.
+
+pyarrow è una dipendenza opzionale: viene importata solo al momento dell'esportazione.
+"""
+import os
+import datetime
+from decimal import Decimal, InvalidOperation
+
+import openpyxl
+
+from instrumentation import span
+from schema_fatture import SheetLayout
+
+
+FORMAT_PARQUET = "parquet"
+FORMAT_ARROW = "arrow"
+
+DEFAULT_ROW_GROUP_SIZE = 10000
+
+# Colonne dei fogli nell'ordine canonico dello schema, con il tipo:
+# "str", "date", "int" oppure ("decimal", precisione, scala)
+MASTER_COLUMNS = [
+    ("ID_Fattura", "str"), ("NumeroFattura", "str"), ("DataFattura", "date"),
+    ("TipoDocumento", "str"), ("ImportoTotale", ("decimal", 15, 2)),
+    ("CedenteIdPaese", "str"), ("CedentePartitaIVA", "str"), ("CedenteCodiceFiscale", "str"),
+    ("CedenteDenominazione", "str"), ("CedenteNome", "str"), ("CedenteCognome", "str"),
+    ("CedenteRegimeFiscale", "str"), ("CedenteIndirizzo", "str"), ("CedenteCAP", "str"),
+    ("CedenteComune", "str"), ("CedenteProvincia", "str"), ("CedenteNazione", "str"),
+    ("CessionarioIdPaese", "str"), ("CessionarioPartitaIVA", "str"), ("CessionarioCodiceFiscale", "str"),
+    ("CessionarioDenominazione", "str"), ("CessionarioNome", "str"), ("CessionarioCognome", "str"),
+    ("CessionarioIndirizzo", "str"), ("CessionarioCAP", "str"), ("CessionarioComune", "str"),
+    ("CessionarioProvincia", "str"), ("CessionarioNazione", "str"),
+    ("NotaFattura", "str"), ("ProgressivoInvio", "str"),
+]
+
+DETAIL_COLUMNS = [
+    ("ID_Fattura", "str"), ("NumeroLinea", "int"), ("Descrizione", "str"),
+    ("Quantita", ("decimal", 21, 8)), ("UnitaMisura", "str"),
+    ("PrezzoUnitario", ("decimal", 21, 8)), ("PrezzoTotale", ("decimal", 21, 8)),
+    ("AliquotaIVA", ("decimal", 6, 2)), ("Note", "str"),
+]
+
+SUMMARY_COLUMNS = [
+    ("ID_Fattura", "str"), ("AliquotaIVA", ("decimal", 6, 2)),
+    ("ImponibileImporto", ("decimal", 15, 2)), ("Imposta", ("decimal", 15, 2)),
+    ("EsigibilitaIVA", "str"), ("Natura", "str"),
+]
+
+
+def _import_pyarrow():
+    """
+    Importa pyarrow solo quando serve
+
+    Returns:
+        tuple: (modulo pyarrow, modulo pyarrow.parquet, modulo pyarrow.ipc)
+
+    Raises:
+        ImportError: Se pyarrow non è installato
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Per l'esportazione Parquet/Arrow è necessario installare pyarrow "
+                          "(pip install pyarrow)")
+    return pyarrow, pyarrow.parquet, pyarrow.ipc
+
+
+def _arrow_schema(pa, columns):
+    """Costruisce lo schema Arrow dalla descrizione delle colonne"""
+    fields = []
+    for name, kind in columns:
+        if kind == "date":
+            arrow_type = pa.date32()
+        elif kind == "int":
+            arrow_type = pa.int32()
+        elif isinstance(kind, tuple):
+            arrow_type = pa.decimal128(kind[1], kind[2])
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def _converter(kind):
+    """Restituisce la funzione che converte un valore del foglio nel tipo della colonna"""
+    if kind == "date":
+        def convert(value):
+            if isinstance(value, datetime.datetime):
+                return value.date()
+            if isinstance(value, datetime.date):
+                return value
+            try:
+                return datetime.datetime.strptime(str(value).strip()[:10], "%Y-%m-%d").date()
+            except ValueError:
+                return None
+        return convert
+
+    if kind == "int":
+        def convert(value):
+            try:
+                return int(str(value).strip())
+            except ValueError:
+                return None
+        return convert
+
+    if isinstance(kind, tuple):
+        precision = kind[1]
+        quantum = Decimal(1).scaleb(-kind[2])
+
+        def convert(value):
+            try:
+                number = Decimal(str(value).strip().replace(",", ".")).quantize(quantum)
+            except InvalidOperation:
+                return None
+            # Un valore oltre la precisione della colonna viene scritto come null
+            return number if len(number.as_tuple().digits) <= precision else None
+        return convert
+
+    return str
+
+
+def _iter_batches(sheet, columns, row_group_size):
+    """
+    Legge un foglio a blocchi di righe, già convertite e organizzate per colonna
+
+    Args:
+        sheet: Foglio in sola lettura
+        columns: Descrizione delle colonne
+        row_group_size: Numero di righe per blocco
+
+    Yields:
+        dict: Nome colonna -> lista di valori
+    """
+    names = [name for name, _ in columns]
+    converters = [_converter(kind) for _, kind in columns]
+
+    # Le colonne sono risolte per nome dall'intestazione del foglio
+    layout = SheetLayout.of(sheet, names)
+
+    batch = {name: [] for name in names}
+    size = 0
+
+    for row in sheet.iter_rows(min_row=2, max_col=layout.max_column(), values_only=True):
+        row = layout.to_canonical(row)
+        if not row[0]:
+            continue
+        for name, convert, value in zip(names, converters, row):
+            # Le celle vuote diventano null, non stringhe vuote
+            batch[name].append(convert(value) if value not in (None, "") else None)
+        size += 1
+
+        if size >= row_group_size:
+            yield batch
+            batch = {name: [] for name in names}
+            size = 0
+
+    if size:
+        yield batch
+
+
+def export_database(excel_path, output_dir, file_format=FORMAT_PARQUET,
+                    row_group_size=DEFAULT_ROW_GROUP_SIZE, sheet_names=None):
+    """
+    Esporta fatture, linee e riepiloghi in file colonnari tipizzati
+
+    Args:
+        excel_path: Percorso del database Excel
+        output_dir: Cartella di destinazione
+        file_format: FORMAT_PARQUET o FORMAT_ARROW (Arrow IPC / Feather v2)
+        row_group_size: Righe per row group (Parquet) o record batch (Arrow)
+        sheet_names: Dizionario opzionale con i nomi dei fogli
+                     ("fatture", "linee", "riepiloghi")
+
+    Returns:
+        dict: Nome del file scritto -> numero di righe
+    """
+    pa, pq, ipc = _import_pyarrow()
+
+    names = {"fatture": "Fatture", "linee": "DettaglioLinee", "riepiloghi": "DatiRiepilogo"}
+    names.update(sheet_names or {})
+
+    extension = ".parquet" if file_format == FORMAT_PARQUET else ".arrow"
+    os.makedirs(output_dir, exist_ok=True)
+    written = {}
+
+    wb = openpyxl.load_workbook(excel_path, read_only=True)
+    try:
+        for key, columns in (("fatture", MASTER_COLUMNS), ("linee", DETAIL_COLUMNS),
+                             ("riepiloghi", SUMMARY_COLUMNS)):
+            if names[key] not in wb.sheetnames:
+                continue
+
+            schema = _arrow_schema(pa, columns)
+            path = os.path.join(output_dir, key + extension)
+            rows = 0
+
+            with span("export.colonnare", tabella=key, formato=file_format):
+                if file_format == FORMAT_PARQUET:
+                    writer = pq.ParquetWriter(path, schema, compression="zstd")
+                else:
+                    writer = ipc.new_file(path, schema)
+
+                try:
+                    for batch in _iter_batches(wb[names[key]], columns, row_group_size):
+                        table = pa.Table.from_pydict(batch, schema=schema)
+                        if file_format == FORMAT_PARQUET:
+                            writer.write_table(table, row_group_size=row_group_size)
+                        else:
+                            writer.write_table(table, max_chunksize=row_group_size)
+                        rows += table.num_rows
+                finally:
+                    writer.close()
+
+            written[os.path.basename(path)] = rows
+    finally:
+        wb.close()
+
+    return written
@@ -9,6 +9,155 @@ import traceback
 from openpyxl.utils import get_column_letter
 import datetime
 import uuid
+import glob
+import sqlite3
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+from instrumentation import span, timed, worker_init, run_collecting, merge_timings
+from bounded_log import DEBUG, INFO, WARNING
+from p7m import parse_invoice
+from indice_fatture import (INDEX_SHEET_NAME, INDEX_HEADERS, MATCH_HASH, InvoiceIndex,
+                            content_hash, natural_key, make_natural_key, cedente_id)
+from ricerca_fatture import (InvoiceSearchIndex, search_index_path, file_state,
+                             sheet_fingerprints, document_fingerprint)
+from piano_xml import XmlPlan, default_columns
+from template_cache import new_document
+from batch_fatture import (read_rows, group_invoices, validate_spec, fill_template,
+                           invoice_filename, load_schema)
+from sequenze import SequenceStore, sequence_path, number_sequence, parse_progressivo, PROGRESSIVO
+from giornale import Journal, journal_path, atomic_save
+from blocco_db import DatabaseLock, lock_path
+from schema_fatture import (MASTER_HEADERS, DETAIL_HEADERS, SUMMARY_HEADERS, STRUCTURE_HEADERS,
+                            ID_COLUMN, SheetLayout, read_headers, migrate_headers)
+import registro_iva
+import esporta_colonnare
+
+
+# Modello delle fatture emesse: il suo cedente è l'azienda che usa il programma
+DEFAULT_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "modelloFattura.xml")
+
+
+def _extract_invoice_rows(root, ns, xml_path, structure=True):
+    """
+    Estrae da un documento le righe da salvare nel database, con un nuovo ID fattura
+    
+    Args:
+        root: Elemento radice della fattura
+        ns: Namespace XML da utilizzare
+        xml_path: Percorso del file della fattura
+        structure: Estrae anche la struttura dell'XML (None se False)
+    
+    Returns:
+        dict: Righe estratte ("master", "details", "summary", "structure"), hash e chiave naturale
+    """
+    manager = ExcelXmlManager(None, ns)
+    invoice_id = str(uuid.uuid4())
+    
+    return {
+        "path": xml_path,
+        "master": manager._extract_invoice_data(root, invoice_id),
+        "details": manager._extract_detail_lines(root, invoice_id),
+        "summary": manager._extract_summary_data(root, invoice_id),
+        "structure": manager._extract_xml_structure(root) if structure else None,
+        "hash": content_hash(root),
+        "chiave": natural_key(root),
+    }
+
+
+# Numero e progressivo provvisori per la validazione prima della numerazione
+# (stesso formato dei valori definitivi)
+_PLACEHOLDER_NUMBER = "1"
+_PLACEHOLDER_PROGRESSIVO = "00000"
+
+# Stato di caricamento che non coincide con nessuno stato registrato nell'indice di
+# ricerca (nemmeno None, lo stato di un indice mai costruito): l'indice va riallineato
+_STALE_STATE = object()
+
+
+def _number_suffix(numero):
+    """Parte numerica finale di un numero fattura ("2024/15" -> 15), None se manca"""
+    match = re.search(r"(\d+)\s*$", str(numero or ""))
+    return int(match.group(1)) if match else None
+
+
+def _extract_invoice_file(xml_path, ns):
+    """
+    Legge un file XML (anche firmato .xml.p7m) ed estrae le righe da salvare nel database.
+    Eseguita nei processi del pool durante l'importazione massiva.
+    
+    Args:
+        xml_path: Percorso del file XML o p7m della fattura
+        ns: Namespace XML da utilizzare
+    
+    Returns:
+        dict: Righe estratte (vedi _extract_invoice_rows) oppure "errore"
+    """
+    try:
+        xml_doc = parse_invoice(xml_path)
+        return _extract_invoice_rows(xml_doc.getroot(), ns, xml_path)
+    except Exception as e:
+        return {"path": xml_path, "errore": str(e)}
+
+
+def _check_invoice_spec(task):
+    """
+    Compila una fattura dal modello con numero e progressivo provvisori e la valida,
+    senza scriverla. Eseguita nei processi del pool durante la fatturazione periodica,
+    prima di riservare i numeri: le fatture scartate non lasciano buchi nella numerazione.
+    
+    Args:
+        task: Tupla (percorso modello, InvoiceSpec, data, percorso XSD o None)
+    
+    Returns:
+        dict: "cliente" ed eventualmente "errore"
+    """
+    template_path, spec, data, xsd_path = task
+    try:
+        tree = fill_template(new_document(template_path), spec, _PLACEHOLDER_NUMBER, data,
+                             _PLACEHOLDER_PROGRESSIVO)
+        if xsd_path:
+            schema = load_schema(xsd_path)
+            if not schema.validate(tree):
+                return {"cliente": spec.cliente, "errore": f"XML non valido: {schema.error_log.last_error}"}
+        return {"cliente": spec.cliente}
+    except Exception as e:
+        return {"cliente": spec.cliente, "errore": str(e)}
+
+
+def _generate_invoice_file(task, ns):
+    """
+    Compila una fattura dal modello, la scrive nella cartella di destinazione ed estrae
+    le righe da salvare nel database. Eseguita nei processi del pool durante la
+    fatturazione periodica; ogni processo analizza il modello una sola volta.
+    
+    Args:
+        task: Tupla (percorso modello, cartella di destinazione, InvoiceSpec, numero,
+              data, progressivo di invio, percorso XSD o None)
+        ns: Namespace XML da utilizzare
+    
+    Returns:
+        dict: Righe estratte (vedi _extract_invoice_rows) oppure "errore"; "cliente" in entrambi i casi
+    """
+    template_path, output_dir, spec, numero, data, progressivo, xsd_path = task
+    try:
+        tree = fill_template(new_document(template_path), spec, numero, data, progressivo)
+        
+        if xsd_path:
+            schema = load_schema(xsd_path)
+            if not schema.validate(tree):
+                return {"cliente": spec.cliente, "errore": f"XML non valido: {schema.error_log.last_error}"}
+        
+        xml_path = os.path.join(output_dir, invoice_filename(tree, progressivo))
+        tree.write(xml_path, xml_declaration=True, encoding="UTF-8", pretty_print=True)
+        
+        # La struttura, uguale per tutte le fatture, viene ricavata una volta dal modello
+        result = _extract_invoice_rows(tree.getroot(), ns, xml_path, structure=False)
+        result["cliente"] = spec.cliente
+        return result
+    except Exception as e:
+        return {"cliente": spec.cliente, "errore": str(e)}
+
 
 class ExcelXmlManager:
     """
@@ -35,15 +184,217 @@ class ExcelXmlManager:
         self.details_sheet_name = "DettaglioLinee"
         self.summary_sheet_name = "DatiRiepilogo"
         self.structure_sheet_name = "StrutturaXML"
+        self.index_sheet_name = INDEX_SHEET_NAME
+        
+        # ID dell'ultima fattura esportata (nuova, aggiornata o già presente)
+        self.last_invoice_id = None
+        
+        # Indice di ricerca full-text e stato del file Excel all'ultimo caricamento
+        self._search_index = None
+        self._loaded_state = None
+        
+        # Impronta del database (e del giornale) al caricamento, per rilevare i salvataggi
+        # di altre postazioni sul file condiviso
+        self._loaded_etag = None
+        
+        # Piano compilato per la generazione dell'XML dai dati Excel
+        self._xml_plan = None
+        
+        # Sequenze persistenti di progressivi di invio e numeri fattura
+        self._sequences = None
+        
+        # Partita IVA (o codice fiscale) dell'azienda, per distinguere le fatture emesse
+        # da quelle ricevute; se None è quella del cedente del modello di fattura
+        self.company_id = None
+        self._template_company_id = None
     
-    def log(self, message):
+    def log(self, message, level=INFO):
         """
         Utilizza il metodo di log del parent se disponibile
+        
+        Args:
+            message: Testo del messaggio
+            level: Livello del messaggio (DEBUG, INFO, WARNING, ERROR)
         """
         if hasattr(self.parent, 'log') and callable(self.parent.log):
-            self.parent.log(message)
-        else:
+            self.parent.log(message, level)
+        elif level >= INFO:
             print(message)
+
+    def _load_workbook(self, read_only=False):
+        """
+        Apre il file Excel corrente registrando il tempo di caricamento
+        
+        Args:
+            read_only: Apre il workbook in modalità sola lettura
+        
+        Returns:
+            Workbook: Workbook Excel
+        """
+        if not read_only:
+            # Stato del file prima delle modifiche, per l'aggiornamento dell'indice di ricerca
+            self._loaded_state = file_state(self.excel_path)
+            self._loaded_etag = self._database_etag()
+        with span("excel.load", read_only=read_only):
+            wb = openpyxl.load_workbook(self.excel_path, read_only=read_only)
+        
+        if not read_only:
+            # Operazioni rimaste nel giornale da un salvataggio interrotto
+            self._replay_journal(wb)
+        return wb
+
+    def _database_etag(self):
+        """Impronta corrente del database Excel e del suo giornale"""
+        return file_state(self.excel_path), file_state(journal_path(self.excel_path))
+
+    def _save_workbook(self, wb, operation=None):
+        """
+        Salva il workbook nel file Excel corrente in modo atomico, registrando
+        prima l'operazione nel giornale (vedi giornale.py).
+        
+        La scrittura avviene con il blocco del database (vedi blocco_db.py). Se dal
+        caricamento un'altra postazione ha salvato il file, il workbook viene
+        ricaricato e l'operazione riapplicata alla versione più recente, così le
+        fatture salvate nel frattempo non vanno perse.
+        
+        Args:
+            wb: Workbook Excel da salvare
+            operation: Operazione da registrare nel giornale ("scrivi": righe delle
+                       fatture, vedi _journal_entry; "rimuovi": ID delle fatture eliminate;
+                       "progressivi": ID fattura -> progressivo di invio assegnato)
+        
+        Raises:
+            DatabaseLockedError: Se il database resta bloccato da un'altra postazione
+        """
+        with DatabaseLock(lock_path(self.excel_path)) as lock:
+            if self._database_etag() != self._loaded_etag:
+                wb = self._merge_latest(operation)
+            
+            # Giornale e file vengono scritti solo se nessun'altra postazione ha preso il blocco
+            lock.check()
+            journal = Journal(journal_path(self.excel_path))
+            if operation:
+                journal.append(operation)
+            
+            with span("excel.save"):
+                atomic_save(wb, self.excel_path)
+            
+            # Il workbook salvato contiene anche le operazioni riapplicate dal giornale
+            journal.clear()
+            self._loaded_etag = self._database_etag()
+
+    def _merge_latest(self, operation):
+        """
+        Ricarica la versione più recente del database e vi riapplica un'operazione
+        (da chiamare con il blocco del database)
+        
+        Args:
+            operation: Operazione da riapplicare (None se il workbook va solo ricaricato)
+        
+        Returns:
+            Workbook: Workbook aggiornato, pronto per il salvataggio
+        """
+        self.log("Il database è stato modificato da un'altra postazione: "
+                 "le modifiche vengono riapplicate alla versione più recente", WARNING)
+        with span("excel.conflitto"):
+            # Il caricamento riapplica anche il giornale e allinea le intestazioni
+            wb = self._open_database_workbook()[0]
+            if operation:
+                self._apply_operation(wb, operation, self._open_invoice_index(wb))
+        return wb
+
+    @staticmethod
+    def _journal_entry(invoice_data, detail_lines, summary_data, hash_value, key):
+        """Descrive nel giornale le righe di una fattura da scrivere"""
+        return {"master": list(invoice_data), "details": [list(line) for line in detail_lines],
+                "summary": [list(item) for item in summary_data], "hash": hash_value, "chiave": key}
+
+    def _replay_journal(self, wb):
+        """
+        Riapplica a un workbook appena caricato le operazioni del giornale non ancora salvate
+        
+        Args:
+            wb: Workbook Excel caricato in scrittura
+        
+        Returns:
+            int: Numero di operazioni riapplicate
+        """
+        operations = Journal(journal_path(self.excel_path)).pending()
+        if not operations:
+            return 0
+        
+        required_sheets = [self.master_sheet_name, self.details_sheet_name, self.summary_sheet_name]
+        if any(name not in wb.sheetnames for name in required_sheets):
+            self.log("Giornale presente ma fogli del database mancanti: operazioni non riapplicate", WARNING)
+            return 0
+        
+        self.log(f"Recupero di {len(operations)} operazioni non salvate dal giornale", WARNING)
+        with span("giornale.recupero", operazioni=len(operations)):
+            index = self._open_invoice_index(wb)
+            for operation in operations:
+                self._apply_operation(wb, operation, index)
+        
+        # L'indice di ricerca non conosce le operazioni recuperate: verrà riallineato
+        self._loaded_state = _STALE_STATE
+        return len(operations)
+
+    def _apply_operation(self, wb, operation, index):
+        """
+        Applica a un workbook un'operazione del giornale. Le fatture sono riscritte
+        per ID; una fattura già salvata nel frattempo con un altro ID (ad esempio
+        da un'altra postazione) viene riconosciuta dall'indice e non duplicata.
+        
+        Args:
+            wb: Workbook Excel
+            operation: Operazione ("scrivi", "rimuovi" e/o "progressivi")
+            index: Indice delle fatture del workbook
+        """
+        for item in operation.get("scrivi", []):
+            invoice_id = item["master"][0]
+            master, details, summary = item["master"], item["details"], item["summary"]
+            
+            existing_id, match = index.find(item["hash"], item["chiave"])
+            if existing_id and existing_id != invoice_id:
+                if match == MATCH_HASH:
+                    self.log(f"Fattura già presente nel database con ID: {existing_id}, nessuna modifica")
+                    continue
+                # Stessa chiave naturale: aggiorna la fattura esistente mantenendone l'ID
+                invoice_id = existing_id
+                master = [invoice_id] + master[1:]
+                details = [[invoice_id] + line[1:] for line in details]
+                summary = [[invoice_id] + row[1:] for row in summary]
+            
+            self._replace_invoice_rows(wb, invoice_id, master, details, summary)
+            index.set(invoice_id, item["hash"], item["chiave"])
+        
+        for invoice_id in operation.get("rimuovi", []):
+            self._delete_invoice_rows(wb, invoice_id)
+        
+        self._set_progressivi(wb, operation.get("progressivi"))
+
+    def recover_journal(self):
+        """
+        Salva nel database Excel le operazioni rimaste nel giornale dopo un'interruzione
+        
+        Returns:
+            int: Numero di operazioni recuperate (0 se il giornale era vuoto o in caso di errore)
+        """
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            return 0
+        pending = len(Journal(journal_path(self.excel_path)).pending())
+        if not pending:
+            return 0
+        
+        try:
+            # Il caricamento in scrittura riapplica il giornale, il salvataggio lo svuota
+            wb = self._load_workbook()
+            self._save_workbook(wb)
+            self._sync_search_index()
+            return pending
+        except Exception as e:
+            self.log(f"Errore nel recupero delle operazioni dal giornale: {str(e)}")
+            traceback.print_exc()
+            return 0
     
     def export_xml_to_excel(self, xml_doc, excel_path=None):
         """
@@ -66,74 +417,58 @@ class ExcelXmlManager:
         try:
             root = xml_doc.getroot()
             
-            # Verifica se il file Excel esiste
-            if os.path.exists(self.excel_path):
-                # Apri il workbook esistente
-                wb = openpyxl.load_workbook(self.excel_path)
-                self.log(f"File Excel esistente aperto: {self.excel_path}")
-            else:
-                # Crea un nuovo workbook e rimuovi il foglio di default
-                wb = openpyxl.Workbook()
-                if "Sheet" in wb.sheetnames:
-                    wb.remove(wb["Sheet"])
-                self.log(f"Nuovo file Excel creato")
-            
-            # Crea o recupera i fogli necessari
-            master_sheet = self._ensure_sheet(wb, self.master_sheet_name)
-            details_sheet = self._ensure_sheet(wb, self.details_sheet_name)
-            summary_sheet = self._ensure_sheet(wb, self.summary_sheet_name)
-            structure_sheet = self._ensure_sheet(wb, self.structure_sheet_name)
-            
-            # Configura le intestazioni nei fogli se sono vuoti
-            self._setup_sheet_headers(master_sheet, [
-                "ID_Fattura", "NumeroFattura", "DataFattura", "TipoDocumento", 
-                "ImportoTotale", "CedenteDenominazione", "CedentePartitaIVA", 
-                "CessionarioDenominazione", "CessionarioPartitaIVA", "NotaFattura"
-            ])
-            
-            self._setup_sheet_headers(details_sheet, [
-                "ID_Fattura", "NumeroLinea", "Descrizione", "Quantita", 
-                "UnitaMisura", "PrezzoUnitario", "PrezzoTotale", "AliquotaIVA", "Note"
-            ])
-            
-            self._setup_sheet_headers(summary_sheet, [
-                "ID_Fattura", "AliquotaIVA", "ImponibileImporto", "Imposta", 
-                "EsigibilitaIVA", "Natura"
-            ])
-            
-            self._setup_sheet_headers(structure_sheet, [
-                "TagXML", "Percorso", "Descrizione"
-            ])
-            
-            # Genera un ID univoco per questa fattura
-            invoice_id = str(uuid.uuid4())
-            
-            # Estrai i dati principali della fattura
-            self.log("Estrazione dati principali della fattura")
-            invoice_data = self._extract_invoice_data(root, invoice_id)
+            wb, master_sheet, details_sheet, summary_sheet, structure_sheet = self._open_database_workbook()
+            index = self._open_invoice_index(wb)
             
-            # Aggiungi i dati della fattura al foglio principale
-            row = master_sheet.max_row + 1
-            for col, value in enumerate(invoice_data, 1):
-                master_sheet.cell(row=row, column=col, value=value)
+            # Progressivo di invio mancante: quello già salvato per la fattura o uno nuovo
+            key = natural_key(root)
+            self._ensure_progressivo(root, wb, index.find(None, key)[0])
             
-            # Estrai e salva le linee di dettaglio
-            self.log("Estrazione linee di dettaglio")
-            detail_lines = self._extract_detail_lines(root, invoice_id)
+            # Una fattura già presente viene riconosciuta dall'indice senza scansionare i fogli
+            hash_value = content_hash(root)
+            existing_id, match = index.find(hash_value, key)
             
-            for line in detail_lines:
-                row = details_sheet.max_row + 1
-                for col, value in enumerate(line, 1):
-                    details_sheet.cell(row=row, column=col, value=value)
+            if match == MATCH_HASH:
+                self.last_invoice_id = existing_id
+                self.log(f"Fattura già presente nel database con ID: {existing_id}, nessuna modifica")
+                return True
+            
+            # Stessa chiave naturale con contenuto diverso: la fattura viene aggiornata
+            invoice_id = existing_id or str(uuid.uuid4())
             
-            # Estrai e salva i dati di riepilogo
+            # Estrai i dati della fattura
+            self.log("Estrazione dati principali della fattura")
+            invoice_data = self._extract_invoice_data(root, invoice_id)
+            self.log("Estrazione linee di dettaglio")
+            detail_lines = self._extract_detail_lines(root, invoice_id)
             self.log("Estrazione dati di riepilogo")
             summary_data = self._extract_summary_data(root, invoice_id)
             
-            for item in summary_data:
-                row = summary_sheet.max_row + 1
-                for col, value in enumerate(item, 1):
-                    summary_sheet.cell(row=row, column=col, value=value)
+            if existing_id:
+                self.log(f"Fattura con la stessa chiave già presente (ID: {existing_id}), aggiornamento dei dati")
+                self._replace_invoice_rows(wb, invoice_id, invoice_data, detail_lines, summary_data)
+            else:
+                # Le righe sono scritte nelle colonne indicate dalle intestazioni dei fogli
+                layouts = self._sheet_layouts(wb)
+                
+                # Aggiungi i dati della fattura al foglio principale
+                row = master_sheet.max_row + 1
+                for col, value in enumerate(layouts[self.master_sheet_name].to_sheet(invoice_data), 1):
+                    master_sheet.cell(row=row, column=col, value=value)
+                
+                # Salva le linee di dettaglio
+                for line in detail_lines:
+                    row = details_sheet.max_row + 1
+                    for col, value in enumerate(layouts[self.details_sheet_name].to_sheet(line), 1):
+                        details_sheet.cell(row=row, column=col, value=value)
+                
+                # Salva i dati di riepilogo
+                for item in summary_data:
+                    row = summary_sheet.max_row + 1
+                    for col, value in enumerate(layouts[self.summary_sheet_name].to_sheet(item), 1):
+                        summary_sheet.cell(row=row, column=col, value=value)
+            
+            index.set(invoice_id, hash_value, key)
             
             # Estrai e salva la struttura XML (solo se il foglio è vuoto)
             if structure_sheet.max_row <= 1:
@@ -150,7 +485,11 @@ class ExcelXmlManager:
                 self._optimize_column_width(sheet)
             
             # Salva il file Excel
-            wb.save(self.excel_path)
+            self._save_workbook(wb, {"scrivi": [self._journal_entry(
+                invoice_data, detail_lines, summary_data, hash_value, key)]})
+            self.last_invoice_id = invoice_id
+            self._sync_search_index(updated=[(invoice_data, detail_lines)])
+            self._advance_sequences([invoice_data])
             
             self.log(f"Fattura esportata in Excel con ID: {invoice_id}")
             self.log(f"Righe di dettaglio: {len(detail_lines)}")
@@ -163,6 +502,271 @@ class ExcelXmlManager:
             traceback.print_exc()
             return False
     
+    def _open_database_workbook(self):
+        """
+        Apre il database Excel (creandolo se non esiste) e prepara i fogli con le intestazioni
+        
+        Returns:
+            tuple: (workbook, foglio fatture, foglio dettagli, foglio riepilogo, foglio struttura)
+        """
+        # Verifica se il file Excel esiste
+        if os.path.exists(self.excel_path):
+            # Apri il workbook esistente
+            wb = self._load_workbook()
+            self.log(f"File Excel esistente aperto: {self.excel_path}")
+        else:
+            # Crea un nuovo workbook e rimuovi il foglio di default
+            wb = openpyxl.Workbook()
+            if "Sheet" in wb.sheetnames:
+                wb.remove(wb["Sheet"])
+            self._loaded_state = None
+            self._loaded_etag = self._database_etag()
+            self.log(f"Nuovo file Excel creato")
+        
+        # Crea o recupera i fogli necessari
+        master_sheet = self._ensure_sheet(wb, self.master_sheet_name)
+        details_sheet = self._ensure_sheet(wb, self.details_sheet_name)
+        summary_sheet = self._ensure_sheet(wb, self.summary_sheet_name)
+        structure_sheet = self._ensure_sheet(wb, self.structure_sheet_name)
+        
+        # Configura le intestazioni nei fogli se sono vuoti, altrimenti le allinea allo schema
+        for sheet, headers in ((master_sheet, MASTER_HEADERS), (details_sheet, DETAIL_HEADERS),
+                               (summary_sheet, SUMMARY_HEADERS)):
+            self._setup_sheet_headers(sheet, headers)
+            self._migrate_sheet_headers(sheet, headers)
+        
+        self._setup_sheet_headers(structure_sheet, STRUCTURE_HEADERS)
+        
+        return wb, master_sheet, details_sheet, summary_sheet, structure_sheet
+
+    def _migrate_sheet_headers(self, sheet, canonical):
+        """
+        Allinea allo schema l'intestazione di un foglio esistente: l'intestazione a
+        10 colonne delle versioni precedenti viene sostituita con i nomi corretti e
+        le colonne mancanti vengono aggiunte. La modifica è salvata con il workbook.
+        
+        Args:
+            sheet: Foglio Excel (non in sola lettura)
+            canonical: Colonne canoniche del foglio
+        
+        Returns:
+            bool: True se l'intestazione è stata modificata
+        """
+        headers = migrate_headers(read_headers(sheet), canonical)
+        if headers is None:
+            return False
+        
+        self._write_headers(sheet, headers)
+        self.log(f"Intestazione del foglio '{sheet.title}' aggiornata allo schema corrente")
+        return True
+
+    def _sheet_layouts(self, wb):
+        """
+        Risolve per nome le colonne dei fogli dati, una volta per caricamento del workbook
+        
+        Args:
+            wb: Workbook Excel
+        
+        Returns:
+            dict: Nome del foglio -> SheetLayout (solo per i fogli presenti)
+        """
+        return {name: SheetLayout.of(wb[name], headers)
+                for name, headers in ((self.master_sheet_name, MASTER_HEADERS),
+                                      (self.details_sheet_name, DETAIL_HEADERS),
+                                      (self.summary_sheet_name, SUMMARY_HEADERS))
+                if name in wb.sheetnames}
+
+    def migrate_database(self):
+        """
+        Aggiorna le intestazioni del database Excel allo schema corrente e assegna il
+        progressivo di invio alle fatture salvate senza
+        
+        Returns:
+            bool: True se il database è stato modificato, False se era già
+                  aggiornato o in caso di errore
+        """
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            self.log(f"File Excel non trovato: {self.excel_path}")
+            return False
+        
+        try:
+            wb = self._load_workbook()
+            changed = False
+            for name, headers in ((self.master_sheet_name, MASTER_HEADERS),
+                                  (self.details_sheet_name, DETAIL_HEADERS),
+                                  (self.summary_sheet_name, SUMMARY_HEADERS)):
+                if name in wb.sheetnames:
+                    changed = self._migrate_sheet_headers(wb[name], headers) or changed
+            
+            assigned = self._assign_missing_progressivi(wb)
+            if assigned:
+                self.log(f"Progressivo di invio assegnato a {len(assigned)} fatture che ne erano prive")
+                changed = True
+            
+            if changed:
+                # I progressivi sono nel giornale: in caso di conflitto vengono riapplicati
+                # alla versione più recente del database
+                self._save_workbook(wb, {"progressivi": assigned} if assigned else None)
+                # Intestazioni e progressivi non sono nell'indice di ricerca, che resta valido
+                self._sync_search_index()
+            return changed
+        
+        except Exception as e:
+            self.log(f"Errore nella migrazione del database Excel: {str(e)}")
+            traceback.print_exc()
+            return False
+
+    def _open_invoice_index(self, wb):
+        """
+        Prepara il foglio indice e lo carica in memoria.
+        Per un database creato prima dell'indice, le chiavi naturali vengono
+        ricostruite dal foglio principale (l'hash sarà calcolato al primo aggiornamento).
+        
+        Args:
+            wb: Workbook Excel
+        
+        Returns:
+            InvoiceIndex: Indice delle fatture
+        """
+        index_sheet = self._ensure_sheet(wb, self.index_sheet_name)
+        self._setup_sheet_headers(index_sheet, INDEX_HEADERS)
+        
+        if index_sheet.max_row <= 1 and self.master_sheet_name in wb.sheetnames:
+            master_sheet = wb[self.master_sheet_name]
+            if master_sheet.max_row > 1:
+                self.log("Creazione dell'indice delle fatture dal foglio principale")
+                layout = SheetLayout.of(master_sheet, MASTER_HEADERS)
+                for row in master_sheet.iter_rows(min_row=2, values_only=True):
+                    invoice_id = layout.value(row, ID_COLUMN)
+                    if invoice_id:
+                        key = make_natural_key(layout.value(row, "CedentePartitaIVA"), layout.value(row, "NumeroFattura"),
+                                               layout.value(row, "DataFattura"), layout.value(row, "TipoDocumento"))
+                        index_sheet.append([invoice_id, "", key])
+        
+        return InvoiceIndex(index_sheet)
+
+    def _find_invoice_rows(self, sheet, invoice_id, id_column=1):
+        """
+        Restituisce i numeri di riga di un foglio che appartengono a una fattura
+        
+        Args:
+            sheet: Foglio Excel
+            invoice_id: ID della fattura
+            id_column: Numero della colonna con l'ID fattura
+        
+        Returns:
+            list: Numeri di riga in ordine crescente
+        """
+        return [row_idx for row_idx, (value,) in
+                enumerate(sheet.iter_rows(min_row=2, min_col=id_column, max_col=id_column,
+                                          values_only=True), 2)
+                if value == invoice_id]
+
+    def _replace_invoice_rows(self, wb, invoice_id, invoice_data, detail_lines, summary_data):
+        """
+        Sostituisce nel workbook i dati di una fattura già presente, riscrivendo
+        le righe esistenti al loro posto. Le righe in eccesso vengono eliminate,
+        quelle mancanti aggiunte in fondo al foglio.
+        
+        Args:
+            wb: Workbook Excel
+            invoice_id: ID della fattura
+            invoice_data: Riga del foglio principale
+            detail_lines: Righe di dettaglio
+            summary_data: Righe di riepilogo
+        
+        Returns:
+            bool: True se la fattura era presente nel foglio principale
+        """
+        found = False
+        layouts = self._sheet_layouts(wb)
+        
+        for sheet_name, rows in ((self.master_sheet_name, [invoice_data]),
+                                 (self.details_sheet_name, detail_lines),
+                                 (self.summary_sheet_name, summary_data)):
+            sheet = wb[sheet_name]
+            layout = layouts[sheet_name]
+            existing_rows = self._find_invoice_rows(sheet, invoice_id, layout.column(ID_COLUMN))
+            if sheet_name == self.master_sheet_name:
+                found = bool(existing_rows)
+            
+            # Sovrascrive le colonne dello schema nelle righe già occupate dalla fattura;
+            # le eventuali colonne aggiunte dall'utente restano invariate
+            for row_idx, values in zip(existing_rows, rows):
+                for i, position in enumerate(layout.positions):
+                    if position >= 0:
+                        sheet.cell(row=row_idx, column=position + 1,
+                                   value=values[i] if i < len(values) else None)
+            
+            # Elimina le righe in eccesso partendo dal fondo
+            for row_idx in reversed(existing_rows[len(rows):]):
+                sheet.delete_rows(row_idx)
+            
+            # Aggiunge le righe nuove
+            for values in rows[len(existing_rows):]:
+                sheet.append(layout.to_sheet(values))
+        
+        return found
+
+    def update_invoice(self, invoice_id, xml_doc):
+        """
+        Aggiorna nel database Excel una fattura già salvata, mantenendone l'ID.
+        Riga principale, righe di dettaglio e di riepilogo vengono riscritte al loro
+        posto con un solo caricamento e un solo salvataggio del workbook.
+        
+        Args:
+            invoice_id: ID della fattura da aggiornare
+            xml_doc: Documento XML con i dati aggiornati
+        
+        Returns:
+            bool: True se l'operazione ha successo, False altrimenti
+        """
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            self.log(f"File Excel non trovato: {self.excel_path}")
+            return False
+        
+        try:
+            root = xml_doc.getroot()
+            
+            wb, master_sheet, details_sheet, summary_sheet, structure_sheet = self._open_database_workbook()
+            index = self._open_invoice_index(wb)
+            
+            self._ensure_progressivo(root, wb, invoice_id)
+            hash_value = content_hash(root)
+            key = natural_key(root)
+            
+            # La chiave naturale non può appartenere a un'altra fattura
+            other_id = index.by_key.get(key)
+            if other_id and other_id != invoice_id:
+                self.log(f"Errore: esiste già un'altra fattura con gli stessi dati identificativi (ID: {other_id})")
+                return False
+            
+            invoice_data = self._extract_invoice_data(root, invoice_id)
+            detail_lines = self._extract_detail_lines(root, invoice_id)
+            summary_data = self._extract_summary_data(root, invoice_id)
+            
+            if not self._replace_invoice_rows(wb, invoice_id, invoice_data, detail_lines, summary_data):
+                self.log(f"Fattura con ID {invoice_id} non trovata nel database")
+                return False
+            
+            index.set(invoice_id, hash_value, key)
+            
+            self._save_workbook(wb, {"scrivi": [self._journal_entry(
+                invoice_data, detail_lines, summary_data, hash_value, key)]})
+            self.last_invoice_id = invoice_id
+            self._sync_search_index(updated=[(invoice_data, detail_lines)])
+            self._advance_sequences([invoice_data])
+            
+            self.log(f"Fattura con ID {invoice_id} aggiornata nel database Excel")
+            self.log(f"Righe di dettaglio: {len(detail_lines)}")
+            self.log(f"Dati di riepilogo: {len(summary_data)}")
+            return True
+        
+        except Exception as e:
+            self.log(f"Errore nell'aggiornamento della fattura: {str(e)}")
+            traceback.print_exc()
+            return False
+
     def _ensure_sheet(self, workbook, sheet_name):
         """
         Assicura che il foglio esista, creandolo se necessario
@@ -189,15 +793,26 @@ class ExcelXmlManager:
         """
         if sheet.max_row <= 1 and sheet.max_column <= 1:
             # Foglio vuoto, aggiungi intestazioni
-            header_font = Font(bold=True, color="FFFFFF")
-            header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-            
-            for col, header in enumerate(headers, 1):
-                cell = sheet.cell(row=1, column=col, value=header)
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.alignment = Alignment(horizontal="center")
+            self._write_headers(sheet, headers)
     
+    def _write_headers(self, sheet, headers):
+        """
+        Scrive la riga di intestazione di un foglio con lo stile del database
+        
+        Args:
+            sheet: Foglio Excel
+            headers: Lista di intestazioni
+        """
+        header_font = Font(bold=True, color="FFFFFF")
+        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+        
+        for col, header in enumerate(headers, 1):
+            cell = sheet.cell(row=1, column=col, value=header)
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.alignment = Alignment(horizontal="center")
+    
+    @timed("xpath.dati_fattura")
     def _extract_invoice_data(self, root, invoice_id):
         """
         Estrae i dati principali della fattura
@@ -387,6 +1002,7 @@ class ExcelXmlManager:
             progressivo_invio,  # Colonna note vuota
         ]
 
+    @timed("xpath.linee_dettaglio")
     def _extract_detail_lines(self, root, invoice_id):
         """
         Estrae tutte le linee di dettaglio
@@ -424,6 +1040,7 @@ class ExcelXmlManager:
         
         return lines
     
+    @timed("xpath.dati_riepilogo")
     def _extract_summary_data(self, root, invoice_id):
         """
         Estrae i dati di riepilogo
@@ -651,20 +1268,21 @@ class ExcelXmlManager:
             # Log per debugging
             self.log("Avvio selettore fatture")
             
-            # Estrai l'elenco delle fatture
+            # Estrai l'elenco delle fatture, con le colonne risolte per nome
             invoices = []
-            for row in range(2, master_sheet.max_row + 1):
-                invoice_id = master_sheet.cell(row=row, column=1).value
+            layout = SheetLayout.of(master_sheet, MASTER_HEADERS)
+            for row in master_sheet.iter_rows(min_row=2, values_only=True):
+                invoice_id = layout.value(row, ID_COLUMN)
                 if not invoice_id:
                     continue
                     
-                numero = master_sheet.cell(row=row, column=2).value or ""
-                data = master_sheet.cell(row=row, column=3).value or ""
-                cedente = master_sheet.cell(row=row, column=6).value or ""
-                cessionario = master_sheet.cell(row=row, column=8).value or ""
+                numero = layout.value(row, "NumeroFattura") or ""
+                data = layout.value(row, "DataFattura") or ""
+                cedente = layout.value(row, "CedenteDenominazione") or ""
+                cessionario = layout.value(row, "CessionarioDenominazione") or ""
                 
                 # Log dei valori per debug
-                self.log(f"Fattura trovata: ID={invoice_id}, Numero={numero}, Data={data}")
+                self.log(f"Fattura trovata: ID={invoice_id}, Numero={numero}, Data={data}", level=DEBUG)
                 
                 display_text = f"{numero} - {data} - {cedente} → {cessionario}"
                 invoices.append((invoice_id, display_text))
@@ -776,39 +1394,54 @@ class ExcelXmlManager:
             "structure": self._extract_xml_structure_from_sheet(workbook[self.structure_sheet_name])
         }
         
-        # Estrai i dati principali della fattura
+        # Le righe vengono restituite nell'ordine canonico delle colonne
+        layouts = self._sheet_layouts(workbook)
+        
+        # Estrai i dati principali della fattura, partendo dalla riga registrata nell'indice
         master_sheet = workbook[self.master_sheet_name]
-        for row in range(2, master_sheet.max_row + 1):
-            if master_sheet.cell(row=row, column=1).value == invoice_id:
-                invoice_data["master"] = [
-                    master_sheet.cell(row=row, column=i).value 
-                    for i in range(1, master_sheet.max_column + 1)
-                ]
+        master_layout = layouts[self.master_sheet_name]
+        id_column = master_layout.column(ID_COLUMN)
+        hint = self._master_row_hint(invoice_id)
+        candidates = range(2, master_sheet.max_row + 1)
+        if hint and 2 <= hint <= master_sheet.max_row:
+            candidates = [hint] + [row for row in candidates if row != hint]
+        for row in candidates:
+            if master_sheet.cell(row=row, column=id_column).value == invoice_id:
+                invoice_data["master"] = master_layout.to_canonical(
+                    next(master_sheet.iter_rows(min_row=row, max_row=row, values_only=True)))
                 break
         
         if not invoice_data["master"]:
             return None
         
- 
-        # Estrai le linee di dettaglio
-        details_sheet = workbook[self.details_sheet_name]
-        for row in range(2, details_sheet.max_row + 1):
-            if details_sheet.cell(row=row, column=1).value == invoice_id:
-                line_data = [details_sheet.cell(row=row, column=i).value 
-                            for i in range(1, details_sheet.max_column + 1)]
-                invoice_data["details"].append(line_data)
-        
-        # Estrai i dati di riepilogo
-        summary_sheet = workbook[self.summary_sheet_name]
-        for row in range(2, summary_sheet.max_row + 1):
-            if summary_sheet.cell(row=row, column=1).value == invoice_id:
-                summary_data = [summary_sheet.cell(row=row, column=i).value 
-                                for i in range(1, summary_sheet.max_column + 1)]
-                invoice_data["summary"].append(summary_data)
+        # Estrai le linee di dettaglio e i dati di riepilogo
+        for sheet_name, key in ((self.details_sheet_name, "details"), (self.summary_sheet_name, "summary")):
+            layout = layouts[sheet_name]
+            for row in workbook[sheet_name].iter_rows(min_row=2, values_only=True):
+                if layout.value(row, ID_COLUMN) == invoice_id:
+                    invoice_data[key].append(layout.to_canonical(row))
         
         return invoice_data
 
 
+    def _master_row_hint(self, invoice_id):
+        """
+        Restituisce la riga del foglio principale registrata nell'indice di ricerca
+        
+        Args:
+            invoice_id: ID della fattura
+        
+        Returns:
+            int: Numero di riga da verificare, None se non disponibile
+        """
+        if not self.excel_path:
+            return None
+        try:
+            index = self._open_search_index()
+            return index.row_of(invoice_id) if index is not None else None
+        except sqlite3.Error:
+            return None
+
     def _extract_xml_structure_from_sheet(self, structure_sheet):
         """
         Estrae la struttura XML dal foglio dedicato
@@ -834,6 +1467,7 @@ class ExcelXmlManager:
         
         return structure
 
+    @timed("xml.genera")
     def _generate_xml_from_invoice_data(self, invoice_data):
         """
         Genera un documento XML dai dati della fattura
@@ -844,226 +1478,22 @@ class ExcelXmlManager:
         Returns:
             etree.ElementTree: Documento XML generato
         """
-        ns_uri = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
-        
-        # Crea elemento radice SENZA prefisso nel namespace
-        nsmap = {None: ns_uri}
-        root = etree.Element(f"{{{ns_uri}}}FatturaElettronica", nsmap=nsmap)
-        root.set("versione", "FPR12")
-        
-        # Crea la struttura base
-        header = etree.SubElement(root, f"{{{ns_uri}}}FatturaElettronicaHeader")
-        body = etree.SubElement(root, f"{{{ns_uri}}}FatturaElettronicaBody")
-        
-        # Ottieni i dati principali
-        master_data = invoice_data["master"]
-        details_data = invoice_data["details"]
-        summary_data = invoice_data["summary"]
-        progressivo_invio = master_data[-1] if len(master_data) > 28 else None
-        # Indici per i dati nel master_data
-        # Nota: questi indici devono corrispondere esattamente all'ordine restituito da _extract_invoice_data
-        
-        # Indici base
-        IDX_ID = 0
-        IDX_NUMERO = 1
-        IDX_DATA = 2
-        IDX_TIPO_DOC = 3
-        IDX_IMPORTO = 4
-        
-        # Indici dati cedente
-        IDX_CEDENTE_ID_PAESE = 5
-        IDX_CEDENTE_PARTITA_IVA = 6
-        IDX_CEDENTE_CF = 7
-        IDX_CEDENTE_DENOMINAZIONE = 8
-        IDX_CEDENTE_NOME = 9
-        IDX_CEDENTE_COGNOME = 10
-        IDX_CEDENTE_REGIME = 11
-        IDX_CEDENTE_INDIRIZZO = 12
-        IDX_CEDENTE_CAP = 13
-        IDX_CEDENTE_COMUNE = 14
-        IDX_CEDENTE_PROVINCIA = 15
-        IDX_CEDENTE_NAZIONE = 16
-        
-        # Indici dati cessionario
-        IDX_CESS_ID_PAESE = 17
-        IDX_CESS_PARTITA_IVA = 18
-        IDX_CESS_CF = 19
-        IDX_CESS_DENOMINAZIONE = 20
-        IDX_CESS_NOME = 21
-        IDX_CESS_COGNOME = 22
-        IDX_CESS_INDIRIZZO = 23
-        IDX_CESS_CAP = 24
-        IDX_CESS_COMUNE = 25
-        IDX_CESS_PROVINCIA = 26
-        IDX_CESS_NAZIONE = 27
-        
-        # Crea struttura DatiTrasmissione
-        dati_trasmissione = etree.SubElement(header, f"{{{ns_uri}}}DatiTrasmissione")
-        id_trasmittente = etree.SubElement(dati_trasmissione, f"{{{ns_uri}}}IdTrasmittente")
-        etree.SubElement(id_trasmittente, f"{{{ns_uri}}}IdPaese").text = master_data[IDX_CEDENTE_ID_PAESE] or "IT"
-        etree.SubElement(id_trasmittente, f"{{{ns_uri}}}IdCodice").text = master_data[IDX_CEDENTE_PARTITA_IVA] or "00000000000"
-
-
-        if progressivo_invio:
-            etree.SubElement(dati_trasmissione, f"{{{ns_uri}}}ProgressivoInvio").text = progressivo_invio
-        else:
-            import time
-            new_progressivo_invio = f"INV{int(time.time())}"
-            etree.SubElement(dati_trasmissione, f"{{{ns_uri}}}ProgressivoInvio").text = new_progressivo_invio
-    
-        etree.SubElement(dati_trasmissione, f"{{{ns_uri}}}FormatoTrasmissione").text = "FPR12"
-        etree.SubElement(dati_trasmissione, f"{{{ns_uri}}}CodiceDestinatario").text = "0000000"
-        
-        # Crea struttura CedentePrestatore con tutti i dati anagrafici
-        cedente = etree.SubElement(header, f"{{{ns_uri}}}CedentePrestatore")
-        dati_anagrafici_cedente = etree.SubElement(cedente, f"{{{ns_uri}}}DatiAnagrafici")
-        
-        # Dati fiscali cedente
-        id_fiscale_iva_cedente = etree.SubElement(dati_anagrafici_cedente, f"{{{ns_uri}}}IdFiscaleIVA")
-        etree.SubElement(id_fiscale_iva_cedente, f"{{{ns_uri}}}IdPaese").text = master_data[IDX_CEDENTE_ID_PAESE] or "IT"
-        etree.SubElement(id_fiscale_iva_cedente, f"{{{ns_uri}}}IdCodice").text = master_data[IDX_CEDENTE_PARTITA_IVA] or "00000000000"
+        # Il piano di generazione è compilato una sola volta
+        if self._xml_plan is None:
+            self._xml_plan = XmlPlan(default_columns())
         
-        # Codice fiscale cedente (opzionale)
-        if master_data[IDX_CEDENTE_CF]:
-            etree.SubElement(dati_anagrafici_cedente, f"{{{ns_uri}}}CodiceFiscale").text = master_data[IDX_CEDENTE_CF]
+        # Il progressivo di invio è assegnato al salvataggio (vedi _ensure_progressivo),
+        # mai durante la generazione: ogni esportazione della stessa fattura lo ripete uguale
+        master = invoice_data["master"]
+        position = MASTER_HEADERS.index("ProgressivoInvio")
+        if len(master) <= position or not master[position]:
+            self.log(f"Fattura {master[0]} senza progressivo di invio: aggiorna il database "
+                     f"per assegnarlo", WARNING)
         
-        # Anagrafica cedente
-        anagrafica_cedente = etree.SubElement(dati_anagrafici_cedente, f"{{{ns_uri}}}Anagrafica")
-        
-        # Gestisci denominazione o nome/cognome
-        if master_data[IDX_CEDENTE_DENOMINAZIONE]:
-            etree.SubElement(anagrafica_cedente, f"{{{ns_uri}}}Denominazione").text = master_data[IDX_CEDENTE_DENOMINAZIONE]
-        else:
-            if master_data[IDX_CEDENTE_NOME]:
-                etree.SubElement(anagrafica_cedente, f"{{{ns_uri}}}Nome").text = master_data[IDX_CEDENTE_NOME]
-            if master_data[IDX_CEDENTE_COGNOME]:
-                etree.SubElement(anagrafica_cedente, f"{{{ns_uri}}}Cognome").text = master_data[IDX_CEDENTE_COGNOME]
-        
-        # Regime fiscale
-        etree.SubElement(dati_anagrafici_cedente, f"{{{ns_uri}}}RegimeFiscale").text = master_data[IDX_CEDENTE_REGIME] or "RF01"
-        
-        # Sede cedente
-        sede_cedente = etree.SubElement(cedente, f"{{{ns_uri}}}Sede")
-        etree.SubElement(sede_cedente, f"{{{ns_uri}}}Indirizzo").text = master_data[IDX_CEDENTE_INDIRIZZO] or "Indirizzo"
-        etree.SubElement(sede_cedente, f"{{{ns_uri}}}CAP").text = master_data[IDX_CEDENTE_CAP] or "00000"
-        etree.SubElement(sede_cedente, f"{{{ns_uri}}}Comune").text = master_data[IDX_CEDENTE_COMUNE] or "Comune"
-        if master_data[IDX_CEDENTE_PROVINCIA]:
-            etree.SubElement(sede_cedente, f"{{{ns_uri}}}Provincia").text = master_data[IDX_CEDENTE_PROVINCIA]
-        etree.SubElement(sede_cedente, f"{{{ns_uri}}}Nazione").text = master_data[IDX_CEDENTE_NAZIONE] or "IT"
-        
-        # Crea struttura CessionarioCommittente con tutti i dati anagrafici
-        cessionario = etree.SubElement(header, f"{{{ns_uri}}}CessionarioCommittente")
-        dati_anagrafici_cessionario = etree.SubElement(cessionario, f"{{{ns_uri}}}DatiAnagrafici")
-        
-        # Dati fiscali cessionario
-        if master_data[IDX_CESS_PARTITA_IVA]:
-            id_fiscale_iva_cessionario = etree.SubElement(dati_anagrafici_cessionario, f"{{{ns_uri}}}IdFiscaleIVA")
-            etree.SubElement(id_fiscale_iva_cessionario, f"{{{ns_uri}}}IdPaese").text = master_data[IDX_CESS_ID_PAESE] or "IT"
-            etree.SubElement(id_fiscale_iva_cessionario, f"{{{ns_uri}}}IdCodice").text = master_data[IDX_CESS_PARTITA_IVA]
-        
-        # Codice fiscale cessionario (opzionale)
-        if master_data[IDX_CESS_CF]:
-            etree.SubElement(dati_anagrafici_cessionario, f"{{{ns_uri}}}CodiceFiscale").text = master_data[IDX_CESS_CF]
-        
-        # Anagrafica cessionario
-        anagrafica_cessionario = etree.SubElement(dati_anagrafici_cessionario, f"{{{ns_uri}}}Anagrafica")
-        
-        # Gestisci denominazione o nome/cognome
-        if master_data[IDX_CESS_DENOMINAZIONE]:
-            etree.SubElement(anagrafica_cessionario, f"{{{ns_uri}}}Denominazione").text = master_data[IDX_CESS_DENOMINAZIONE]
-        else:
-            if master_data[IDX_CESS_NOME]:
-                etree.SubElement(anagrafica_cessionario, f"{{{ns_uri}}}Nome").text = master_data[IDX_CESS_NOME]
-            if master_data[IDX_CESS_COGNOME]:
-                etree.SubElement(anagrafica_cessionario, f"{{{ns_uri}}}Cognome").text = master_data[IDX_CESS_COGNOME]
-        
-        # Sede cessionario
-        sede_cessionario = etree.SubElement(cessionario, f"{{{ns_uri}}}Sede")
-        etree.SubElement(sede_cessionario, f"{{{ns_uri}}}Indirizzo").text = master_data[IDX_CESS_INDIRIZZO] or "Indirizzo"
-        etree.SubElement(sede_cessionario, f"{{{ns_uri}}}CAP").text = master_data[IDX_CESS_CAP] or "00000"
-        etree.SubElement(sede_cessionario, f"{{{ns_uri}}}Comune").text = master_data[IDX_CESS_COMUNE] or "Comune"
-        if master_data[IDX_CESS_PROVINCIA]:
-            etree.SubElement(sede_cessionario, f"{{{ns_uri}}}Provincia").text = master_data[IDX_CESS_PROVINCIA]
-        etree.SubElement(sede_cessionario, f"{{{ns_uri}}}Nazione").text = master_data[IDX_CESS_NAZIONE] or "IT"
-        
-        # Crea struttura DatiGenerali
-        dati_generali = etree.SubElement(body, f"{{{ns_uri}}}DatiGenerali")
-        dati_generali_documento = etree.SubElement(dati_generali, f"{{{ns_uri}}}DatiGeneraliDocumento")
-        etree.SubElement(dati_generali_documento, f"{{{ns_uri}}}TipoDocumento").text = master_data[IDX_TIPO_DOC] or "TD01"
-        etree.SubElement(dati_generali_documento, f"{{{ns_uri}}}Divisa").text = "EUR"
-        
-        # Data fattura
-        data_fattura = master_data[IDX_DATA]
-        if isinstance(data_fattura, datetime.datetime):
-            data_fattura = data_fattura.strftime("%Y-%m-%d")
-        etree.SubElement(dati_generali_documento, f"{{{ns_uri}}}Data").text = data_fattura or datetime.date.today().strftime("%Y-%m-%d")
-        
-        etree.SubElement(dati_generali_documento, f"{{{ns_uri}}}Numero").text = master_data[IDX_NUMERO] or "00001"
-        etree.SubElement(dati_generali_documento, f"{{{ns_uri}}}ImportoTotaleDocumento").text = str(master_data[IDX_IMPORTO] or "0.00")
-        
-        # Crea struttura DatiBeniServizi
-        dati_beni = etree.SubElement(body, f"{{{ns_uri}}}DatiBeniServizi")
-        
-        # Aggiungi DettaglioLinee
-        for line_data in details_data:
-            dettaglio = etree.SubElement(dati_beni, f"{{{ns_uri}}}DettaglioLinee")
-            etree.SubElement(dettaglio, f"{{{ns_uri}}}NumeroLinea").text = str(line_data[1] or "1")
-            etree.SubElement(dettaglio, f"{{{ns_uri}}}Descrizione").text = str(line_data[2] or "Descrizione")
-            
-            # Gestisci i campi opzionali
-            if line_data[3]:  # Quantità
-                etree.SubElement(dettaglio, f"{{{ns_uri}}}Quantita").text = str(line_data[3])
-            
-            if line_data[4]:  # Unità misura
-                etree.SubElement(dettaglio, f"{{{ns_uri}}}UnitaMisura").text = str(line_data[4])
-            
-            etree.SubElement(dettaglio, f"{{{ns_uri}}}PrezzoUnitario").text = str(line_data[5] or "0.00")
-            etree.SubElement(dettaglio, f"{{{ns_uri}}}PrezzoTotale").text = str(line_data[6] or "0.00")
-            etree.SubElement(dettaglio, f"{{{ns_uri}}}AliquotaIVA").text = str(line_data[7] or "22.00")
-        
-        # Aggiungi DatiRiepilogo
-        for summary_item in summary_data:
-            riepilogo = etree.SubElement(dati_beni, f"{{{ns_uri}}}DatiRiepilogo")
-            etree.SubElement(riepilogo, f"{{{ns_uri}}}AliquotaIVA").text = str(summary_item[1] or "22.00")
-            etree.SubElement(riepilogo, f"{{{ns_uri}}}ImponibileImporto").text = str(summary_item[2] or "0.00")
-            etree.SubElement(riepilogo, f"{{{ns_uri}}}Imposta").text = str(summary_item[3] or "0.00")
-            
-            # Aggiungi campi opzionali
-            if summary_item[4]:  # EsigibilitaIVA
-                etree.SubElement(riepilogo, f"{{{ns_uri}}}EsigibilitaIVA").text = str(summary_item[4])
-            
-            if summary_item[5]:  # Natura
-                etree.SubElement(riepilogo, f"{{{ns_uri}}}Natura").text = str(summary_item[5])
-        
-        # Crea struttura DatiPagamento
-        dati_pagamento = etree.SubElement(body, f"{{{ns_uri}}}DatiPagamento")
-        etree.SubElement(dati_pagamento, f"{{{ns_uri}}}CondizioniPagamento").text = "TP02"  # Default
-        
-        dettaglio_pagamento = etree.SubElement(dati_pagamento, f"{{{ns_uri}}}DettaglioPagamento")
-        etree.SubElement(dettaglio_pagamento, f"{{{ns_uri}}}ModalitaPagamento").text = "MP05"  # Default
-        
-        # Data scadenza (30 giorni dalla data fattura)
-        data_fattura_obj = None
-        try:
-            if isinstance(data_fattura, str):
-                data_fattura_obj = datetime.datetime.strptime(data_fattura, "%Y-%m-%d").date()
-            elif isinstance(data_fattura, datetime.datetime):
-                data_fattura_obj = data_fattura.date()
-        except:
-            data_fattura_obj = datetime.date.today()
-        
-        if not data_fattura_obj:
-            data_fattura_obj = datetime.date.today()
-            
-        data_scadenza = data_fattura_obj + datetime.timedelta(days=30)
-        etree.SubElement(dettaglio_pagamento, f"{{{ns_uri}}}DataScadenzaPagamento").text = data_scadenza.strftime("%Y-%m-%d")
-        
-        etree.SubElement(dettaglio_pagamento, f"{{{ns_uri}}}ImportoPagamento").text = str(master_data[IDX_IMPORTO] or "0.00")
-
-        etree.SubElement(dettaglio_pagamento, f"{{{ns_uri}}}CodicePagamento").text = "RB01"  # Valore di default
+        root = self._xml_plan.build(master, invoice_data["details"], invoice_data["summary"])
         
         # Applica indentazione per migliorare la leggibilità
-        self._indent_xml(root)
+        etree.indent(root, space="  ")
         
         # Crea l'albero XML
         tree = etree.ElementTree(root)
@@ -1075,26 +1505,6 @@ class ExcelXmlManager:
         return tree
 
 
-    def _indent_xml(self, elem, level=0):
-        """
-        Applica indentazione per formattare l'XML in modo leggibile
-        
-        Args:
-            elem: Elemento XML
-            level: Livello di indentazione
-        """
-        i = "\n" + "  " * level
-        if len(elem):
-            if not elem.text or not elem.text.strip():
-                elem.text = i + "  "
-            for child in elem:
-                self._indent_xml(child, level + 1)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-        else:
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-
     def import_excel_to_xml(self, template_xml_path=None, output_xml_path=None):
         """
         Crea un nuovo XML a partire dai dati in Excel (mostra selettore fattura)
@@ -1116,7 +1526,7 @@ class ExcelXmlManager:
                 return False, ""
             
             # Carica il workbook
-            wb = openpyxl.load_workbook(self.excel_path)
+            wb = self._load_workbook()
             
             # Verifica che i fogli necessari esistano
             required_sheets = [self.master_sheet_name, self.details_sheet_name, 
@@ -1155,25 +1565,7 @@ class ExcelXmlManager:
             xml_doc = self._generate_xml_from_invoice_data(invoice_data)
             
             # Salva il file XML
-            xml_string = etree.tostring(xml_doc, pretty_print=True, encoding="UTF-8", 
-                                        xml_declaration=True).decode("utf-8")
-            
-            # Migliora formattazione per nodi ripetuti
-            xml_string = re.sub(r'(</DettaglioLinee>)(\r?\n)+(<(?:\w+:)?DatiRiepilogo>)', 
-                            r'\1\n      \3', xml_string)
-            xml_string = re.sub(r'(</DettaglioLinee>)(<(?:\w+:)?DatiRiepilogo>)', 
-                            r'\1\n      \2', xml_string)
-            
-            # Aggiungi il prefisso "p:" SOLO all'elemento radice FatturaElettronica
-            xml_string = xml_string.replace("<FatturaElettronica ", "<p:FatturaElettronica ")
-            xml_string = xml_string.replace("</FatturaElettronica>", "</p:FatturaElettronica>")
-            
-            # Aggiungi il namespace "xmlns:p" all'elemento radice
-            xml_string = xml_string.replace("<p:FatturaElettronica ", 
-                                        "<p:FatturaElettronica xmlns:p=\"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2\" ")
-            
-            # Rimuovi il namespace senza prefisso, per evitare di avere entrambi
-            xml_string = xml_string.replace(" xmlns=\"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2\"", "")
+            xml_string = self._serialize_invoice_xml(xml_doc)
             
             with open(output_xml_path, 'w', encoding='utf-8') as f:
                 f.write(xml_string)
@@ -1189,69 +1581,110 @@ class ExcelXmlManager:
 
 
 
-    def list_invoices(self):
+    def iter_invoices(self):
         """
-        Restituisce un elenco delle fatture presenti nel file Excel
+        Scorre le fatture presenti nel file Excel senza caricarle tutte in memoria.
+        Il foglio viene letto in streaming, solo valori e solo fino all'ultima colonna necessaria.
         
-        Returns:
-            list: Lista di tuple (id, numero, data, cedente, cessionario)
+        Yields:
+            tuple: (id, numero, data, cedente, cessionario)
         """
+        # Verifica che il file Excel esista
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            self.log(f"File Excel non trovato: {self.excel_path}")
+            return
+        
+        # Carica il workbook in modalità sola lettura
+        wb = self._load_workbook(read_only=True)
         try:
-            # Verifica che il file Excel esista
-            if not os.path.exists(self.excel_path):
-                self.log(f"File Excel non trovato: {self.excel_path}")
-                return []
-            
-            # Carica il workbook in modalità sola lettura
-            wb = openpyxl.load_workbook(self.excel_path, read_only=True)
-            
             # Verifica che il foglio master esista
             if self.master_sheet_name not in wb.sheetnames:
                 self.log(f"Foglio '{self.master_sheet_name}' non trovato nel file Excel")
-                return []
+                return
             
-            # Estrai l'elenco delle fatture
-            invoices = []
             master_sheet = wb[self.master_sheet_name]
             
-            # Ottieni gli indici delle colonne (per supportare anche fogli con colonne diverse)
-            headers = next(master_sheet.rows)
-            col_indices = {cell.value: i for i, cell in enumerate(headers)}
+            # Risolve le colonne per nome (supporta anche fogli con colonne spostate)
+            layout = SheetLayout.of(master_sheet, MASTER_HEADERS)
             
             # Verifica che ci siano le colonne necessarie
-            required_cols = ["ID_Fattura", "NumeroFattura", "DataFattura", 
+            required_cols = [ID_COLUMN, "NumeroFattura", "DataFattura", 
                             "CedenteDenominazione", "CessionarioDenominazione"]
             
             for col in required_cols:
-                if col not in col_indices:
+                if col not in layout.index:
                     self.log(f"Colonna '{col}' non trovata nel foglio principale")
-                    return []
+                    return
+            
+            id_col, numero_col, data_col, cedente_col, cessionario_col = (layout.index[c] for c in required_cols)
+            max_col = layout.max_column(required_cols)
             
-            # Estrai i dati
-            for row in list(master_sheet.rows)[1:]:  # Salta intestazione
-                invoice_id = row[col_indices["ID_Fattura"]].value
+            # Estrai i dati (salta intestazione)
+            for row in master_sheet.iter_rows(min_row=2, max_col=max_col, values_only=True):
+                if len(row) < max_col:
+                    row = row + (None,) * (max_col - len(row))
+                
+                invoice_id = row[id_col]
                 if not invoice_id:
                     continue
-                    
-                numero = row[col_indices["NumeroFattura"]].value or ""
-                data = row[col_indices["DataFattura"]].value or ""
                 
+                data = row[data_col] or ""
                 # Formatta la data se necessario
                 if isinstance(data, datetime.datetime):
                     data = data.strftime("%Y-%m-%d")
-                    
-                cedente = row[col_indices["CedenteDenominazione"]].value or ""
-                cessionario = row[col_indices["CessionarioDenominazione"]].value or ""
                 
-                invoices.append((invoice_id, numero, data, cedente, cessionario))
-            
-            return invoices
+                yield (invoice_id, row[numero_col] or "", data,
+                       row[cedente_col] or "", row[cessionario_col] or "")
+        finally:
+            wb.close()
+
+    def list_invoices(self):
+        """
+        Restituisce un elenco delle fatture presenti nel file Excel
+        
+        Returns:
+            list: Lista di tuple (id, numero, data, cedente, cessionario)
+        """
+        try:
+            return list(self.iter_invoices())
         
         except Exception as e:
             self.log(f"Errore nell'elenco delle fatture: {str(e)}")
             traceback.print_exc()
             return []
 
+    def _delete_invoice_rows(self, wb, invoice_id):
+        """
+        Elimina da tutti i fogli le righe di una fattura e la rimuove dall'indice
+        
+        Args:
+            wb: Workbook Excel
+            invoice_id: ID della fattura
+        
+        Returns:
+            int: Numero di righe eliminate
+        """
+        rows_deleted = 0
+        layouts = self._sheet_layouts(wb)
+        
+        for sheet_name, description in ((self.master_sheet_name, "principale"),
+                                        (self.details_sheet_name, "dettagli"),
+                                        (self.summary_sheet_name, "riepilogo")):
+            sheet = wb[sheet_name]
+            rows_to_delete = self._find_invoice_rows(
+                sheet, invoice_id, layouts[sheet_name].column(ID_COLUMN))[::-1]  # Inizia dal fondo
+            
+            for row_idx in rows_to_delete:
+                sheet.delete_rows(row_idx)
+                rows_deleted += 1
+            
+            self.log(f"Rimosse {len(rows_to_delete)} righe dal foglio {description}")
+        
+        if self.index_sheet_name in wb.sheetnames:
+            InvoiceIndex(wb[self.index_sheet_name]).remove(invoice_id)
+        
+        return rows_deleted
+
     def delete_invoice(self, invoice_id):
         """
         Elimina una fattura dal file Excel
@@ -1269,7 +1702,7 @@ class ExcelXmlManager:
                 return False
             
             # Carica il workbook
-            wb = openpyxl.load_workbook(self.excel_path)
+            wb = self._load_workbook()
             
             # Verifica che i fogli necessari esistano
             required_sheets = [self.master_sheet_name, self.details_sheet_name, self.summary_sheet_name]
@@ -1279,53 +1712,12 @@ class ExcelXmlManager:
                 self.log(f"Fogli mancanti: {', '.join(missing_sheets)}")
                 return False
             
-            # Elimina le righe corrispondenti nei vari fogli
-            rows_deleted = 0
-            
-            # Elimina dal foglio principale
-            rows_to_delete = []
-            master_sheet = wb[self.master_sheet_name]
-            
-            for row_idx in range(master_sheet.max_row, 1, -1):  # Inizia dal fondo
-                if master_sheet.cell(row=row_idx, column=1).value == invoice_id:
-                    rows_to_delete.append(row_idx)
-            
-            for row_idx in rows_to_delete:
-                master_sheet.delete_rows(row_idx)
-                rows_deleted += 1
-            
-            self.log(f"Rimosse {len(rows_to_delete)} righe dal foglio principale")
-            
-            # Elimina dal foglio dettagli
-            rows_to_delete = []
-            details_sheet = wb[self.details_sheet_name]
-            
-            for row_idx in range(details_sheet.max_row, 1, -1):  # Inizia dal fondo
-                if details_sheet.cell(row=row_idx, column=1).value == invoice_id:
-                    rows_to_delete.append(row_idx)
-            
-            for row_idx in rows_to_delete:
-                details_sheet.delete_rows(row_idx)
-                rows_deleted += 1
-            
-            self.log(f"Rimosse {len(rows_to_delete)} righe dal foglio dettagli")
-            
-            # Elimina dal foglio riepilogo
-            rows_to_delete = []
-            summary_sheet = wb[self.summary_sheet_name]
-            
-            for row_idx in range(summary_sheet.max_row, 1, -1):  # Inizia dal fondo
-                if summary_sheet.cell(row=row_idx, column=1).value == invoice_id:
-                    rows_to_delete.append(row_idx)
-            
-            for row_idx in rows_to_delete:
-                summary_sheet.delete_rows(row_idx)
-                rows_deleted += 1
-            
-            self.log(f"Rimosse {len(rows_to_delete)} righe dal foglio riepilogo")
+            # Elimina le righe corrispondenti nei vari fogli e la voce dell'indice
+            rows_deleted = self._delete_invoice_rows(wb, invoice_id)
             
             # Salva il file Excel
-            wb.save(self.excel_path)
+            self._save_workbook(wb, {"rimuovi": [invoice_id]})
+            self._sync_search_index(removed=[invoice_id])
             
             self.log(f"Fattura con ID {invoice_id} eliminata. Totale righe rimosse: {rows_deleted}")
             return rows_deleted > 0
@@ -1337,6 +1729,39 @@ class ExcelXmlManager:
         
 
 
+    def _serialize_invoice_xml(self, xml_doc):
+        """
+        Serializza un documento generato dai dati Excel nel formato dei file fattura:
+        prefisso "p:" solo sull'elemento radice e riferimento al foglio di stile
+        
+        Args:
+            xml_doc: Documento XML generato da _generate_xml_from_invoice_data
+        
+        Returns:
+            str: Testo XML della fattura
+        """
+        with span("xml.serializza"):
+            xml_string = etree.tostring(xml_doc, pretty_print=True, encoding="UTF-8", 
+                                        xml_declaration=True).decode("utf-8")
+        
+        # Migliora formattazione per nodi ripetuti
+        xml_string = re.sub(r'(</DettaglioLinee>)(\r?\n)+(<(?:\w+:)?DatiRiepilogo>)', 
+                        r'\1\n      \3', xml_string)
+        xml_string = re.sub(r'(</DettaglioLinee>)(<(?:\w+:)?DatiRiepilogo>)', 
+                        r'\1\n      \2', xml_string)
+        
+        # Aggiungi il prefisso "p:" SOLO all'elemento radice FatturaElettronica
+        xml_string = xml_string.replace("<FatturaElettronica ", "<p:FatturaElettronica ")
+        xml_string = xml_string.replace("</FatturaElettronica>", "</p:FatturaElettronica>")
+        
+        # Aggiungi il namespace "xmlns:p" all'elemento radice
+        xml_string = xml_string.replace("<p:FatturaElettronica ", 
+                                    "<p:FatturaElettronica xmlns:p=\"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2\" ")
+        
+        # Rimuovi il namespace senza prefisso, per evitare di avere entrambi
+        xml_string = xml_string.replace(" xmlns=\"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2\"", "")
+        return xml_string
+
     def create_xml_from_excel_by_id(self, invoice_id=None, output_xml_path=None):
         """
         Crea un nuovo XML a partire dai dati in Excel per un ID fattura specifico
@@ -1359,7 +1784,7 @@ class ExcelXmlManager:
                 return False, ""
             
             # Carica il workbook
-            wb = openpyxl.load_workbook(self.excel_path)
+            wb = self._load_workbook()
             
             # Verifica che i fogli necessari esistano
             required_sheets = [self.master_sheet_name, self.details_sheet_name, 
@@ -1399,25 +1824,7 @@ class ExcelXmlManager:
             xml_doc = self._generate_xml_from_invoice_data(invoice_data)
             
             # Salva il file XML
-            xml_string = etree.tostring(xml_doc, pretty_print=True, encoding="UTF-8", 
-                                        xml_declaration=True).decode("utf-8")
-            
-            # Migliora formattazione per nodi ripetuti
-            xml_string = re.sub(r'(</DettaglioLinee>)(\r?\n)+(<(?:\w+:)?DatiRiepilogo>)', 
-                            r'\1\n      \3', xml_string)
-            xml_string = re.sub(r'(</DettaglioLinee>)(<(?:\w+:)?DatiRiepilogo>)', 
-                            r'\1\n      \2', xml_string)
-            
-            # Aggiungi il prefisso "p:" SOLO all'elemento radice FatturaElettronica
-            xml_string = xml_string.replace("<FatturaElettronica ", "<p:FatturaElettronica ")
-            xml_string = xml_string.replace("</FatturaElettronica>", "</p:FatturaElettronica>")
-            
-            # Aggiungi il namespace "xmlns:p" all'elemento radice
-            xml_string = xml_string.replace("<p:FatturaElettronica ", 
-                                        "<p:FatturaElettronica xmlns:p=\"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2\" ")
-            
-            # Rimuovi il namespace senza prefisso, per evitare di avere entrambi
-            xml_string = xml_string.replace(" xmlns=\"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2\"", "")
+            xml_string = self._serialize_invoice_xml(xml_doc)
             
             # Aggiungi il riferimento allo stylesheet XSL
             stylesheet_ref = '<?xml-stylesheet type="text/xsl" href="./fatturapa_v1.2_asw.xsl"?>\n'
@@ -1436,4 +1843,873 @@ class ExcelXmlManager:
         except Exception as e:
             self.log(f"Errore nella creazione del file XML: {str(e)}")
             traceback.print_exc()
-            return False, ""
\ No newline at end of file
+            return False, ""
+
+    def _open_search_index(self):
+        """
+        Apre l'indice di ricerca associato al database Excel corrente
+        
+        Returns:
+            InvoiceSearchIndex: Indice di ricerca, None se non disponibile
+        """
+        path = search_index_path(self.excel_path)
+        if self._search_index is not None:
+            if self._search_index.db_path == path:
+                return self._search_index
+            self._search_index.close()
+            self._search_index = None
+        
+        try:
+            self._search_index = InvoiceSearchIndex(path)
+        except sqlite3.Error as e:
+            self.log(f"Indice di ricerca non disponibile: {str(e)}", WARNING)
+            return None
+        
+        return self._search_index
+
+    def _search_document(self, invoice_data, detail_lines):
+        """
+        Prepara i dati di una fattura per l'indice di ricerca
+        
+        Args:
+            invoice_data: Riga del foglio principale
+            detail_lines: Righe di dettaglio della fattura
+        
+        Returns:
+            tuple: (dati per l'elenco, testi ricercabili)
+        """
+        def value(row, idx):
+            item = row[idx] if idx < len(row) else None
+            if isinstance(item, datetime.datetime):
+                return item.strftime("%Y-%m-%d")
+            return str(item) if item is not None else ""
+        
+        def party_name(start):
+            # Denominazione, oppure nome e cognome
+            return value(invoice_data, start) or " ".join(
+                filter(None, (value(invoice_data, start + 1), value(invoice_data, start + 2))))
+        
+        try:
+            amount = float(value(invoice_data, 4).replace(",", "."))
+        except ValueError:
+            amount = None
+        
+        # Posizioni nella riga del foglio principale (vedi _extract_invoice_data)
+        record = {
+            "numero": value(invoice_data, 1),
+            "data": value(invoice_data, 2)[:10],
+            "tipo_documento": value(invoice_data, 3),
+            "importo": amount,
+            "cedente": party_name(8),
+            "cedente_piva": value(invoice_data, 6),
+            "cedente_cf": value(invoice_data, 7),
+            "cessionario": party_name(20),
+            "cessionario_piva": value(invoice_data, 18),
+            "impronta": document_fingerprint(invoice_data, detail_lines),
+        }
+        
+        subjects = [record["numero"], record["cedente"], record["cessionario"],
+                    value(invoice_data, 6), value(invoice_data, 7),
+                    value(invoice_data, 18), value(invoice_data, 19)]
+        notes = [value(invoice_data, 28)] + [value(line, 8) for line in detail_lines]
+        
+        texts = {
+            "soggetti": " ".join(filter(None, subjects)),
+            "descrizioni": "\n".join(filter(None, (value(line, 2) for line in detail_lines))),
+            "note": "\n".join(filter(None, notes)),
+        }
+        return record, texts
+
+    def _sync_search_index(self, updated=(), removed=()):
+        """
+        Aggiorna l'indice di ricerca dopo un salvataggio del workbook.
+        Se prima del salvataggio l'indice non corrispondeva già al file Excel,
+        viene lasciato da ricostruire alla ricerca successiva.
+        
+        Args:
+            updated: Tuple (riga del foglio principale, righe di dettaglio) delle fatture salvate
+            removed: ID delle fatture eliminate
+        """
+        try:
+            index = self._open_search_index()
+            if index is None or index.stored_state() != self._loaded_state:
+                return
+            
+            with span("ricerca.aggiornamento", fatture=len(updated) + len(removed)):
+                index.update(
+                    [(invoice_data[0],) + self._search_document(invoice_data, detail_lines)
+                     for invoice_data, detail_lines in updated],
+                    removed)
+                index.mark_current(file_state(self.excel_path), self._indexed_sheet_fingerprints())
+        except Exception as e:
+            self.log(f"Errore nell'aggiornamento dell'indice di ricerca: {str(e)}", WARNING)
+            traceback.print_exc()
+
+    def _indexed_sheet_fingerprints(self):
+        """Restituisce le impronte dei fogli letti dall'indice di ricerca"""
+        return sheet_fingerprints(self.excel_path, [self.master_sheet_name, self.details_sheet_name])
+
+    def _refresh_search_index(self, index):
+        """
+        Allinea l'indice di ricerca al database Excel modificato altrove.
+        Se i fogli indicizzati non sono cambiati il workbook non viene letto;
+        altrimenti sono reindicizzate solo le fatture aggiunte o modificate.
+        
+        Args:
+            index: Indice di ricerca da aggiornare
+        """
+        state = file_state(self.excel_path)
+        parts = self._indexed_sheet_fingerprints()
+        if parts is not None and parts == index.stored_parts():
+            index.mark_current(state, parts)
+            self.log("Indice di ricerca già allineato ai fogli del database", DEBUG)
+            return
+        
+        self.log("Aggiornamento dell'indice di ricerca")
+        known = index.fingerprints()
+        changed = []
+        rows = {}
+        
+        wb = self._load_workbook(read_only=True)
+        try:
+            # Le righe sono convertite nell'ordine canonico delle colonne
+            layouts = self._sheet_layouts(wb)
+            details = {}
+            if self.details_sheet_name in wb.sheetnames:
+                layout = layouts[self.details_sheet_name]
+                for row in wb[self.details_sheet_name].iter_rows(min_row=2, values_only=True):
+                    row = layout.to_canonical(row)
+                    if row[0]:
+                        details.setdefault(row[0], []).append(row)
+            
+            layout = layouts[self.master_sheet_name]
+            for row_idx, row in enumerate(wb[self.master_sheet_name].iter_rows(min_row=2, values_only=True), 2):
+                row = layout.to_canonical(row)
+                if not row[0]:
+                    continue
+                invoice_id = row[0]
+                rows[invoice_id] = row_idx
+                lines = details.get(invoice_id, [])
+                if known.get(invoice_id) != document_fingerprint(row, lines):
+                    record, texts = self._search_document(row, lines)
+                    record["riga"] = row_idx
+                    changed.append((invoice_id, record, texts))
+        finally:
+            wb.close()
+        
+        removed = [invoice_id for invoice_id in known if invoice_id not in rows]
+        index.update(changed, removed)
+        index.set_rows(rows)
+        index.mark_current(state, parts)
+        self.log(f"Indice di ricerca aggiornato: {len(changed)} fatture reindicizzate, "
+                 f"{len(removed)} rimosse, {len(rows)} in totale")
+
+    def _current_search_index(self):
+        """
+        Restituisce l'indice di ricerca, aggiornandolo se non corrisponde al file Excel
+        
+        Returns:
+            InvoiceSearchIndex: Indice aggiornato, None se non disponibile
+        """
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            return None
+        
+        index = self._open_search_index()
+        if index is not None and not index.is_current(self.excel_path):
+            with span("ricerca.allineamento"):
+                self._refresh_search_index(index)
+        return index
+
+    def search_invoices(self, text, limit=200):
+        """
+        Cerca le fatture per parole contenute in descrizioni, soggetti e note
+        
+        Args:
+            text: Testo della ricerca (ogni parola è cercata come prefisso)
+            limit: Numero massimo di risultati
+        
+        Returns:
+            list: Tuple (id, numero, data, cedente, cessionario, estratto) in ordine di rilevanza
+        """
+        try:
+            index = self._current_search_index()
+            if index is None:
+                return []
+            
+            with span("ricerca.query"):
+                return index.search(text, limit)
+        
+        except Exception as e:
+            self.log(f"Errore nella ricerca delle fatture: {str(e)}")
+            traceback.print_exc()
+            return []
+
+    def query_invoices(self, filters=None, sort_by="data", descending=True, offset=0, limit=100):
+        """
+        Restituisce una pagina dell'elenco delle fatture, filtrato e ordinato.
+        Filtri e ordinamento usano gli indici del database di ricerca, senza leggere il workbook.
+        
+        Args:
+            filters: Dizionario con chiavi opzionali "data_da", "data_a" (AAAA-MM-GG),
+                     "controparte" (nome o partita IVA), "tipo_documento",
+                     "importo_min", "importo_max", "testo" (ricerca full-text)
+            sort_by: "numero", "data", "tipo", "importo", "cedente" o "cessionario";
+                     None ordina per rilevanza quando è presente un testo
+            descending: Ordinamento decrescente
+            offset: Numero di fatture da saltare
+            limit: Numero massimo di fatture della pagina
+        
+        Returns:
+            tuple: (righe, totale). Ogni riga è (id, numero, data, tipo, importo,
+                   cedente, cessionario, estratto)
+        """
+        try:
+            index = self._current_search_index()
+            if index is None:
+                # Senza indice: elenco dal workbook in streaming, senza filtri né ordinamento;
+                # in memoria restano solo le righe della pagina richiesta
+                rows = []
+                total = 0
+                for invoice_id, numero, data, cedente, cessionario in self.iter_invoices():
+                    if offset <= total < offset + limit:
+                        rows.append((invoice_id, numero, data, "", None, cedente, cessionario, ""))
+                    total += 1
+                return rows, total
+            
+            with span("elenco.query", offset=offset, limit=limit):
+                return index.query(filters, sort_by, descending, offset, limit)
+        
+        except Exception as e:
+            self.log(f"Errore nell'elenco delle fatture: {str(e)}")
+            traceback.print_exc()
+            return [], 0
+
+    def vat_register(self, period=registro_iva.PERIOD_MONTH, year=None):
+        """
+        Calcola il registro IVA del database Excel, separando le fatture emesse
+        dall'azienda (vendite) da quelle ricevute dai fornitori (acquisti).
+        Data, tipo e cedente di ogni documento vengono presi dall'indice di ricerca,
+        così del workbook si legge solo il foglio dei riepiloghi.
+        
+        Args:
+            period: registro_iva.PERIOD_MONTH o registro_iva.PERIOD_QUARTER
+            year: Anno da includere (None per tutti)
+        
+        Returns:
+            tuple: (righe del registro, righe di riepilogo scartate)
+        """
+        documents = None
+        try:
+            index = self._current_search_index()
+            if index is not None:
+                documents = index.documents()
+        except Exception as e:
+            self.log(f"Indice di ricerca non utilizzabile per il registro IVA: {str(e)}", WARNING)
+        
+        company = self.own_company_id()
+        if not company:
+            self.log("Partita IVA dell'azienda non disponibile: tutte le fatture sono nel registro vendite",
+                     WARNING)
+        
+        rows, skipped = registro_iva.build_register(self.excel_path, period, year,
+                                                    self.master_sheet_name, self.summary_sheet_name,
+                                                    documents, company)
+        if skipped:
+            self.log(f"Registro IVA: {skipped} righe di riepilogo scartate (fattura mancante, "
+                     f"data o importi non validi)", WARNING)
+        return rows, skipped
+
+    def export_columnar(self, output_dir, file_format=esporta_colonnare.FORMAT_PARQUET,
+                        row_group_size=esporta_colonnare.DEFAULT_ROW_GROUP_SIZE):
+        """
+        Esporta il database in file colonnari tipizzati (Parquet o Arrow IPC)
+        
+        Args:
+            output_dir: Cartella di destinazione
+            file_format: esporta_colonnare.FORMAT_PARQUET o FORMAT_ARROW
+            row_group_size: Righe per row group
+        
+        Returns:
+            dict: Nome del file -> numero di righe, None se l'esportazione non riesce
+        """
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            self.log(f"File Excel non trovato: {self.excel_path}")
+            return None
+        
+        try:
+            written = esporta_colonnare.export_database(
+                self.excel_path, output_dir, file_format, row_group_size,
+                {"fatture": self.master_sheet_name, "linee": self.details_sheet_name,
+                 "riepiloghi": self.summary_sheet_name})
+            for filename, rows in written.items():
+                self.log(f"Esportato {filename}: {rows} righe")
+            return written
+        except ImportError as e:
+            self.log(str(e))
+            return None
+        except Exception as e:
+            self.log(f"Errore nell'esportazione colonnare: {str(e)}")
+            traceback.print_exc()
+            return None
+
+    def import_xml_folder(self, folder, max_workers=None, recursive=False):
+        """
+        Importa nel database Excel tutte le fatture XML di una cartella,
+        comprese quelle firmate (.xml.p7m).
+        Il parsing e l'estrazione avvengono in parallelo in un pool di processi,
+        poi tutte le righe vengono scritte con un unico salvataggio del workbook.
+        
+        Args:
+            folder: Cartella contenente i file XML
+            max_workers: Numero massimo di processi (default: numero di CPU)
+            recursive: Cerca i file anche nelle sottocartelle
+        
+        Returns:
+            dict: Riepilogo con "file", "importate", "aggiornate" (stessa chiave naturale),
+                  "duplicate" (stesso contenuto, ignorate) ed "errori" (lista di tuple (percorso, messaggio))
+        """
+        report = {"file": 0, "importate": 0, "aggiornate": 0, "duplicate": 0, "errori": []}
+        
+        if not self.excel_path:
+            self.log("Errore: Nessun file Excel specificato. Usa prima 'Carica DB Excel' o 'Crea DB Excel'.")
+            return report
+        
+        base = os.path.join(folder, "**") if recursive else folder
+        xml_files = sorted(
+            path
+            for extension in ("*.xml", "*.p7m")
+            for path in glob.glob(os.path.join(base, extension), recursive=recursive)
+        )
+        report["file"] = len(xml_files)
+        
+        if not xml_files:
+            self.log(f"Nessun file XML trovato in: {folder}")
+            return report
+        
+        self.log(f"Importazione di {len(xml_files)} file XML da {folder}")
+        
+        # Estrazione in parallelo: un file non valido non interrompe gli altri
+        with span("ingest.estrazione", file=len(xml_files)):
+            # I processi del pool restituiscono le proprie misure invece di scrivere nel log
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=worker_init) as executor:
+                results = list(map(merge_timings, executor.map(
+                    functools.partial(run_collecting, _extract_invoice_file), xml_files,
+                    [self.NS] * len(xml_files), chunksize=8)))
+        
+        extracted = []
+        for result in results:
+            if "errore" in result:
+                report["errori"].append((result["path"], result["errore"]))
+                self.log(f"Errore nel file {os.path.basename(result['path'])}: {result['errore']}")
+            else:
+                extracted.append(result)
+        
+        if not extracted:
+            return report
+        
+        self._store_extracted(extracted, report)
+        
+        self.log(f"Importazione completata: {report['importate']} fatture importate, "
+                 f"{report['aggiornate']} aggiornate, {report['duplicate']} già presenti, "
+                 f"{len(report['errori'])} errori su {report['file']} file")
+        return report
+
+    def _store_extracted(self, extracted, report):
+        """
+        Scrive nel database Excel le righe estratte da più fatture con un solo
+        caricamento e salvataggio del workbook, controllando i duplicati con l'indice
+        
+        Args:
+            extracted: Risultati di _extract_invoice_rows, nell'ordine di inserimento
+            report: Riepilogo da aggiornare ("importate", "aggiornate", "duplicate", "errori")
+        """
+        try:
+            # Scrittura di tutte le righe con un solo caricamento e salvataggio del workbook
+            with span("ingest.scrittura", fatture=len(extracted)):
+                wb, master_sheet, details_sheet, summary_sheet, structure_sheet = self._open_database_workbook()
+                index = self._open_invoice_index(wb)
+                layouts = self._sheet_layouts(wb)
+                indexed = []
+                written = []
+                
+                for result in extracted:
+                    # L'indice copre anche i duplicati all'interno della stessa cartella
+                    existing_id, match = index.find(result["hash"], result["chiave"])
+                    if match == MATCH_HASH:
+                        report["duplicate"] += 1
+                        continue
+                    
+                    if existing_id:
+                        invoice_id = existing_id
+                        invoice_data = [invoice_id] + result["master"][1:]
+                        detail_lines = [[invoice_id] + line[1:] for line in result["details"]]
+                        summary_data = [[invoice_id] + item[1:] for item in result["summary"]]
+                        self._replace_invoice_rows(wb, invoice_id, invoice_data, detail_lines, summary_data)
+                        report["aggiornate"] += 1
+                    else:
+                        invoice_id = result["master"][0]
+                        invoice_data = result["master"]
+                        detail_lines = result["details"]
+                        summary_data = result["summary"]
+                        master_sheet.append(layouts[self.master_sheet_name].to_sheet(invoice_data))
+                        for line in detail_lines:
+                            details_sheet.append(layouts[self.details_sheet_name].to_sheet(line))
+                        for item in result["summary"]:
+                            summary_sheet.append(layouts[self.summary_sheet_name].to_sheet(item))
+                        report["importate"] += 1
+                    
+                    index.set(invoice_id, result["hash"], result["chiave"])
+                    indexed.append((invoice_data, detail_lines))
+                    written.append(self._journal_entry(invoice_data, detail_lines, summary_data,
+                                                       result["hash"], result["chiave"]))
+                
+                if structure_sheet.max_row <= 1:
+                    for item in extracted[0]["structure"]:
+                        structure_sheet.append(item)
+                
+                for sheet in [master_sheet, details_sheet, summary_sheet, structure_sheet]:
+                    self._optimize_column_width(sheet)
+                
+                self._save_workbook(wb, {"scrivi": written} if written else None)
+            
+            self._sync_search_index(updated=indexed)
+            self._advance_sequences([invoice_data for invoice_data, _ in indexed])
+        except Exception as e:
+            self.log(f"Errore nel salvataggio delle fatture nel database: {str(e)}")
+            traceback.print_exc()
+            # Nessuna fattura è stata salvata
+            report["importate"] = report["aggiornate"] = report["duplicate"] = 0
+            report["errori"].append((self.excel_path, str(e)))
+
+    def _sequence_store(self):
+        """
+        Restituisce le sequenze associate al database Excel corrente
+        (quelle dell'utente se non è stato specificato un database)
+        
+        Returns:
+            SequenceStore: Sequenze persistenti
+        """
+        path = sequence_path(self.excel_path)
+        if self._sequences is None or self._sequences.db_path != path:
+            self._sequences = SequenceStore(path)
+        return self._sequences
+
+    def _progressivo_sequence(self):
+        """
+        Restituisce il nome della sequenza dei progressivi di invio; al primo utilizzo
+        la sequenza parte dopo il progressivo più alto delle fatture emesse già nel
+        database (ad esempio numerate con un altro programma), perché il nome del
+        file SdI non si ripeta
+        
+        Returns:
+            str: Nome della sequenza
+        """
+        store = self._sequence_store()
+        if not store.exists(PROGRESSIVO):
+            store.ensure_after(PROGRESSIVO, self._last_progressivo())
+        return PROGRESSIVO
+
+    def reserve_progressivi(self, count=1):
+        """
+        Riserva progressivi di invio mai assegnati prima
+        
+        Args:
+            count: Numero di progressivi
+        
+        Returns:
+            list: Progressivi di invio (al massimo 10 caratteri)
+        """
+        self._progressivo_sequence()
+        return self._sequence_store().reserve_progressivi(count)
+
+    def _ensure_progressivo(self, root, wb, invoice_id=None):
+        """
+        Completa una fattura senza progressivo di invio prima del salvataggio: riceve
+        quello già registrato per la stessa fattura oppure uno nuovo dalla sequenza.
+        Il valore viene scritto nel documento, quindi è salvato con la fattura.
+        
+        Args:
+            root: Elemento radice XML (viene modificato)
+            wb: Workbook Excel aperto
+            invoice_id: ID della fattura se è già nel database
+        
+        Returns:
+            str: Progressivo di invio, None se il documento non ha dati di trasmissione
+        """
+        elements = root.xpath("//*/DatiTrasmissione/ProgressivoInvio", namespaces=self.NS)
+        if elements and elements[0].text and elements[0].text.strip():
+            return elements[0].text
+        
+        trasmissione = root.xpath("//*/DatiTrasmissione", namespaces=self.NS)
+        if not trasmissione:
+            return None
+        trasmissione = trasmissione[0]
+        
+        progressivo = None
+        if invoice_id and self.master_sheet_name in wb.sheetnames:
+            sheet = wb[self.master_sheet_name]
+            layout = SheetLayout.of(sheet, MASTER_HEADERS)
+            column = layout.column("ProgressivoInvio")
+            rows = self._find_invoice_rows(sheet, invoice_id, layout.column(ID_COLUMN))
+            if rows and column:
+                progressivo = sheet.cell(row=rows[0], column=column).value
+        progressivo = str(progressivo) if progressivo else self.reserve_progressivi(1)[0]
+        
+        if elements:
+            element = elements[0]
+        else:
+            # Nello schema ProgressivoInvio segue IdTrasmittente
+            element = trasmissione.makeelement("ProgressivoInvio", {})
+            first = trasmissione[0] if len(trasmissione) else None
+            position = 1 if first is not None and etree.QName(first).localname == "IdTrasmittente" else 0
+            trasmissione.insert(position, element)
+        element.text = progressivo
+        return progressivo
+
+    def _assign_missing_progressivi(self, wb):
+        """
+        Assegna un progressivo di invio alle fatture salvate senza (versioni precedenti)
+        
+        Args:
+            wb: Workbook Excel aperto in scrittura
+        
+        Returns:
+            dict: ID fattura -> progressivo assegnato
+        """
+        if self.master_sheet_name not in wb.sheetnames:
+            return {}
+        sheet = wb[self.master_sheet_name]
+        layout = SheetLayout.of(sheet, MASTER_HEADERS)
+        if layout.column("ProgressivoInvio") is None:
+            return {}
+        
+        missing = [layout.value(row, ID_COLUMN) for row in sheet.iter_rows(min_row=2, values_only=True)
+                   if layout.value(row, ID_COLUMN) and not layout.value(row, "ProgressivoInvio")]
+        assigned = dict(zip(missing, self.reserve_progressivi(len(missing))))
+        self._set_progressivi(wb, assigned)
+        return assigned
+
+    def _set_progressivi(self, wb, progressivi):
+        """
+        Scrive i progressivi di invio assegnati alle fatture che ne sono ancora prive
+        (un progressivo salvato nel frattempo da un'altra postazione resta invariato)
+        
+        Args:
+            wb: Workbook Excel aperto in scrittura
+            progressivi: Dizionario ID fattura -> progressivo
+        """
+        if not progressivi or self.master_sheet_name not in wb.sheetnames:
+            return
+        sheet = wb[self.master_sheet_name]
+        layout = SheetLayout.of(sheet, MASTER_HEADERS)
+        column = layout.column("ProgressivoInvio")
+        if column is None:
+            return
+        
+        for row_idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), 2):
+            progressivo = progressivi.get(layout.value(row, ID_COLUMN))
+            if progressivo and not layout.value(row, "ProgressivoInvio"):
+                sheet.cell(row=row_idx, column=column, value=progressivo)
+
+    def own_company_id(self):
+        """
+        Restituisce la partita IVA (o il codice fiscale) dell'azienda: company_id se
+        impostato, altrimenti quella del cedente del modello di fattura
+        
+        Returns:
+            str: Identificativo fiscale, None se non disponibile
+        """
+        if self.company_id:
+            return str(self.company_id).strip().upper()
+        
+        if self._template_company_id is None:
+            self._template_company_id = ""
+            if os.path.exists(DEFAULT_TEMPLATE_PATH):
+                try:
+                    self._template_company_id = cedente_id(new_document(DEFAULT_TEMPLATE_PATH).getroot()).strip().upper()
+                except Exception as e:
+                    self.log(f"Partita IVA dell'azienda non leggibile dal modello: {str(e)}", WARNING)
+        return self._template_company_id or None
+
+    def _is_own_invoice(self, partita_iva, codice_fiscale, company=None):
+        """
+        Indica se una fattura è stata emessa dall'azienda (cedente = azienda)
+        
+        Args:
+            partita_iva: Partita IVA del cedente
+            codice_fiscale: Codice fiscale del cedente
+            company: Identificativo dell'azienda (default: own_company_id())
+        
+        Returns:
+            bool: True se il cedente è l'azienda; sempre True se l'azienda non è nota
+        """
+        company = company or self.own_company_id()
+        if not company:
+            return True
+        return company in (str(partita_iva or "").strip().upper(), str(codice_fiscale or "").strip().upper())
+
+    def _own_invoice_values(self, names):
+        """
+        Legge alcune colonne delle fatture emesse dall'azienda. Le fatture dei fornitori
+        importate nel database hanno numerazione e progressivi propri e non vengono considerate.
+        
+        Args:
+            names: Colonne del foglio principale da leggere
+        
+        Returns:
+            list: Tuple dei valori delle colonne, una per fattura emessa
+        """
+        values = []
+        if not self.excel_path or not os.path.exists(self.excel_path):
+            return values
+        
+        company = self.own_company_id()
+        if not company:
+            self.log("Partita IVA dell'azienda non disponibile: la numerazione considera tutte le fatture",
+                     WARNING)
+        
+        wb = self._load_workbook(read_only=True)
+        try:
+            if self.master_sheet_name not in wb.sheetnames:
+                return values
+            master_sheet = wb[self.master_sheet_name]
+            columns = list(names) + ["CedentePartitaIVA", "CedenteCodiceFiscale"]
+            layout = SheetLayout.of(master_sheet, MASTER_HEADERS)
+            for row in master_sheet.iter_rows(min_row=2, max_col=layout.max_column(columns), values_only=True):
+                row = [layout.value(row, name) for name in columns]
+                if self._is_own_invoice(row[-2], row[-1], company):
+                    values.append(tuple(row[:-2]))
+        finally:
+            wb.close()
+        return values
+
+    def _last_invoice_number(self, year):
+        """
+        Restituisce il numero più alto delle fatture emesse dall'azienda in un anno
+        (la parte numerica finale, per numeri come "2024/15")
+        
+        Args:
+            year: Anno delle fatture
+        
+        Returns:
+            int: Ultimo numero usato, 0 se non ce ne sono
+        """
+        last = 0
+        for numero, data in self._own_invoice_values(["NumeroFattura", "DataFattura"]):
+            if isinstance(data, datetime.datetime):
+                data = data.strftime("%Y-%m-%d")
+            number = _number_suffix(numero)
+            if str(data or "")[:4] == str(year) and number is not None:
+                last = max(last, number)
+        return last
+
+    def _last_progressivo(self):
+        """
+        Restituisce il valore (in base 36) del progressivo di invio più alto delle
+        fatture emesse dall'azienda
+        
+        Returns:
+            int: Valore della sequenza, 0 se non ce ne sono
+        """
+        values = [parse_progressivo(progressivo) for progressivo, in
+                  self._own_invoice_values(["ProgressivoInvio"])]
+        return max((value for value in values if value is not None), default=0)
+
+    def _invoice_number_sequence(self, year):
+        """
+        Restituisce il nome della sequenza dei numeri di un anno; al primo utilizzo
+        la sequenza parte dopo l'ultimo numero già presente nel database
+        
+        Args:
+            year: Anno delle fatture
+        
+        Returns:
+            str: Nome della sequenza
+        """
+        name = number_sequence(year)
+        store = self._sequence_store()
+        if not store.exists(name):
+            store.ensure_after(name, self._last_invoice_number(year))
+        return name
+
+    def _advance_sequences(self, invoices):
+        """
+        Fa proseguire numerazione e progressivi di invio dopo quelli delle fatture
+        emesse appena salvate (ad esempio un numero inserito a mano); non li fa mai
+        tornare indietro
+        
+        Args:
+            invoices: Righe del foglio principale (ordine canonico) delle fatture salvate
+        """
+        names = ["NumeroFattura", "DataFattura", "CedentePartitaIVA", "CedenteCodiceFiscale", "ProgressivoInvio"]
+        positions = [MASTER_HEADERS.index(name) for name in names]
+        company = self.own_company_id()
+        try:
+            for invoice_data in invoices:
+                numero, data, partita_iva, codice_fiscale, progressivo = (
+                    invoice_data[i] if i < len(invoice_data) else None for i in positions)
+                if not self._is_own_invoice(partita_iva, codice_fiscale, company):
+                    continue
+                if isinstance(data, datetime.datetime):
+                    data = data.strftime("%Y-%m-%d")
+                year = str(data or "")[:4]
+                number = _number_suffix(numero)
+                if number is not None and year.isdigit():
+                    self._sequence_store().ensure_after(self._invoice_number_sequence(int(year)), number)
+                value = parse_progressivo(progressivo)
+                if value is not None:
+                    self._sequence_store().ensure_after(self._progressivo_sequence(), value)
+        except Exception as e:
+            self.log(f"Errore nell'aggiornamento della numerazione delle fatture: {str(e)}", WARNING)
+            traceback.print_exc()
+
+    def next_invoice_number(self, year):
+        """
+        Restituisce il prossimo numero fattura dell'anno senza riservarlo
+        
+        Args:
+            year: Anno delle fatture
+        
+        Returns:
+            int: Prossimo numero
+        """
+        return self._sequence_store().peek(self._invoice_number_sequence(year))
+
+    def reserve_invoice_numbers(self, year, count=1, first=None):
+        """
+        Riserva numeri fattura consecutivi dell'anno
+        
+        Args:
+            year: Anno delle fatture
+            count: Numero di fatture
+            first: Primo numero da riservare (default: prossimo numero della sequenza)
+        
+        Returns:
+            range: Numeri riservati
+        
+        Raises:
+            ValueError: Se first è già stato assegnato
+        """
+        name = self._invoice_number_sequence(year)
+        if first is None:
+            return self._sequence_store().reserve(name, count)
+        return self._sequence_store().reserve_from(name, first, count)
+
+    def generate_invoice_batch(self, list_path, output_dir, template_path, first_number=None,
+                               invoice_date=None, max_workers=None, xsd_path=None):
+        """
+        Fatturazione periodica: genera dal modello XML una fattura per ogni cliente
+        dell'elenco, con numeri e progressivi di invio consecutivi.
+        I clienti con dati non validi e le fatture che non superano la validazione
+        XSD vengono scartati prima della numerazione; compilazione, scrittura dei file
+        ed estrazione delle righe avvengono in parallelo, poi le fatture sono salvate
+        nel database con un unico salvataggio.
+        
+        Args:
+            list_path: Elenco dei clienti e delle linee (CSV o Excel), vedi batch_fatture
+            output_dir: Cartella in cui scrivere i file XML
+            template_path: Modello XML della fattura
+            first_number: Numero della prima fattura (default: prossimo numero della sequenza
+                          dell'anno); se indicato non può precedere la sequenza, che prosegue
+                          dopo l'ultimo numero usato
+            invoice_date: Data delle fatture (default: oggi)
+            max_workers: Numero massimo di processi (default: numero di CPU)
+            xsd_path: Schema XSD con cui validare ogni fattura (opzionale)
+        
+        Returns:
+            dict: Riepilogo con "clienti", "generate", "file" (percorsi scritti), "importate",
+                  "aggiornate", "duplicate" ed "errori" (lista di tuple (cliente, messaggio))
+        """
+        report = {"clienti": 0, "generate": 0, "file": [], "importate": 0, "aggiornate": 0,
+                  "duplicate": 0, "errori": []}
+        
+        try:
+            with span("batch.lettura"):
+                specs = group_invoices(read_rows(list_path))
+        except Exception as e:
+            self.log(f"Errore nella lettura dell'elenco clienti: {str(e)}")
+            traceback.print_exc()
+            report["errori"].append((list_path, str(e)))
+            return report
+        report["clienti"] = len(specs)
+        
+        # Validazione prima della numerazione, così i numeri restano consecutivi
+        valid = []
+        for spec in specs:
+            errors = validate_spec(spec)
+            if errors:
+                report["errori"].append((f"{spec.cliente} (riga {spec.riga})", "; ".join(errors)))
+                self.log(f"Cliente scartato {spec.cliente}: {'; '.join(errors)}", WARNING)
+            else:
+                valid.append(spec)
+        
+        if not valid:
+            self.log("Nessuna fattura da generare")
+            return report
+        
+        invoice_date = invoice_date or datetime.date.today()
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # I processi del pool restituiscono le proprie misure invece di scrivere nel log
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=worker_init) as executor:
+            # Compilazione e validazione XSD con numeri provvisori: solo le fatture
+            # valide ricevono un numero, così la numerazione resta senza buchi
+            with span("batch.validazione", fatture=len(valid)):
+                checks = list(map(merge_timings, executor.map(
+                    functools.partial(run_collecting, _check_invoice_spec),
+                    [(template_path, spec, invoice_date, xsd_path) for spec in valid], chunksize=16)))
+            accepted = []
+            for spec, check in zip(valid, checks):
+                if "errore" in check:
+                    report["errori"].append((check["cliente"], check["errore"]))
+                    self.log(f"Errore nella fattura di {check['cliente']}: {check['errore']}")
+                else:
+                    accepted.append(spec)
+            
+            if not accepted:
+                self.log("Nessuna fattura da generare")
+                return report
+            
+            # Numeri e progressivi sono riservati in blocco, in modo atomico, prima della generazione
+            try:
+                numbers = self.reserve_invoice_numbers(invoice_date.year, len(accepted), first_number)
+            except ValueError as e:
+                self.log(f"Numerazione non valida: {str(e)}")
+                report["errori"].append((f"numero {first_number}", str(e)))
+                return report
+            progressivi = self.reserve_progressivi(len(accepted))
+            
+            tasks = [(template_path, output_dir, spec, str(number), invoice_date, progressivo, xsd_path)
+                     for spec, number, progressivo in zip(accepted, numbers, progressivi)]
+            
+            self.log(f"Generazione di {len(tasks)} fatture dal modello {os.path.basename(template_path)}")
+            with span("batch.generazione", fatture=len(tasks)):
+                results = list(map(merge_timings, executor.map(
+                    functools.partial(run_collecting, _generate_invoice_file), tasks,
+                    [self.NS] * len(tasks), chunksize=16)))
+        
+        generated = []
+        for task, result in zip(tasks, results):
+            if "errore" in result:
+                # Errore dopo la numerazione (ad esempio in scrittura): il numero resta inutilizzato
+                report["errori"].append((result["cliente"], result["errore"]))
+                self.log(f"Errore nella fattura di {result['cliente']} (numero {task[3]} non utilizzato): "
+                         f"{result['errore']}", WARNING)
+            else:
+                generated.append(result)
+                report["file"].append(result["path"])
+        report["generate"] = len(generated)
+        
+        if not generated:
+            return report
+        
+        if self.excel_path:
+            generated[0]["structure"] = self._extract_xml_structure(new_document(template_path).getroot())
+            self._store_extracted(generated, report)
+        else:
+            self.log("Nessun database Excel specificato: le fatture generate non sono state salvate nel database")
+        
+        self.log(f"Fatturazione periodica completata: {report['generate']} fatture generate su "
+                 f"{report['clienti']} clienti, {report['importate']} salvate nel database, "
+                 f"{len(report['errori'])} errori")
+        return report
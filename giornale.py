@@ -0,0 +1,122 @@
+"""
+Scritture sicure del database Excel: salvataggio atomico e giornale delle operazioni.
+
+Il workbook non viene mai riscritto sul posto: atomic_save() lo salva in un file
+temporaneo nella stessa cartella, lo forza su disco (fsync) e lo sostituisce al
+database con una rinomina atomica. Un'interruzione durante il salvataggio lascia
+quindi intatta la versione precedente.
+
+Prima del salvataggio ogni modifica viene registrata nel giornale (un file JSON
+Lines accanto al database, scritto con fsync): righe delle fatture da scrivere,
+ID delle fatture da eliminare e progressivi di invio assegnati. Se il salvataggio non arriva a termine, le
+operazioni rimaste nel giornale vengono riapplicate alla successiva apertura del
+database in scrittura. Le operazioni sono idempotenti (le righe di una fattura
+sostituiscono quelle con lo stesso ID), quindi riapplicarle è sempre sicuro.
+"""
+import os
+import json
+import tempfile
+
+from instrumentation import span
+
+
+def journal_path(excel_path):
+    """
+    Restituisce il percorso del giornale associato a un file Excel
+
+    Args:
+        excel_path: Percorso del database Excel
+
+    Returns:
+        str: Percorso del giornale
+    """
+    return os.path.splitext(excel_path)[0] + ".giornale.jsonl"
+
+
+def _fsync_directory(directory):
+    """Forza su disco la voce di cartella dopo una rinomina (non disponibile su Windows)"""
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_save(wb, path):
+    """
+    Salva un workbook sostituendo il file in modo atomico
+
+    Args:
+        wb: Workbook openpyxl
+        path: Percorso del file Excel
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".~" + os.path.basename(path) + ".", suffix=".tmp",
+                                     dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with span("excel.save.scrittura"):
+                wb.save(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _fsync_directory(directory)
+
+
+class Journal:
+    """
+    Giornale delle operazioni non ancora salvate nel database Excel
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Percorso del file del giornale
+        """
+        self.path = path
+
+    def append(self, operation):
+        """
+        Registra un'operazione in modo durevole
+
+        Args:
+            operation: Dizionario serializzabile in JSON ("scrivi": righe delle fatture,
+                       "rimuovi": ID delle fatture da eliminare, "progressivi": progressivi
+                       di invio assegnati alle fatture che ne erano prive)
+        """
+        line = json.dumps(operation, ensure_ascii=False, default=str) + "\n"
+        with span("giornale.scrittura"):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def pending(self):
+        """
+        Restituisce le operazioni registrate e non ancora salvate
+
+        Returns:
+            list: Operazioni nell'ordine di registrazione (un'ultima riga incompleta,
+                  scritta durante un'interruzione, viene ignorata)
+        """
+        if not os.path.exists(self.path):
+            return []
+        operations = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    operations.append(json.loads(line))
+                except ValueError:
+                    break
+        return operations
+
+    def clear(self):
+        """Svuota il giornale dopo un salvataggio riuscito"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,200 @@
+"""
+Indice delle fatture salvate nel database Excel.
+
+Ogni fattura è identificata da due chiavi:
+- l'hash del contenuto: SHA-256 della forma canonica (C14N 2.0, senza spazi di
+  formattazione) dell'intera fattura, intestazione compresa: una fattura con lo
+  stesso hash è identica in tutti i campi salvati nel database;
+- la chiave naturale: partita IVA del cedente, numero, data e tipo documento.
+
+L'indice è conservato nel foglio "IndiceFatture" e caricato in dizionari, così
+che il riconoscimento di un duplicato non richieda la scansione dei fogli dati.
+"""
+import hashlib
+
+from lxml import etree
+
+
+INDEX_SHEET_NAME = "IndiceFatture"
+INDEX_HEADERS = ["ID_Fattura", "HashContenuto", "ChiaveNaturale"]
+
+# Esiti della ricerca nell'indice
+MATCH_HASH = "hash"
+MATCH_KEY = "chiave"
+
+
+def content_hash(root):
+    """
+    Calcola l'hash del contenuto della fattura
+
+    Args:
+        root: Elemento radice XML
+
+    Returns:
+        str: Hash SHA-256 esadecimale della fattura (intestazione e blocchi FatturaElettronicaBody)
+    """
+    # strip_text rende l'hash indipendente dall'indentazione del file
+    return hashlib.sha256(etree.tostring(root, method="c14n2", strip_text=True)).hexdigest()
+
+
+def make_natural_key(partita_iva, numero, data, tipo_documento):
+    """
+    Compone la chiave naturale della fattura
+
+    Args:
+        partita_iva: Partita IVA (o codice fiscale) del cedente
+        numero: Numero della fattura
+        data: Data della fattura (AAAA-MM-GG)
+        tipo_documento: Codice del tipo documento (TD01, ...)
+
+    Returns:
+        str: Chiave naturale, vuota se numero o cedente non sono disponibili
+    """
+    values = [str(value).strip() if value is not None else ""
+              for value in (partita_iva, numero, data, tipo_documento)]
+    if not values[0] or not values[1]:
+        return ""
+    # Una data letta da Excel può essere un datetime
+    values[2] = values[2][:10]
+    return "|".join(values)
+
+
+def _first_text(root, xpath):
+    """Testo del primo elemento trovato ("" se assente o vuoto)"""
+    elements = root.xpath(xpath)
+    return elements[0].text if elements and elements[0].text else ""
+
+
+def cedente_id(root):
+    """
+    Restituisce l'identificativo fiscale del cedente
+
+    Args:
+        root: Elemento radice XML
+
+    Returns:
+        str: Partita IVA del cedente, o codice fiscale se manca ("" se nessuno dei due)
+    """
+    return (_first_text(root, "//*/CedentePrestatore/DatiAnagrafici/IdFiscaleIVA/IdCodice")
+            or _first_text(root, "//*/CedentePrestatore/DatiAnagrafici/CodiceFiscale"))
+
+
+def natural_key(root):
+    """
+    Calcola la chiave naturale della fattura dal documento XML
+
+    Args:
+        root: Elemento radice XML
+
+    Returns:
+        str: Chiave naturale (vuota se i dati minimi mancano)
+    """
+    def first_text(xpath):
+        return _first_text(root, xpath)
+
+    return make_natural_key(
+        cedente_id(root),
+        first_text("//*/DatiGenerali/DatiGeneraliDocumento/Numero"),
+        first_text("//*/DatiGenerali/DatiGeneraliDocumento/Data"),
+        first_text("//*/DatiGenerali/DatiGeneraliDocumento/TipoDocumento"),
+    )
+
+
+class InvoiceIndex:
+    """
+    Vista in memoria del foglio indice, con ricerca per hash e per chiave naturale
+    """
+
+    def __init__(self, sheet):
+        """
+        Carica l'indice dal foglio
+
+        Args:
+            sheet: Foglio "IndiceFatture" del workbook
+        """
+        self.sheet = sheet
+        self.by_hash = {}
+        self.by_key = {}
+        self.rows = {}
+
+        for row_idx, row in enumerate(sheet.iter_rows(min_row=2, max_col=3, values_only=True), 2):
+            invoice_id, hash_value, key = row
+            if not invoice_id:
+                continue
+            self.rows[invoice_id] = row_idx
+            if hash_value:
+                self.by_hash[hash_value] = invoice_id
+            if key:
+                self.by_key[key] = invoice_id
+
+    def __len__(self):
+        return len(self.rows)
+
+    def find(self, hash_value, key):
+        """
+        Cerca una fattura già presente
+
+        Args:
+            hash_value: Hash del contenuto
+            key: Chiave naturale
+
+        Returns:
+            tuple: (ID fattura, MATCH_HASH o MATCH_KEY), oppure (None, None)
+        """
+        if hash_value and hash_value in self.by_hash:
+            return self.by_hash[hash_value], MATCH_HASH
+        if key and key in self.by_key:
+            return self.by_key[key], MATCH_KEY
+        return None, None
+
+    def set(self, invoice_id, hash_value, key):
+        """
+        Inserisce o aggiorna la voce di una fattura
+
+        Args:
+            invoice_id: ID della fattura
+            hash_value: Hash del contenuto
+            key: Chiave naturale
+        """
+        row_idx = self.rows.get(invoice_id)
+        if row_idx is None:
+            row_idx = self.sheet.max_row + 1
+            self.rows[invoice_id] = row_idx
+        else:
+            # Rimuove i riferimenti della versione precedente
+            _, old_hash, old_key = (cell.value for cell in self.sheet[row_idx][:3])
+            if self.by_hash.get(old_hash) == invoice_id:
+                del self.by_hash[old_hash]
+            if self.by_key.get(old_key) == invoice_id:
+                del self.by_key[old_key]
+
+        for col, value in enumerate((invoice_id, hash_value, key), 1):
+            self.sheet.cell(row=row_idx, column=col, value=value)
+
+        if hash_value:
+            self.by_hash[hash_value] = invoice_id
+        if key:
+            self.by_key[key] = invoice_id
+
+    def remove(self, invoice_id):
+        """
+        Elimina la voce di una fattura dal foglio indice
+
+        Args:
+            invoice_id: ID della fattura
+
+        Returns:
+            bool: True se la voce era presente
+        """
+        row_idx = self.rows.pop(invoice_id, None)
+        if row_idx is None:
+            return False
+
+        self.sheet.delete_rows(row_idx)
+        self.by_hash = {h: i for h, i in self.by_hash.items() if i != invoice_id}
+        self.by_key = {k: i for k, i in self.by_key.items() if i != invoice_id}
+        # Le righe successive scalano di una posizione
+        for other_id, other_row in self.rows.items():
+            if other_row > row_idx:
+                self.rows[other_id] = other_row - 1
+        return True
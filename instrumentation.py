@@ -0,0 +1,200 @@
+"""
+Strumentazione leggera dei tempi di esecuzione delle operazioni più costose
+(parsing, estrazione XPath, lettura/scrittura workbook, XSLT, serializzazione, totali).
+
+Ogni misura ("span") viene scritta come riga JSON in un file di log a rotazione
+e conservata in memoria negli ultimi N risultati, consultabili dall'applicazione.
+
+La rotazione del file non è sicura tra più processi (su Windows la rinomina fallisce
+finché altri processi tengono aperto il file): i processi dei pool vengono avviati
+con worker_init(), non aprono il file e restituiscono le proprie misure insieme ai
+risultati (run_collecting); il processo principale le registra con merge_timings().
+"""
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+import functools
+import collections
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+
+DEFAULT_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "tempi_operazioni.jsonl")
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+DEFAULT_HISTORY = 200
+
+_logger = logging.getLogger("fatturexml.timing")
+_logger.propagate = False
+_lock = threading.Lock()
+_configured = False
+_recent = collections.deque(maxlen=DEFAULT_HISTORY)
+# Misure da restituire al processo principale (None fuori dai processi del pool)
+_forwarded = None
+
+
+def configure(log_path=DEFAULT_LOG_PATH, max_bytes=DEFAULT_MAX_BYTES,
+              backup_count=DEFAULT_BACKUP_COUNT, history=DEFAULT_HISTORY):
+    """
+    Configura la destinazione delle misure
+
+    Args:
+        log_path: Percorso del file JSON lines (None per disattivare il file)
+        max_bytes: Dimensione massima del file prima della rotazione
+        backup_count: Numero di file ruotati da conservare
+        history: Numero di misure mantenute in memoria per il pannello dell'applicazione
+    """
+    global _configured, _recent
+
+    with _lock:
+        for handler in list(_logger.handlers):
+            _logger.removeHandler(handler)
+            handler.close()
+
+        if log_path:
+            try:
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                handler = RotatingFileHandler(log_path, maxBytes=max_bytes,
+                                              backupCount=backup_count, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                _logger.addHandler(handler)
+            except OSError as e:
+                print(f"[Strumentazione] Impossibile aprire il file di log dei tempi: {str(e)}")
+
+        _logger.setLevel(logging.INFO)
+        _recent = collections.deque(_recent, maxlen=history)
+        _configured = True
+
+
+def _record(entry):
+    """Registra una misura in memoria e nel file di log"""
+    if not _configured:
+        configure()
+
+    with _lock:
+        _recent.append(entry)
+        if _forwarded is not None:
+            _forwarded.append(entry)
+
+    if _logger.handlers:
+        _logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+def worker_init():
+    """
+    Inizializzatore dei processi di un pool (ProcessPoolExecutor(initializer=worker_init)):
+    disattiva il file di log e raccoglie le misure da restituire al processo principale
+    """
+    global _forwarded
+
+    configure(log_path=None)
+    with _lock:
+        _forwarded = []
+
+
+def run_collecting(func, *args):
+    """
+    Esegue una funzione in un processo del pool e restituisce anche le misure raccolte.
+    Da usare con functools.partial, ad esempio executor.map(partial(run_collecting, func), ...)
+
+    Args:
+        func: Funzione da eseguire
+        *args: Argomenti della funzione
+
+    Returns:
+        tuple: (risultato della funzione, misure registrate durante l'esecuzione)
+    """
+    result = func(*args)
+    with _lock:
+        if _forwarded is None:
+            return result, []
+        entries = list(_forwarded)
+        _forwarded.clear()
+    return result, entries
+
+
+def merge_timings(item):
+    """
+    Registra nel processo principale le misure restituite da run_collecting
+
+    Args:
+        item: Tupla (risultato, misure) restituita da run_collecting
+
+    Returns:
+        Risultato della funzione eseguita nel pool
+    """
+    result, entries = item
+    for entry in entries:
+        _record(entry)
+    return result
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Misura il tempo di esecuzione di un blocco di codice
+
+    Args:
+        name: Nome dell'operazione (es. "excel.save")
+        **attributes: Attributi aggiuntivi da registrare con la misura
+
+    Esempio:
+        with span("xml.parse", file=path):
+            doc = etree.parse(path)
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attributes
+    except Exception:
+        status = "errore"
+        raise
+    finally:
+        entry = {
+            "ts": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "operazione": name,
+            "durata_ms": round((time.perf_counter() - start) * 1000, 3),
+            "esito": status,
+        }
+        if attributes:
+            entry.update(attributes)
+        _record(entry)
+
+
+def timed(name=None):
+    """
+    Decoratore che misura ogni chiamata della funzione decorata
+
+    Args:
+        name: Nome dell'operazione (default: nome qualificato della funzione)
+    """
+    def decorator(func):
+        operation = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def recent_timings(limit=None):
+    """
+    Restituisce le misure più recenti, dalla più nuova alla più vecchia
+
+    Args:
+        limit: Numero massimo di misure da restituire (None per tutte)
+
+    Returns:
+        list: Dizionari con operazione, durata_ms, esito e attributi
+    """
+    with _lock:
+        entries = list(_recent)
+    entries.reverse()
+    return entries[:limit] if limit else entries
@@ -0,0 +1,229 @@
+"""
+Lettura delle fatture firmate CAdES (.xml.p7m) senza strumenti esterni.
+
+Il file p7m è una struttura PKCS#7/CMS SignedData codificata in DER (o BER) e,
+spesso, ulteriormente codificata in base64. L'XML della fattura è il contenuto
+incapsulato (eContent): viene restituito come slice della memoria del file,
+senza copie quando l'OCTET STRING è primitivo. La firma non viene verificata.
+"""
+import re
+import base64
+import binascii
+
+from lxml import etree
+
+
+# Tag ASN.1 utilizzati
+_TAG_SEQUENCE = 0x30
+_TAG_OID = 0x06
+_TAG_OCTET_STRING = 0x04
+_TAG_OCTET_STRING_CONSTRUCTED = 0x24
+_TAG_CONTEXT_0 = 0xA0
+
+# OID 1.2.840.113549.1.7.2 (signedData) in codifica DER
+_OID_SIGNED_DATA = bytes.fromhex("2a864886f70d010702")
+
+P7M_EXTENSIONS = (".p7m",)
+
+
+class P7MError(ValueError):
+    """Errore nella lettura di una busta p7m"""
+
+
+def is_p7m(path):
+    """
+    Indica se il percorso corrisponde a un file firmato p7m
+
+    Args:
+        path: Percorso del file
+
+    Returns:
+        bool: True se l'estensione è .p7m
+    """
+    return path.lower().endswith(P7M_EXTENSIONS)
+
+
+def _read_tlv(view, offset):
+    """
+    Legge un elemento TLV ASN.1
+
+    Args:
+        view: memoryview dei dati
+        offset: Posizione dell'elemento
+
+    Returns:
+        tuple: (tag, inizio valore, fine valore, fine elemento). Per le lunghezze
+               indefinite (BER) la fine del valore precede il terminatore 00 00.
+    """
+    if offset + 2 > len(view):
+        raise P7MError("Struttura ASN.1 troncata")
+
+    tag = view[offset]
+    if tag & 0x1F == 0x1F:
+        raise P7MError("Tag ASN.1 multi-byte non supportato")
+
+    length_byte = view[offset + 1]
+    start = offset + 2
+
+    if length_byte == 0x80:
+        # Lunghezza indefinita: i figli proseguono fino al terminatore 00 00
+        if not tag & 0x20:
+            raise P7MError("Lunghezza indefinita su un elemento primitivo")
+        position = start
+        while True:
+            if position + 2 > len(view):
+                raise P7MError("Terminatore di lunghezza indefinita mancante")
+            if view[position] == 0 and view[position + 1] == 0:
+                return tag, start, position, position + 2
+            position = _read_tlv(view, position)[3]
+
+    if length_byte & 0x80:
+        num_bytes = length_byte & 0x7F
+        if num_bytes == 0 or num_bytes > 4 or start + num_bytes > len(view):
+            raise P7MError("Lunghezza ASN.1 non valida")
+        length = int.from_bytes(view[start:start + num_bytes], "big")
+        start += num_bytes
+    else:
+        length = length_byte
+
+    end = start + length
+    if end > len(view):
+        raise P7MError("Struttura ASN.1 troncata")
+
+    return tag, start, end, end
+
+
+def _children(view, start, end):
+    """Restituisce i figli (tag, inizio, fine valore) di un elemento costruito"""
+    children = []
+    position = start
+    while position < end:
+        tag, value_start, value_end, next_position = _read_tlv(view, position)
+        children.append((tag, value_start, value_end))
+        position = next_position
+    return children
+
+
+def _expect(element, tag, description):
+    if element[0] != tag:
+        raise P7MError(f"Struttura p7m non valida: atteso {description}")
+    return element
+
+
+def _decode_envelope(data):
+    """
+    Restituisce i dati DER della busta, decodificando il base64 se necessario
+
+    Args:
+        data: Contenuto del file p7m
+
+    Returns:
+        bytes o memoryview: Dati binari della busta
+    """
+    if data[:1] == bytes([_TAG_SEQUENCE]):
+        return data
+
+    text = bytes(data)
+    # Formato PEM: rimuove intestazioni e piè di pagina
+    text = re.sub(rb"-----(BEGIN|END)[^-]*-----", b"", text)
+    try:
+        return base64.b64decode(b"".join(text.split()), validate=True)
+    except (binascii.Error, ValueError):
+        raise P7MError("Il file non è una busta PKCS#7 in formato DER o base64")
+
+
+def extract_xml_from_p7m(data):
+    """
+    Estrae il contenuto XML incapsulato in una busta PKCS#7 SignedData
+
+    Args:
+        data: Contenuto del file p7m (DER, BER o base64)
+
+    Returns:
+        memoryview o bytes: XML della fattura. È una slice senza copia dei dati
+                            DER quando il contenuto è un OCTET STRING primitivo.
+    """
+    view = memoryview(_decode_envelope(data))
+
+    # ContentInfo ::= SEQUENCE { contentType OID, content [0] EXPLICIT SignedData }
+    _, start, end, _ = _expect(_read_tlv(view, 0), _TAG_SEQUENCE, "ContentInfo")
+    content_info = _children(view, start, end)
+    if len(content_info) < 2:
+        raise P7MError("ContentInfo incompleto")
+    oid = _expect(content_info[0], _TAG_OID, "contentType")
+    if bytes(view[oid[1]:oid[2]]) != _OID_SIGNED_DATA:
+        raise P7MError("La busta non contiene dati firmati (signedData)")
+
+    explicit = _expect(content_info[1], _TAG_CONTEXT_0, "contenuto [0]")
+    signed_data = _expect(_children(view, explicit[1], explicit[2])[0], _TAG_SEQUENCE, "SignedData")
+
+    # SignedData ::= SEQUENCE { version, digestAlgorithms, encapContentInfo, ... }
+    signed_fields = _children(view, signed_data[1], signed_data[2])
+    if len(signed_fields) < 3:
+        raise P7MError("SignedData incompleto")
+    encap = _expect(signed_fields[2], _TAG_SEQUENCE, "EncapsulatedContentInfo")
+
+    # EncapsulatedContentInfo ::= SEQUENCE { eContentType OID, eContent [0] EXPLICIT OCTET STRING }
+    encap_fields = _children(view, encap[1], encap[2])
+    if len(encap_fields) < 2:
+        raise P7MError("La busta non contiene il documento (firma detached)")
+    econtent_wrapper = _expect(encap_fields[1], _TAG_CONTEXT_0, "eContent [0]")
+    econtent = _children(view, econtent_wrapper[1], econtent_wrapper[2])[0]
+
+    if econtent[0] == _TAG_OCTET_STRING:
+        return view[econtent[1]:econtent[2]]
+
+    if econtent[0] == _TAG_OCTET_STRING_CONSTRUCTED:
+        # OCTET STRING suddiviso in blocchi (codifica BER): i blocchi vanno concatenati
+        chunks = []
+
+        def collect(start, end):
+            for tag, chunk_start, chunk_end in _children(view, start, end):
+                if tag == _TAG_OCTET_STRING:
+                    chunks.append(view[chunk_start:chunk_end])
+                elif tag == _TAG_OCTET_STRING_CONSTRUCTED:
+                    collect(chunk_start, chunk_end)
+                else:
+                    raise P7MError("Blocco non valido nel contenuto incapsulato")
+
+        collect(econtent[1], econtent[2])
+        return b"".join(chunks)
+
+    raise P7MError("Contenuto incapsulato non valido")
+
+
+def parse_invoice(path):
+    """
+    Carica una fattura XML, in chiaro o firmata (.xml.p7m)
+
+    Args:
+        path: Percorso del file
+
+    Returns:
+        etree.ElementTree: Documento XML della fattura
+    """
+    if not is_p7m(path):
+        return etree.parse(path)
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    xml_data = extract_xml_from_p7m(data)
+    parser = etree.XMLParser(remove_blank_text=False)
+    return etree.fromstring(xml_data, parser, base_url=path).getroottree()
+
+
+def xml_filename(path):
+    """
+    Restituisce il nome del file XML corrispondente (senza l'estensione .p7m)
+
+    Args:
+        path: Percorso del file
+
+    Returns:
+        str: Nome del file senza estensione p7m
+    """
+    name = path
+    while is_p7m(name):
+        name = name[:-4]
+    return name
@@ -0,0 +1,323 @@
+"""
+Generazione dell'XML FatturaPA dai dati del database Excel tramite un piano compilato.
+
+Il piano è dichiarativo: ogni voce indica il percorso dell'elemento, la colonna da
+cui prende il valore (per nome) e le regole da applicare (valore predefinito,
+elemento facoltativo, codice da normalizzare, condizioni su altre colonne).
+Le linee di dettaglio e i riepiloghi IVA sono gruppi ripetuti per ogni riga.
+
+Il piano viene compilato una volta per disposizione delle colonne: i nomi diventano
+indici, i percorsi una lista di antenati precalcolati e le regole funzioni già
+pronte, così la generazione di una fattura è un unico ciclo sulla lista dei passi.
+Gli elementi contenitore sono creati solo quando ricevono almeno un figlio.
+"""
+import datetime
+import collections
+
+from lxml import etree
+
+from codici_fatturapa import normalize_code, extract_code
+from schema_fatture import MASTER_HEADERS, DETAIL_HEADERS, SUMMARY_HEADERS
+
+
+NS_URI = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
+
+# Sorgenti dei valori: foglio principale, linee di dettaglio, riepiloghi IVA
+MASTER = "master"
+DETAILS = "details"
+SUMMARY = "summary"
+
+# Voce del piano: valore di un elemento
+Field = collections.namedtuple("Field", "path column default optional code when unless compute")
+
+# Voce del piano: gruppo ripetuto per ogni riga della sorgente
+Repeat = collections.namedtuple("Repeat", "path source fields")
+
+
+def field(path, column=None, default=None, optional=False, code=None, when=None, unless=None, compute=None):
+    """
+    Descrive il valore di un elemento
+
+    Args:
+        path: Percorso dell'elemento rispetto alla radice (o al gruppo ripetuto)
+        column: Nome della colonna da cui prendere il valore
+        default: Valore (o funzione senza argomenti) usato se la colonna è vuota
+        optional: Se True e la colonna è vuota l'elemento viene omesso
+        code: Tabella dei codici FatturaPA con cui normalizzare il valore
+        when: Colonna che deve essere valorizzata perché l'elemento sia generato
+        unless: Colonna che, se valorizzata, esclude l'elemento
+        compute: Funzione che calcola il valore da get(nome colonna)
+
+    Returns:
+        Field: Voce del piano
+    """
+    return Field(path, column, default, optional, code, when, unless, compute)
+
+
+def _today():
+    return datetime.date.today()
+
+
+def _to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(str(value).strip()[:10], "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def _due_date(get):
+    """Scadenza del pagamento: 30 giorni dalla data fattura (o da oggi se non valida)"""
+    return (_to_date(get("DataFattura")) or _today()) + datetime.timedelta(days=30)
+
+
+_HEADER = "FatturaElettronicaHeader/"
+_CEDENTE = _HEADER + "CedentePrestatore/"
+_CESSIONARIO = _HEADER + "CessionarioCommittente/"
+_BODY = "FatturaElettronicaBody/"
+_DOCUMENTO = _BODY + "DatiGenerali/DatiGeneraliDocumento/"
+_PAGAMENTO = _BODY + "DatiPagamento/"
+
+# Linea di dettaglio (percorsi relativi a DettaglioLinee)
+LINE_PLAN = [
+    field("NumeroLinea", "NumeroLinea", "1"),
+    field("Descrizione", "Descrizione", "Descrizione"),
+    field("Quantita", "Quantita", optional=True),
+    field("UnitaMisura", "UnitaMisura", optional=True),
+    field("PrezzoUnitario", "PrezzoUnitario", "0.00"),
+    field("PrezzoTotale", "PrezzoTotale", "0.00"),
+    field("AliquotaIVA", "AliquotaIVA", "22.00"),
+]
+
+# Riepilogo IVA (percorsi relativi a DatiRiepilogo), nell'ordine dello schema
+SUMMARY_PLAN = [
+    field("AliquotaIVA", "AliquotaIVA", "22.00"),
+    field("Natura", "Natura", optional=True, code="Natura"),
+    field("ImponibileImporto", "ImponibileImporto", "0.00"),
+    field("Imposta", "Imposta", "0.00"),
+    field("EsigibilitaIVA", "EsigibilitaIVA", optional=True, code="EsigibilitaIVA"),
+]
+
+# Fattura completa, nell'ordine degli elementi dello schema FatturaPA
+INVOICE_PLAN = [
+    field(_HEADER + "DatiTrasmissione/IdTrasmittente/IdPaese", "CedenteIdPaese", "IT"),
+    field(_HEADER + "DatiTrasmissione/IdTrasmittente/IdCodice", "CedentePartitaIVA", "00000000000"),
+    # Il progressivo mancante viene assegnato da ExcelXmlManager con la sequenza persistente
+    field(_HEADER + "DatiTrasmissione/ProgressivoInvio", "ProgressivoInvio"),
+    field(_HEADER + "DatiTrasmissione/FormatoTrasmissione", default="FPR12"),
+    field(_HEADER + "DatiTrasmissione/CodiceDestinatario", default="0000000"),
+
+    field(_CEDENTE + "DatiAnagrafici/IdFiscaleIVA/IdPaese", "CedenteIdPaese", "IT"),
+    field(_CEDENTE + "DatiAnagrafici/IdFiscaleIVA/IdCodice", "CedentePartitaIVA", "00000000000"),
+    field(_CEDENTE + "DatiAnagrafici/CodiceFiscale", "CedenteCodiceFiscale", optional=True),
+    field(_CEDENTE + "DatiAnagrafici/Anagrafica/Denominazione", "CedenteDenominazione", optional=True),
+    field(_CEDENTE + "DatiAnagrafici/Anagrafica/Nome", "CedenteNome", optional=True,
+          unless="CedenteDenominazione"),
+    field(_CEDENTE + "DatiAnagrafici/Anagrafica/Cognome", "CedenteCognome", optional=True,
+          unless="CedenteDenominazione"),
+    field(_CEDENTE + "DatiAnagrafici/RegimeFiscale", "CedenteRegimeFiscale", "RF01", code="RegimeFiscale"),
+    field(_CEDENTE + "Sede/Indirizzo", "CedenteIndirizzo", "Indirizzo"),
+    field(_CEDENTE + "Sede/CAP", "CedenteCAP", "00000"),
+    field(_CEDENTE + "Sede/Comune", "CedenteComune", "Comune"),
+    field(_CEDENTE + "Sede/Provincia", "CedenteProvincia", optional=True),
+    field(_CEDENTE + "Sede/Nazione", "CedenteNazione", "IT"),
+
+    # L'identificativo IVA del cessionario è presente solo con la partita IVA
+    field(_CESSIONARIO + "DatiAnagrafici/IdFiscaleIVA/IdPaese", "CessionarioIdPaese", "IT",
+          when="CessionarioPartitaIVA"),
+    field(_CESSIONARIO + "DatiAnagrafici/IdFiscaleIVA/IdCodice", "CessionarioPartitaIVA", optional=True),
+    field(_CESSIONARIO + "DatiAnagrafici/CodiceFiscale", "CessionarioCodiceFiscale", optional=True),
+    field(_CESSIONARIO + "DatiAnagrafici/Anagrafica/Denominazione", "CessionarioDenominazione", optional=True),
+    field(_CESSIONARIO + "DatiAnagrafici/Anagrafica/Nome", "CessionarioNome", optional=True,
+          unless="CessionarioDenominazione"),
+    field(_CESSIONARIO + "DatiAnagrafici/Anagrafica/Cognome", "CessionarioCognome", optional=True,
+          unless="CessionarioDenominazione"),
+    field(_CESSIONARIO + "Sede/Indirizzo", "CessionarioIndirizzo", "Indirizzo"),
+    field(_CESSIONARIO + "Sede/CAP", "CessionarioCAP", "00000"),
+    field(_CESSIONARIO + "Sede/Comune", "CessionarioComune", "Comune"),
+    field(_CESSIONARIO + "Sede/Provincia", "CessionarioProvincia", optional=True),
+    field(_CESSIONARIO + "Sede/Nazione", "CessionarioNazione", "IT"),
+
+    field(_DOCUMENTO + "TipoDocumento", "TipoDocumento", "TD01", code="TipoDocumento"),
+    field(_DOCUMENTO + "Divisa", default="EUR"),
+    field(_DOCUMENTO + "Data", "DataFattura", _today),
+    field(_DOCUMENTO + "Numero", "NumeroFattura", "00001"),
+    field(_DOCUMENTO + "ImportoTotaleDocumento", "ImportoTotale", "0.00"),
+
+    Repeat(_BODY + "DatiBeniServizi/DettaglioLinee", DETAILS, LINE_PLAN),
+    Repeat(_BODY + "DatiBeniServizi/DatiRiepilogo", SUMMARY, SUMMARY_PLAN),
+
+    field(_PAGAMENTO + "CondizioniPagamento", default="TP02"),
+    field(_PAGAMENTO + "DettaglioPagamento/ModalitaPagamento", default="MP05"),
+    field(_PAGAMENTO + "DettaglioPagamento/DataScadenzaPagamento", compute=_due_date),
+    field(_PAGAMENTO + "DettaglioPagamento/ImportoPagamento", "ImportoTotale", "0.00"),
+    field(_PAGAMENTO + "DettaglioPagamento/CodicePagamento", default="RB01"),
+]
+
+
+def default_columns():
+    """
+    Restituisce la disposizione predefinita delle colonne dei fogli
+
+    Returns:
+        dict: Sorgente -> (nome colonna -> indice)
+    """
+    return {source: {name: i for i, name in enumerate(headers)}
+            for source, headers in ((MASTER, MASTER_HEADERS), (DETAILS, DETAIL_HEADERS),
+                                    (SUMMARY, SUMMARY_HEADERS))}
+
+
+def _text(value):
+    """Converte un valore del foglio nel testo dell'elemento XML"""
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+# Tipi di passo del piano compilato
+_VALUE = 0
+_REPEAT = 1
+
+
+class XmlPlan:
+    """
+    Piano di generazione compilato per una disposizione delle colonne
+    """
+
+    def __init__(self, columns, plan=INVOICE_PLAN, ns_uri=NS_URI):
+        """
+        Compila il piano
+
+        Args:
+            columns: Sorgente -> (nome colonna -> indice), vedi default_columns()
+            plan: Piano dichiarativo
+            ns_uri: Namespace degli elementi
+        """
+        self.ns_uri = ns_uri
+        self.steps = self._compile(plan, MASTER, columns)
+
+    def _qname(self, tag):
+        return f"{{{self.ns_uri}}}{tag}"
+
+    def _ancestors(self, path):
+        """Restituisce i contenitori (percorso, nome qualificato) di un percorso, dall'alto"""
+        parts = path.split("/")[:-1]
+        return tuple(("/".join(parts[:i + 1]), self._qname(parts[i])) for i in range(len(parts)))
+
+    def _compile(self, plan, source, columns):
+        steps = []
+        for entry in plan:
+            parent_path, _, tag = entry.path.rpartition("/")
+            tag = self._qname(tag)
+            if isinstance(entry, Repeat):
+                steps.append((_REPEAT, parent_path, self._ancestors(entry.path), tag, entry.source,
+                              self._compile(entry.fields, entry.source, columns)))
+            else:
+                steps.append((_VALUE, parent_path, self._ancestors(entry.path), tag,
+                              self._compile_field(entry, columns[source]), None))
+        return tuple(steps)
+
+    @staticmethod
+    def _compile_field(entry, columns):
+        """Restituisce la funzione che calcola il testo dell'elemento da una riga"""
+        # Le colonne assenti hanno indice -1 e risultano sempre vuote
+        index = columns.get(entry.column, -1) if entry.column else -1
+        when = columns.get(entry.when, -1) if entry.when else None
+        unless = columns.get(entry.unless, -1) if entry.unless else None
+        default, optional, code, compute = entry.default, entry.optional, entry.code, entry.compute
+        fallback = None if optional else default
+
+        def cell(row, i):
+            return row[i] if 0 <= i < len(row) else None
+
+        if when is None and unless is None and code is None and compute is None:
+            # Caso più frequente: valore della colonna o valore predefinito
+            if index < 0:
+                if fallback is None:
+                    return lambda row: None
+                if callable(fallback):
+                    return lambda row: _text(fallback())
+                return lambda row: fallback
+
+            def value(row):
+                raw = row[index] if index < len(row) else None
+                if raw:
+                    return raw if raw.__class__ is str else _text(raw)
+                if fallback is None:
+                    return None
+                return _text(fallback() if callable(fallback) else fallback)
+
+            return value
+
+        def value(row):
+            if when is not None and not cell(row, when):
+                return None
+            if unless is not None and cell(row, unless):
+                return None
+
+            if compute is not None:
+                raw = compute(lambda name: cell(row, columns.get(name, -1)))
+            else:
+                raw = cell(row, index)
+
+            if code and raw:
+                # Un codice che non è in tabella resta com'è: il predefinito vale solo per le celle vuote
+                raw = normalize_code(code, raw, extract_code(str(raw)))
+
+            if not raw:
+                if fallback is None:
+                    return None
+                raw = fallback() if callable(fallback) else fallback
+            return _text(raw)
+
+        return value
+
+    @staticmethod
+    def _parent(elements, ancestors):
+        """Restituisce il contenitore dell'elemento, creando i contenitori mancanti"""
+        parent = elements[""]
+        for path, tag in ancestors:
+            element = elements.get(path)
+            if element is None:
+                element = elements[path] = etree.SubElement(parent, tag)
+            parent = element
+        return parent
+
+    def _run(self, steps, elements, row, rows):
+        sub_element = etree.SubElement
+        for kind, parent_path, ancestors, tag, function, substeps in steps:
+            # Il contenitore diretto è quasi sempre già stato creato da un passo precedente
+            parent = elements.get(parent_path)
+            if kind == _VALUE:
+                text = function(row)
+                if text is not None:
+                    if parent is None:
+                        parent = self._parent(elements, ancestors)
+                    sub_element(parent, tag).text = text
+            else:
+                for item in rows[function]:
+                    if parent is None:
+                        parent = self._parent(elements, ancestors)
+                    self._run(substeps, {"": sub_element(parent, tag)}, item, rows)
+
+    def build(self, master, details=(), summary=()):
+        """
+        Genera l'elemento radice della fattura
+
+        Args:
+            master: Riga del foglio principale
+            details: Righe di dettaglio
+            summary: Righe di riepilogo IVA
+
+        Returns:
+            etree.Element: Elemento FatturaElettronica
+        """
+        root = etree.Element(self._qname("FatturaElettronica"), nsmap={None: self.ns_uri})
+        root.set("versione", "FPR12")
+        self._run(self.steps, {"": root}, master, {MASTER: master, DETAILS: details, SUMMARY: summary})
+        return root
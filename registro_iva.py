@@ -0,0 +1,344 @@
+"""
+Registro IVA: riepilogo di imponibile e imposta per periodo, aliquota, natura
+ed esigibilità, calcolato direttamente sul database Excel delle fatture.
+
+Il foglio dei riepiloghi viene letto in sola lettura una volta, per colonne
+(liste parallele); data e tipo documento possono arrivare dall'indice di ricerca
+invece che dal foglio delle fatture. Gli importi sono sommati con Decimal per
+evitare errori di arrotondamento.
+Le fatture emesse dall'azienda (cedente con la sua partita IVA) formano il
+registro delle vendite, quelle ricevute dai fornitori il registro degli acquisti;
+la liquidazione di ogni periodo è l'IVA delle vendite meno quella degli acquisti.
+Le note di credito (TD04, TD08) sono sommate con segno negativo. Tipo documento,
+natura ed esigibilità sono confrontati per codice: le celle salvate dall'editor
+contengono la voce del menu ("TD04 - Nota di credito", "I - Esigibilità immediata").
+"""
+import csv
+import datetime
+import collections
+from decimal import Decimal, InvalidOperation
+
+import openpyxl
+from openpyxl.styles import Font, PatternFill, Alignment
+
+from instrumentation import span
+from codici_fatturapa import normalize_code, extract_code
+from schema_fatture import MASTER_HEADERS, SUMMARY_HEADERS, ID_COLUMN, SheetLayout
+
+
+PERIOD_MONTH = "mese"
+PERIOD_QUARTER = "trimestre"
+
+# Registri: fatture emesse e fatture ricevute
+REGISTER_SALES = "Vendite"
+REGISTER_PURCHASES = "Acquisti"
+
+# Tipi documento che riducono imponibile e imposta
+CREDIT_NOTE_TYPES = frozenset({"TD04", "TD08"})
+
+REGISTER_HEADERS = ["Registro", "Periodo", "AliquotaIVA", "Natura", "EsigibilitaIVA",
+                    "Documenti", "Imponibile", "Imposta"]
+
+# Intestazioni della liquidazione per periodo
+SETTLEMENT_HEADERS = ["Periodo", "IVA vendite", "IVA acquisti", "Saldo"]
+
+# Riga del registro
+RegisterRow = collections.namedtuple(
+    "RegisterRow", "registro periodo aliquota natura esigibilita documenti imponibile imposta")
+
+_ZERO = Decimal("0.00")
+_CENT = Decimal("0.01")
+
+
+def _to_decimal(value):
+    """Converte un importo letto dal foglio in Decimal (None se non valido)"""
+    if value is None or value == "":
+        return _ZERO
+    try:
+        return Decimal(str(value).strip().replace(",", "."))
+    except InvalidOperation:
+        return None
+
+
+def _code(table_name, value):
+    """Converte una cella (codice o voce del menu) nel codice della tabella ("" se vuota)"""
+    if value is None or str(value).strip() == "":
+        return ""
+    text = str(value).strip()
+    # Un codice che non è nella tabella resta com'è, senza la descrizione
+    return normalize_code(table_name, text, extract_code(text))
+
+
+def _to_date(value):
+    """Converte una data letta dal foglio (stringa AAAA-MM-GG o datetime) in date"""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(str(value).strip()[:10], "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def period_label(date, period=PERIOD_MONTH):
+    """
+    Restituisce l'etichetta del periodo di una data
+
+    Args:
+        date: Data del documento
+        period: PERIOD_MONTH o PERIOD_QUARTER
+
+    Returns:
+        str: "AAAA-MM" per il mese, "AAAA-Tn" per il trimestre
+    """
+    if period == PERIOD_QUARTER:
+        return f"{date.year}-T{(date.month - 1) // 3 + 1}"
+    return f"{date.year}-{date.month:02d}"
+
+
+def _read_documents(wb, master_sheet_name, ids=None):
+    """
+    Legge dal foglio delle fatture data, tipo documento e identificativi del cedente
+
+    Args:
+        wb: Workbook aperto in sola lettura
+        master_sheet_name: Nome del foglio delle fatture
+        ids: ID delle fatture da leggere (None per tutte)
+
+    Returns:
+        dict: ID -> (data, tipo documento, partita IVA del cedente, codice fiscale del cedente)
+    """
+    documents = {}
+    if master_sheet_name not in wb.sheetnames:
+        return documents
+    master_sheet = wb[master_sheet_name]
+    names = [ID_COLUMN, "DataFattura", "TipoDocumento", "CedentePartitaIVA", "CedenteCodiceFiscale"]
+    layout = SheetLayout.of(master_sheet, MASTER_HEADERS)
+    for row in master_sheet.iter_rows(min_row=2, max_col=layout.max_column(names), values_only=True):
+        invoice_id, date, doc_type, partita_iva, codice_fiscale = (layout.value(row, name) for name in names)
+        if invoice_id and (ids is None or invoice_id in ids):
+            documents[invoice_id] = (date, doc_type, partita_iva, codice_fiscale)
+    return documents
+
+
+def load_columns(excel_path, master_sheet_name="Fatture", summary_sheet_name="DatiRiepilogo",
+                 documents=None):
+    """
+    Legge dal database le colonne necessarie al registro
+
+    Args:
+        excel_path: Percorso del database Excel
+        master_sheet_name: Nome del foglio delle fatture
+        summary_sheet_name: Nome del foglio dei riepiloghi IVA
+        documents: Dizionario ID -> (data, tipo documento, partita IVA del cedente, codice
+                   fiscale del cedente) già disponibile (ad esempio dall'indice di ricerca);
+                   se None, o per le fatture che non contiene, viene letto dal foglio delle fatture
+
+    Returns:
+        dict: Liste parallele "id", "data", "tipo", "cedente" (tupla partita IVA, codice
+              fiscale), "aliquota", "imponibile", "imposta", "esigibilita", "natura" (una voce
+              per riga di riepilogo). Le righe di una fattura assente dal foglio delle fatture
+              hanno data None e vengono scartate dall'aggregazione.
+    """
+    with span("registro_iva.lettura"):
+        wb = openpyxl.load_workbook(excel_path, read_only=True)
+        try:
+            summary_sheet = wb[summary_sheet_name]
+            layout = SheetLayout.of(summary_sheet, SUMMARY_HEADERS)
+            summary = [row for row in (layout.to_canonical(row) for row in
+                                       summary_sheet.iter_rows(min_row=2, max_col=layout.max_column(),
+                                                               values_only=True))
+                       if row[0]]
+
+            if documents is None:
+                # ID -> (data, tipo documento, cedente) dal foglio principale, colonne risolte per nome
+                documents = _read_documents(wb, master_sheet_name)
+            else:
+                # Fatture non ancora nell'indice (ad esempio salvate da un'altra postazione)
+                missing = {row[0] for row in summary if row[0] not in documents}
+                if missing:
+                    documents = dict(documents)
+                    documents.update(_read_documents(wb, master_sheet_name, missing))
+        finally:
+            wb.close()
+
+    columns = {name: [] for name in ("id", "data", "tipo", "cedente", "aliquota", "imponibile",
+                                     "imposta", "esigibilita", "natura")}
+    for row in summary:
+        date, doc_type, partita_iva, codice_fiscale = documents.get(row[0], (None, None, None, None))
+        columns["id"].append(row[0])
+        columns["data"].append(date)
+        columns["tipo"].append(doc_type)
+        columns["cedente"].append((partita_iva, codice_fiscale))
+        columns["aliquota"].append(row[1])
+        columns["imponibile"].append(row[2])
+        columns["imposta"].append(row[3])
+        columns["esigibilita"].append(row[4])
+        columns["natura"].append(row[5])
+
+    return columns
+
+
+def aggregate(columns, period=PERIOD_MONTH, date_from=None, date_to=None, company_id=None):
+    """
+    Aggrega le colonne del riepilogo IVA
+
+    Args:
+        columns: Colonne restituite da load_columns()
+        period: PERIOD_MONTH o PERIOD_QUARTER
+        date_from: Data iniziale inclusa (opzionale)
+        date_to: Data finale inclusa (opzionale)
+        company_id: Partita IVA (o codice fiscale) dell'azienda; le fatture con un altro
+                    cedente vanno nel registro degli acquisti (se None tutte vanno in
+                    quello delle vendite)
+
+    Returns:
+        tuple: (righe del registro ordinate per registro, periodo, aliquota, natura,
+                esigibilità; numero di righe scartate per fattura mancante, data o
+                importi non validi)
+    """
+    with span("registro_iva.aggregazione", righe=len(columns["id"])):
+        # Conversione vettoriale delle colonne, una sola volta
+        dates = list(map(_to_date, columns["data"]))
+        taxable = list(map(_to_decimal, columns["imponibile"]))
+        taxes = list(map(_to_decimal, columns["imposta"]))
+        signs = [-1 if _code("TipoDocumento", doc_type) in CREDIT_NOTE_TYPES else 1
+                 for doc_type in columns["tipo"]]
+        rates = [_to_decimal(rate) for rate in columns["aliquota"]]
+        natures = [_code("Natura", natura) for natura in columns["natura"]]
+        chargeability = [_code("EsigibilitaIVA", esigibilita) for esigibilita in columns["esigibilita"]]
+        company = str(company_id).strip().upper() if company_id else None
+        registers = [REGISTER_PURCHASES if company and company not in
+                     (str(identifier or "").strip().upper() for identifier in cedente)
+                     else REGISTER_SALES for cedente in columns["cedente"]]
+
+        totals = {}
+        invoices = collections.defaultdict(set)
+        skipped = 0
+
+        for i, date in enumerate(dates):
+            if date is None or taxable[i] is None or taxes[i] is None or rates[i] is None:
+                skipped += 1
+                continue
+            if (date_from and date < date_from) or (date_to and date > date_to):
+                continue
+
+            key = (registers[i], period_label(date, period), rates[i].quantize(_CENT),
+                   natures[i], chargeability[i])
+            amounts = totals.get(key)
+            if amounts is None:
+                amounts = totals[key] = [_ZERO, _ZERO]
+            amounts[0] += signs[i] * taxable[i]
+            amounts[1] += signs[i] * taxes[i]
+            invoices[key].add(columns["id"][i])
+
+        # Vendite prima degli acquisti
+        rows = [RegisterRow(*key, len(invoices[key]), amounts[0].quantize(_CENT), amounts[1].quantize(_CENT))
+                for key, amounts in sorted(totals.items(), key=lambda item: (item[0][0] != REGISTER_SALES,
+                                                                              item[0]))]
+
+    return rows, skipped
+
+
+def build_register(excel_path, period=PERIOD_MONTH, year=None,
+                   master_sheet_name="Fatture", summary_sheet_name="DatiRiepilogo", documents=None,
+                   company_id=None):
+    """
+    Calcola il registro IVA del database Excel
+
+    Args:
+        excel_path: Percorso del database Excel
+        period: PERIOD_MONTH o PERIOD_QUARTER
+        year: Anno da includere (None per tutti)
+        master_sheet_name: Nome del foglio delle fatture
+        summary_sheet_name: Nome del foglio dei riepiloghi IVA
+        documents: Dizionario ID -> (data, tipo documento, partita IVA e codice fiscale
+                   del cedente), vedi load_columns()
+        company_id: Partita IVA o codice fiscale dell'azienda, vedi aggregate()
+
+    Returns:
+        tuple: (righe del registro, righe scartate)
+    """
+    columns = load_columns(excel_path, master_sheet_name, summary_sheet_name, documents)
+    if year:
+        return aggregate(columns, period, datetime.date(year, 1, 1), datetime.date(year, 12, 31), company_id)
+    return aggregate(columns, period, company_id=company_id)
+
+
+def totals_by_period(rows):
+    """
+    Calcola la liquidazione di ogni periodo: IVA delle vendite meno IVA degli acquisti
+
+    Args:
+        rows: Righe del registro
+
+    Returns:
+        list: Tuple (periodo, IVA vendite, IVA acquisti, saldo) ordinate per periodo;
+              un saldo positivo è IVA a debito
+    """
+    totals = {}
+    for row in rows:
+        amounts = totals.setdefault(row.periodo, [_ZERO, _ZERO])
+        amounts[0 if row.registro == REGISTER_SALES else 1] += row.imposta
+    return [(periodo, sales, purchases, sales - purchases)
+            for periodo, (sales, purchases) in sorted(totals.items())]
+
+
+def export_csv(rows, path):
+    """
+    Esporta il registro in CSV (separatore ";" e virgola decimale, come Excel in italiano)
+
+    Args:
+        rows: Righe del registro
+        path: Percorso del file CSV
+    """
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(REGISTER_HEADERS)
+        for row in rows:
+            writer.writerow([row.registro, row.periodo, str(row.aliquota).replace(".", ","), row.natura,
+                             row.esigibilita, row.documenti,
+                             str(row.imponibile).replace(".", ","), str(row.imposta).replace(".", ",")])
+
+
+def export_xlsx(rows, path):
+    """
+    Esporta il registro in un file Excel, con la liquidazione per periodo in un secondo foglio
+
+    Args:
+        rows: Righe del registro
+        path: Percorso del file Excel
+    """
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.title = "RegistroIVA"
+
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+
+    def write_headers(target, headers):
+        target.append(headers)
+        for cell in target[1]:
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.alignment = Alignment(horizontal="center")
+
+    write_headers(sheet, REGISTER_HEADERS)
+    for row in rows:
+        # Gli importi sono scritti come numeri con formato a due decimali
+        sheet.append([row.registro, row.periodo, float(row.aliquota), row.natura, row.esigibilita,
+                      row.documenti, float(row.imponibile), float(row.imposta)])
+    for column in ("C", "G", "H"):
+        for cell in sheet[column][1:]:
+            cell.number_format = "#,##0.00"
+
+    totals_sheet = wb.create_sheet("Liquidazione")
+    write_headers(totals_sheet, SETTLEMENT_HEADERS)
+    for periodo, sales, purchases, balance in totals_by_period(rows):
+        totals_sheet.append([periodo, float(sales), float(purchases), float(balance)])
+    for column in ("B", "C", "D"):
+        for cell in totals_sheet[column][1:]:
+            cell.number_format = "#,##0.00"
+
+    wb.save(path)
@@ -0,0 +1,276 @@
+"""
+Visualizzazione delle fatture in HTML con i fogli di stile XSL.
+
+La compilazione di un foglio di stile (lettura del file XSL e costruzione
+dell'oggetto etree.XSLT) costa molto più della trasformazione di una fattura:
+i fogli compilati restano in cache finché il file non cambia (dimensione e data
+di modifica). lxml richiede che un oggetto XSLT sia usato nel thread in cui è
+stato creato, quindi la cache è separata per thread: i thread che eseguono
+molte trasformazioni (ad esempio quelli del servizio HTTP) compilano ogni
+foglio una sola volta.
+
+Le pagine HTML prodotte sono conservate su disco da RenderCache, indicizzate
+dall'hash della forma canonica (C14N 2.0) della fattura e dal foglio di stile
+(percorso, dimensione e data di modifica): riaprire una fattura già vista non
+ripete la trasformazione e non crea un nuovo file temporaneo. La cache ha una
+dimensione massima; oltre il limite vengono eliminate le pagine usate meno di
+recente (la data di modifica del file registra l'ultimo uso, così l'ordine si
+conserva tra una sessione e l'altra).
+"""
+import os
+import glob
+import hashlib
+import tempfile
+import threading
+import collections
+
+from lxml import etree
+
+from instrumentation import span
+
+
+# Cartella e dimensione massima predefinite della cache delle pagine HTML
+RENDER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".fatturexml", "visualizzazioni")
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def find_stylesheets(project_dir):
+    """
+    Elenca i fogli di stile XSL disponibili
+
+    Args:
+        project_dir: Cartella del progetto (vengono letti *.xsl e xsl/*.xsl)
+
+    Returns:
+        list: Percorsi dei fogli di stile
+    """
+    paths = glob.glob(os.path.join(project_dir, "*.xsl"))
+    xsl_dir = os.path.join(project_dir, "xsl")
+    if os.path.isdir(xsl_dir):
+        paths.extend(glob.glob(os.path.join(xsl_dir, "*.xsl")))
+    return paths
+
+
+def _file_stamp(path):
+    """Restituisce l'impronta di un file (dimensione, data di modifica in ns)"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class StylesheetCache:
+    """
+    Fogli di stile compilati, per thread e per percorso assoluto
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, path):
+        """
+        Restituisce il foglio di stile compilato, ricompilandolo solo se il file è cambiato
+
+        Args:
+            path: Percorso del foglio di stile XSL
+
+        Returns:
+            etree.XSLT: Trasformazione compilata
+
+        Raises:
+            OSError: Se il file non esiste
+            etree.XSLTParseError: Se il foglio di stile non è valido
+        """
+        entries = getattr(self._local, "entries", None)
+        if entries is None:
+            entries = self._local.entries = {}
+
+        path = os.path.abspath(path)
+        stamp = _file_stamp(path)
+        entry = entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        with span("xslt.compila", foglio=os.path.basename(path)):
+            transformer = etree.XSLT(etree.parse(path))
+        entries[path] = (stamp, transformer)
+        return transformer
+
+    def clear(self):
+        """Svuota la cache del thread corrente"""
+        self._local.entries = {}
+
+
+# Cache condivisa dal processo
+_default_cache = StylesheetCache()
+
+
+def compiled_stylesheet(path):
+    """Restituisce il foglio di stile compilato, vedi StylesheetCache.get()"""
+    return _default_cache.get(path)
+
+
+def render_html(xml_doc, xsl_path):
+    """
+    Trasforma una fattura in HTML
+
+    Args:
+        xml_doc: Documento XML della fattura (ElementTree o elemento radice)
+        xsl_path: Percorso del foglio di stile XSL
+
+    Returns:
+        bytes: Pagina HTML
+    """
+    transformer = compiled_stylesheet(xsl_path)
+    with span("xslt.trasforma", foglio=os.path.basename(xsl_path)):
+        result = transformer(xml_doc)
+    with span("xml.serializza"):
+        return etree.tostring(result, pretty_print=True)
+
+
+def document_hash(xml_doc):
+    """
+    Calcola l'hash della forma canonica di una fattura
+
+    Args:
+        xml_doc: Documento XML (ElementTree o elemento radice)
+
+    Returns:
+        str: Hash SHA-256 esadecimale di documento e istruzioni di elaborazione
+    """
+    if not isinstance(xml_doc, etree._ElementTree):
+        xml_doc = xml_doc.getroottree()
+    return hashlib.sha256(etree.tostring(xml_doc, method="c14n2")).hexdigest()
+
+
+def render_key(xml_doc, xsl_path):
+    """
+    Restituisce la chiave di cache di una trasformazione
+
+    Args:
+        xml_doc: Documento XML della fattura
+        xsl_path: Percorso del foglio di stile XSL
+
+    Returns:
+        str: Chiave esadecimale (fattura e versione del foglio di stile)
+    """
+    xsl_path = os.path.abspath(xsl_path)
+    size, mtime_ns = _file_stamp(xsl_path)
+    stylesheet = f"{xsl_path}:{size}:{mtime_ns}"
+    return hashlib.sha256(f"{document_hash(xml_doc)}\0{stylesheet}".encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    Pagine HTML delle fatture su disco, con eliminazione delle meno usate (LRU)
+    """
+
+    def __init__(self, directory=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES):
+        """
+        Args:
+            directory: Cartella della cache (creata al primo uso)
+            max_bytes: Dimensione massima complessiva delle pagine
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # Nome del file -> dimensione, dal meno al più recentemente usato (letto al primo uso)
+        self._entries = None
+        self._size = 0
+
+    def _load_entries(self):
+        """Legge il contenuto della cartella, ordinato per ultimo uso"""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".html"):
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        files.sort()
+        self._entries = collections.OrderedDict((name, size) for _, name, size in files)
+        self._size = sum(self._entries.values())
+
+    def _evict(self):
+        """Elimina le pagine meno usate oltre la dimensione massima (l'ultima resta sempre)"""
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _lookup(self, name):
+        """Restituisce il percorso di una pagina presente, aggiornandone l'ultimo uso"""
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if self._entries is None:
+                self._load_entries()
+            if name not in self._entries:
+                return None
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Rimossa dall'esterno
+                self._size -= self._entries.pop(name)
+                return None
+            self._entries.move_to_end(name)
+            return path
+
+    def _store(self, name, html):
+        """Scrive una pagina nella cache in modo atomico"""
+        path = os.path.join(self.directory, name)
+        fd, temp_path = tempfile.mkstemp(prefix=".~", suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(html)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._size += len(html) - self._entries.pop(name, 0)
+            self._entries[name] = len(html)
+            self._evict()
+        return path
+
+    def html_path(self, xml_doc, xsl_path):
+        """
+        Restituisce la pagina HTML di una fattura, trasformandola solo se non è in cache
+
+        Args:
+            xml_doc: Documento XML della fattura
+            xsl_path: Percorso del foglio di stile XSL
+
+        Returns:
+            str: Percorso del file HTML
+        """
+        name = render_key(xml_doc, xsl_path) + ".html"
+        path = self._lookup(name)
+        if path is not None:
+            return path
+
+        return self._store(name, render_html(xml_doc, xsl_path))
+
+    def clear(self):
+        """Elimina tutte le pagine della cache"""
+        with self._lock:
+            if self._entries is None:
+                self._load_entries()
+            for name in self._entries:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self._size = 0
+
+
+# Cache delle pagine condivisa dal processo
+_default_render_cache = RenderCache()
+
+
+def cached_html_path(xml_doc, xsl_path):
+    """Restituisce la pagina HTML di una fattura, vedi RenderCache.html_path()"""
+    return _default_render_cache.html_path(xml_doc, xsl_path)
@@ -0,0 +1,462 @@
+"""
+Indice di ricerca full-text delle fatture salvate nel database Excel.
+
+L'indice è un database SQLite (tabella virtuale FTS5) salvato accanto al file
+Excel e aggiornato a ogni esportazione, modifica o eliminazione. Ogni fattura è
+un documento con tre campi ricercabili: soggetti (numero, nomi e partite IVA di
+cedente e cessionario), descrizioni delle linee e note.
+
+La tabella "fatture" contiene anche i campi usati dall'elenco filtrato e
+ordinato (data, tipo documento, importo, soggetti), con i relativi indici.
+
+Lo stato del file Excel (mtime e dimensione) al momento dell'ultimo aggiornamento
+è memorizzato nell'indice: se il file è stato modificato altrove, l'indice viene
+aggiornato alla ricerca successiva. L'aggiornamento è incrementale: se i fogli
+indicizzati non sono cambiati (CRC delle parti dell'archivio xlsx) il workbook non
+viene letto, altrimenti sono reindicizzate solo le fatture la cui impronta è
+diversa. Per ogni fattura è conservata anche la riga del foglio principale.
+"""
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import zipfile
+import datetime
+
+from lxml import etree
+
+
+SCHEMA_VERSION = "4"
+
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_SHARED_STRINGS = "xl/sharedStrings.xml"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    chiave TEXT PRIMARY KEY,
+    valore TEXT
+);
+CREATE TABLE IF NOT EXISTS fatture (
+    rowid INTEGER PRIMARY KEY,
+    invoice_id TEXT UNIQUE NOT NULL,
+    numero TEXT,
+    data TEXT,
+    tipo_documento TEXT,
+    importo REAL,
+    cedente TEXT,
+    cedente_piva TEXT,
+    cedente_cf TEXT,
+    cessionario TEXT,
+    cessionario_piva TEXT,
+    riga INTEGER,
+    impronta TEXT
+);
+CREATE INDEX IF NOT EXISTS fatture_data ON fatture (data);
+CREATE INDEX IF NOT EXISTS fatture_importo ON fatture (importo);
+CREATE INDEX IF NOT EXISTS fatture_tipo ON fatture (tipo_documento, data);
+CREATE INDEX IF NOT EXISTS fatture_cedente ON fatture (cedente COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS fatture_cessionario ON fatture (cessionario COLLATE NOCASE);
+CREATE VIRTUAL TABLE IF NOT EXISTS testo_fatture USING fts5(
+    soggetti, descrizioni, note,
+    tokenize = "unicode61 remove_diacritics 2"
+);
+"""
+
+# Chiavi di ordinamento ammesse per l'elenco e relative espressioni SQL
+SORT_KEYS = {
+    "numero": "CAST(f.numero AS INTEGER) {dir}, f.numero {dir}",
+    "data": "f.data {dir}",
+    "tipo": "f.tipo_documento {dir}",
+    "importo": "f.importo {dir}",
+    "cedente": "f.cedente COLLATE NOCASE {dir}",
+    "cessionario": "f.cessionario COLLATE NOCASE {dir}",
+}
+
+
+def search_index_path(excel_path):
+    """
+    Restituisce il percorso dell'indice di ricerca associato a un file Excel
+
+    Args:
+        excel_path: Percorso del database Excel
+
+    Returns:
+        str: Percorso del file SQLite dell'indice
+    """
+    return os.path.splitext(excel_path)[0] + ".ricerca.sqlite"
+
+
+def file_state(path):
+    """
+    Restituisce una firma dello stato di un file (mtime e dimensione)
+
+    Args:
+        path: Percorso del file
+
+    Returns:
+        str: Firma del file, None se il file non esiste
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def sheet_fingerprints(excel_path, sheet_names):
+    """
+    Restituisce l'impronta delle parti del file xlsx che contengono i fogli indicati.
+    Il file xlsx è un archivio zip: CRC e dimensione di ogni parte si leggono dalla
+    directory centrale, senza decomprimere i fogli.
+
+    Args:
+        excel_path: Percorso del database Excel
+        sheet_names: Nomi dei fogli
+
+    Returns:
+        dict: Nome del foglio -> impronta (None se il foglio non esiste), più le
+              stringhe condivise alla chiave ""; None se il file non è leggibile
+    """
+    try:
+        with zipfile.ZipFile(excel_path) as archive:
+            workbook = etree.fromstring(archive.read("xl/workbook.xml"))
+            rels = etree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+            parts = {info.filename: f"{info.CRC:08x}:{info.file_size}" for info in archive.infolist()}
+    except (OSError, KeyError, zipfile.BadZipFile, etree.XMLSyntaxError):
+        return None
+
+    targets = {}
+    for rel in rels:
+        target = rel.get("Target") or ""
+        # Destinazione assoluta ("/xl/...") o relativa alla cartella xl
+        targets[rel.get("Id")] = target.lstrip("/") if target.startswith("/") else "xl/" + target
+
+    sheets = {sheet.get("name"): targets.get(sheet.get(_NS_REL + "id"))
+              for sheet in workbook.iter(_NS_MAIN + "sheet")}
+
+    fingerprints = {name: parts.get(sheets.get(name)) for name in sheet_names}
+    # Le celle di testo possono rimandare alle stringhe condivise
+    fingerprints[""] = parts.get(_SHARED_STRINGS)
+    return fingerprints
+
+
+def document_fingerprint(master_row, detail_rows):
+    """
+    Calcola l'impronta dei dati di una fattura, per riconoscere le fatture modificate
+
+    Args:
+        master_row: Riga del foglio principale
+        detail_rows: Righe di dettaglio della fattura
+
+    Returns:
+        str: Hash esadecimale dei valori
+    """
+    def text(value):
+        if value is None:
+            return ""
+        if isinstance(value, datetime.datetime):
+            return value.strftime("%Y-%m-%d")
+        return str(value)
+
+    digest = hashlib.sha1()
+    for row in [master_row] + list(detail_rows):
+        values = [text(value) for value in row]
+        # Le celle vuote in coda dipendono dalla larghezza del foglio
+        while values and not values[-1]:
+            values.pop()
+        digest.update(("\x1f".join(values) + "\x1e").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_match_query(text):
+    """
+    Converte il testo digitato dall'utente in un'espressione FTS5.
+    Ogni parola diventa un prefisso da cercare; le parole sono in AND.
+
+    Args:
+        text: Testo della ricerca
+
+    Returns:
+        str: Espressione MATCH, vuota se non ci sono parole
+    """
+    words = re.findall(r"\w+", text or "")
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class InvoiceSearchIndex:
+    """
+    Indice full-text SQLite delle fatture
+    """
+
+    def __init__(self, db_path):
+        """
+        Apre (o crea) l'indice
+
+        Args:
+            db_path: Percorso del file SQLite
+
+        Raises:
+            sqlite3.OperationalError: Se SQLite non supporta FTS5
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+
+        version = self._read_version()
+        if version is not None and version != SCHEMA_VERSION:
+            # Schema di una versione precedente: l'indice viene ricreato da zero
+            self._drop_schema()
+
+        self.conn.executescript(_SCHEMA)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('versione', ?)", (SCHEMA_VERSION,))
+
+    def _read_version(self):
+        try:
+            row = self.conn.execute("SELECT valore FROM meta WHERE chiave = 'versione'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def _drop_schema(self):
+        with self.conn:
+            for table in ("testo_fatture", "fatture", "meta"):
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def close(self):
+        """Chiude la connessione al database"""
+        self.conn.close()
+
+    def is_current(self, excel_path):
+        """
+        Indica se l'indice corrisponde allo stato attuale del file Excel
+
+        Args:
+            excel_path: Percorso del database Excel
+
+        Returns:
+            bool: True se l'indice è aggiornato
+        """
+        return self.stored_state() == file_state(excel_path)
+
+    def stored_state(self):
+        """Restituisce la firma del file Excel registrata all'ultimo aggiornamento"""
+        row = self.conn.execute("SELECT valore FROM meta WHERE chiave = 'stato_excel'").fetchone()
+        return row[0] if row else None
+
+    def stored_parts(self):
+        """Restituisce le impronte dei fogli registrate all'ultimo aggiornamento"""
+        row = self.conn.execute("SELECT valore FROM meta WHERE chiave = 'impronte_fogli'").fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def mark_current(self, state, parts=None):
+        """
+        Registra lo stato del file Excel a cui corrisponde l'indice
+
+        Args:
+            state: Firma del file Excel restituita da file_state()
+            parts: Impronte dei fogli restituite da sheet_fingerprints()
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('stato_excel', ?)", (state,))
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('impronte_fogli', ?)",
+                              (json.dumps(parts, sort_keys=True) if parts else None,))
+
+    def fingerprints(self):
+        """
+        Restituisce l'impronta di tutte le fatture indicizzate
+
+        Returns:
+            dict: ID fattura -> impronta
+        """
+        return dict(self.conn.execute("SELECT invoice_id, impronta FROM fatture"))
+
+    def set_rows(self, rows):
+        """
+        Registra la riga del foglio principale di ogni fattura
+
+        Args:
+            rows: Dizionario ID fattura -> numero di riga
+        """
+        with self.conn:
+            self.conn.executemany("UPDATE fatture SET riga = ? WHERE invoice_id = ? AND riga IS NOT ?",
+                                  [(row, invoice_id, row) for invoice_id, row in rows.items()])
+
+    def row_of(self, invoice_id):
+        """
+        Restituisce la riga del foglio principale registrata per una fattura.
+        Il valore è un suggerimento e va verificato sul foglio.
+
+        Args:
+            invoice_id: ID della fattura
+
+        Returns:
+            int: Numero di riga, None se non noto
+        """
+        row = self.conn.execute("SELECT riga FROM fatture WHERE invoice_id = ?", (invoice_id,)).fetchone()
+        return row[0] if row else None
+
+    def _delete(self, invoice_id):
+        row = self.conn.execute("SELECT rowid FROM fatture WHERE invoice_id = ?", (invoice_id,)).fetchone()
+        if row:
+            self.conn.execute("DELETE FROM testo_fatture WHERE rowid = ?", row)
+            self.conn.execute("DELETE FROM fatture WHERE rowid = ?", row)
+
+    def _insert(self, invoice_id, record, texts):
+        cursor = self.conn.execute(
+            """
+            INSERT INTO fatture (invoice_id, numero, data, tipo_documento, importo,
+                                 cedente, cedente_piva, cedente_cf, cessionario, cessionario_piva,
+                                 riga, impronta)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (invoice_id, record.get("numero"), record.get("data"),
+             record.get("tipo_documento"), record.get("importo"),
+             record.get("cedente"), record.get("cedente_piva"), record.get("cedente_cf"),
+             record.get("cessionario"), record.get("cessionario_piva"),
+             record.get("riga"), record.get("impronta")))
+        self.conn.execute(
+            "INSERT INTO testo_fatture (rowid, soggetti, descrizioni, note) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, texts.get("soggetti", ""), texts.get("descrizioni", ""), texts.get("note", "")))
+
+    def update(self, updated=(), removed=()):
+        """
+        Aggiorna l'indice in un'unica transazione
+
+        Args:
+            updated: Sequenza di tuple (ID fattura, dati per l'elenco, testi)
+            removed: ID delle fatture da rimuovere
+        """
+        with self.conn:
+            for invoice_id in removed:
+                self._delete(invoice_id)
+            for invoice_id, record, texts in updated:
+                self._delete(invoice_id)
+                self._insert(invoice_id, record, texts)
+
+    def search(self, text, limit=200):
+        """
+        Cerca le fatture che contengono tutte le parole indicate
+
+        Args:
+            text: Testo della ricerca
+            limit: Numero massimo di risultati
+
+        Returns:
+            list: Tuple (id, numero, data, cedente, cessionario, estratto) in ordine di rilevanza
+        """
+        query = build_match_query(text)
+        if not query:
+            return []
+
+        return self.conn.execute(
+            """
+            SELECT f.invoice_id, f.numero, f.data, f.cedente, f.cessionario,
+                   snippet(testo_fatture, -1, '[', ']', '…', 10)
+            FROM testo_fatture
+            JOIN fatture f ON f.rowid = testo_fatture.rowid
+            WHERE testo_fatture MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            """,
+            (query, limit)).fetchall()
+
+    def documents(self):
+        """
+        Restituisce data, tipo documento, partita IVA e codice fiscale del cedente di tutte
+        le fatture indicizzate
+
+        Returns:
+            dict: ID fattura -> (data, tipo documento, partita IVA del cedente, codice fiscale del cedente)
+        """
+        return {invoice_id: (data, doc_type, partita_iva, codice_fiscale)
+                for invoice_id, data, doc_type, partita_iva, codice_fiscale in
+                self.conn.execute("SELECT invoice_id, data, tipo_documento, cedente_piva, cedente_cf "
+                                  "FROM fatture")}
+
+    def _where_clause(self, filters):
+        """
+        Compone la condizione WHERE per i filtri dell'elenco
+
+        Args:
+            filters: Dizionario dei filtri (vedi query())
+
+        Returns:
+            tuple: (condizione SQL, parametri, True se è presente una ricerca testuale)
+        """
+        conditions = []
+        params = []
+
+        if filters.get("data_da"):
+            conditions.append("f.data >= ?")
+            params.append(filters["data_da"])
+        if filters.get("data_a"):
+            conditions.append("f.data <= ?")
+            params.append(filters["data_a"])
+        if filters.get("tipo_documento"):
+            conditions.append("f.tipo_documento = ?")
+            params.append(filters["tipo_documento"])
+        if filters.get("importo_min") is not None:
+            conditions.append("f.importo >= ?")
+            params.append(filters["importo_min"])
+        if filters.get("importo_max") is not None:
+            conditions.append("f.importo <= ?")
+            params.append(filters["importo_max"])
+        if filters.get("controparte"):
+            # Nome (anche parziale) o partita IVA di cedente o cessionario
+            pattern = f"%{filters['controparte']}%"
+            conditions.append("(f.cedente LIKE ? OR f.cessionario LIKE ? "
+                              "OR f.cedente_piva = ? OR f.cessionario_piva = ?)")
+            params.extend([pattern, pattern, filters["controparte"], filters["controparte"]])
+
+        match = build_match_query(filters.get("testo"))
+        if match:
+            conditions.append("testo_fatture MATCH ?")
+            params.append(match)
+
+        return (" AND ".join(conditions) or "1"), params, bool(match)
+
+    def query(self, filters=None, sort_by="data", descending=True, offset=0, limit=100):
+        """
+        Restituisce una pagina dell'elenco delle fatture, filtrato e ordinato
+
+        Args:
+            filters: Dizionario con chiavi opzionali "data_da", "data_a" (AAAA-MM-GG),
+                     "controparte", "tipo_documento", "importo_min", "importo_max", "testo"
+            sort_by: Chiave di ordinamento (vedi SORT_KEYS); con un testo di ricerca,
+                     None ordina per rilevanza
+            descending: Ordinamento decrescente
+            offset: Numero di righe da saltare
+            limit: Numero massimo di righe della pagina
+
+        Returns:
+            tuple: (righe, totale). Ogni riga è (id, numero, data, tipo, importo,
+                   cedente, cessionario, estratto)
+        """
+        where, params, has_text = self._where_clause(filters or {})
+        source = ("fatture f JOIN testo_fatture ON testo_fatture.rowid = f.rowid"
+                  if has_text else "fatture f")
+
+        total = self.conn.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params).fetchone()[0]
+
+        if sort_by in SORT_KEYS:
+            order = SORT_KEYS[sort_by].format(dir="DESC" if descending else "ASC") + ", f.rowid"
+        elif has_text:
+            order = "rank"
+        else:
+            order = "f.rowid"
+
+        snippet = "snippet(testo_fatture, -1, '[', ']', '…', 10)" if has_text else "''"
+        rows = self.conn.execute(
+            f"""
+            SELECT f.invoice_id, f.numero, f.data, f.tipo_documento, f.importo,
+                   f.cedente, f.cessionario, {snippet}
+            FROM {source}
+            WHERE {where}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+            """,
+            params + [limit, offset]).fetchall()
+
+        return rows, total
@@ -0,0 +1,238 @@
+"""
+Schema dei fogli del database Excel delle fatture.
+
+Il codice gestisce le righe nell'ordine canonico delle colonne (MASTER_HEADERS,
+DETAIL_HEADERS, SUMMARY_HEADERS). SheetLayout legge una volta l'intestazione
+reale del foglio e ricava, per nome, la posizione di ogni colonna canonica: le
+righe vengono convertite dall'ordine del foglio a quello canonico (lettura) e
+viceversa (scrittura), così i dati restano corretti anche se le colonne sono
+state spostate o se ne sono aggiunte altre.
+
+Le versioni precedenti creavano il foglio delle fatture con un'intestazione di
+10 colonne (LEGACY_MASTER_HEADERS) pur scrivendo i dati nell'ordine canonico
+completo: quell'intestazione viene riconosciuta come disposizione canonica e
+migrate_headers() la sostituisce con i nomi corretti.
+"""
+
+# Colonne canoniche dei fogli, nell'ordine delle righe prodotte da ExcelXmlManager
+MASTER_HEADERS = [
+    "ID_Fattura", "NumeroFattura", "DataFattura", "TipoDocumento", "ImportoTotale",
+    "CedenteIdPaese", "CedentePartitaIVA", "CedenteCodiceFiscale", "CedenteDenominazione",
+    "CedenteNome", "CedenteCognome", "CedenteRegimeFiscale", "CedenteIndirizzo", "CedenteCAP",
+    "CedenteComune", "CedenteProvincia", "CedenteNazione",
+    "CessionarioIdPaese", "CessionarioPartitaIVA", "CessionarioCodiceFiscale",
+    "CessionarioDenominazione", "CessionarioNome", "CessionarioCognome", "CessionarioIndirizzo",
+    "CessionarioCAP", "CessionarioComune", "CessionarioProvincia", "CessionarioNazione",
+    "NotaFattura", "ProgressivoInvio",
+]
+DETAIL_HEADERS = ["ID_Fattura", "NumeroLinea", "Descrizione", "Quantita", "UnitaMisura",
+                  "PrezzoUnitario", "PrezzoTotale", "AliquotaIVA", "Note"]
+SUMMARY_HEADERS = ["ID_Fattura", "AliquotaIVA", "ImponibileImporto", "Imposta",
+                   "EsigibilitaIVA", "Natura"]
+STRUCTURE_HEADERS = ["TagXML", "Percorso", "Descrizione"]
+
+# Intestazione del foglio fatture scritta dalle versioni precedenti dell'esportazione
+LEGACY_MASTER_HEADERS = [
+    "ID_Fattura", "NumeroFattura", "DataFattura", "TipoDocumento",
+    "ImportoTotale", "CedenteDenominazione", "CedentePartitaIVA",
+    "CessionarioDenominazione", "CessionarioPartitaIVA", "NotaFattura",
+]
+
+ID_COLUMN = "ID_Fattura"
+
+
+def read_headers(sheet):
+    """
+    Legge la riga di intestazione di un foglio
+
+    Args:
+        sheet: Foglio Excel (anche in sola lettura)
+
+    Returns:
+        list: Nomi delle colonne (None per le celle vuote)
+    """
+    headers = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    return [str(value).strip() if value not in (None, "") else None for value in headers]
+
+
+def _is_legacy(headers, canonical):
+    """Indica se l'intestazione è quella a 10 colonne delle versioni precedenti"""
+    return (list(canonical) == MASTER_HEADERS
+            and headers[:len(LEGACY_MASTER_HEADERS)] == LEGACY_MASTER_HEADERS
+            and not any(headers[len(LEGACY_MASTER_HEADERS):]))
+
+
+def effective_headers(headers, canonical):
+    """
+    Restituisce l'intestazione che descrive la disposizione reale dei dati.
+    L'intestazione legacy diventa quella canonica; le colonne canoniche mancanti
+    in coda (database creati prima che fossero aggiunte) prendono la posizione
+    canonica se la cella di intestazione è libera.
+
+    Args:
+        headers: Intestazione letta dal foglio
+        canonical: Colonne canoniche del foglio
+
+    Returns:
+        list: Nomi delle colonne nella posizione del foglio
+    """
+    headers = list(headers)
+    if _is_legacy(headers, canonical):
+        return list(canonical) + headers[len(canonical):]
+
+    present = set(headers)
+    for position, name in enumerate(canonical):
+        if name in present:
+            continue
+        if position >= len(headers):
+            headers.extend([None] * (position + 1 - len(headers)))
+        if headers[position] is None:
+            headers[position] = name
+            present.add(name)
+    return headers
+
+
+def migrate_headers(headers, canonical):
+    """
+    Calcola l'intestazione corretta di un foglio esistente
+
+    Args:
+        headers: Intestazione letta dal foglio
+        canonical: Colonne canoniche del foglio
+
+    Returns:
+        list: Nuova intestazione (le colonne canoniche assenti sono aggiunte in
+              fondo), None se l'intestazione è già corretta o il foglio è vuoto
+    """
+    if not any(headers):
+        return None
+
+    migrated = effective_headers(headers, canonical)
+    present = set(migrated)
+    migrated += [name for name in canonical if name not in present]
+
+    # Le celle vuote in coda non contano
+    while migrated and migrated[-1] is None:
+        migrated.pop()
+    trimmed = list(headers)
+    while trimmed and trimmed[-1] is None:
+        trimmed.pop()
+    return migrated if migrated != trimmed else None
+
+
+class SheetLayout:
+    """
+    Corrispondenza tra le colonne canoniche e le colonne reali di un foglio
+    """
+
+    def __init__(self, headers, canonical):
+        """
+        Risolve le colonne per nome
+
+        Args:
+            headers: Intestazione letta dal foglio
+            canonical: Colonne canoniche del foglio
+        """
+        self.canonical = canonical
+        self.headers = effective_headers(headers, canonical)
+
+        # Nome -> indice (da 0) nel foglio; in caso di nomi ripetuti vale il primo
+        self.index = {}
+        for position, name in enumerate(self.headers):
+            if name is not None:
+                self.index.setdefault(name, position)
+
+        # Posizione nel foglio di ogni colonna canonica (-1 se assente)
+        self.positions = [self.index.get(name, -1) for name in canonical]
+        self.width = max(len(self.headers), len(canonical))
+        self.identity = self.positions == list(range(len(canonical)))
+
+    @classmethod
+    def of(cls, sheet, canonical):
+        """
+        Crea la corrispondenza leggendo l'intestazione del foglio
+
+        Args:
+            sheet: Foglio Excel
+            canonical: Colonne canoniche del foglio
+
+        Returns:
+            SheetLayout: Corrispondenza delle colonne
+        """
+        return cls(read_headers(sheet), canonical)
+
+    def column(self, name):
+        """
+        Restituisce il numero di colonna (da 1) di una colonna
+
+        Args:
+            name: Nome della colonna
+
+        Returns:
+            int: Numero di colonna, None se assente
+        """
+        position = self.index.get(name)
+        return position + 1 if position is not None else None
+
+    def value(self, row, name):
+        """
+        Restituisce il valore di una colonna da una riga nell'ordine del foglio
+
+        Args:
+            row: Valori della riga nell'ordine del foglio
+            name: Nome della colonna
+
+        Returns:
+            Valore della cella, None se la colonna è assente
+        """
+        position = self.index.get(name, -1)
+        return row[position] if 0 <= position < len(row) else None
+
+    def max_column(self, names=None):
+        """
+        Restituisce l'ultima colonna (da 1) da leggere per ottenere le colonne indicate
+
+        Args:
+            names: Nomi delle colonne (tutte le canoniche se None)
+
+        Returns:
+            int: Numero dell'ultima colonna necessaria
+        """
+        positions = [self.index.get(name, -1) for name in (names or self.canonical)]
+        return max(positions + [0]) + 1
+
+    def to_canonical(self, row):
+        """
+        Converte una riga del foglio nell'ordine canonico
+
+        Args:
+            row: Valori della riga nell'ordine del foglio
+
+        Returns:
+            list: Valori nell'ordine canonico (None per le colonne assenti)
+        """
+        size = len(row)
+        if self.identity:
+            values = list(row[:len(self.canonical)])
+            if size < len(self.canonical):
+                values.extend([None] * (len(self.canonical) - size))
+            return values
+        return [row[position] if 0 <= position < size else None for position in self.positions]
+
+    def to_sheet(self, values):
+        """
+        Converte una riga in ordine canonico nell'ordine del foglio
+
+        Args:
+            values: Valori nell'ordine canonico
+
+        Returns:
+            list: Valori nell'ordine del foglio (None per le colonne non canoniche)
+        """
+        if self.identity:
+            return list(values)
+        row = [None] * self.width
+        for value, position in zip(values, self.positions):
+            if position >= 0:
+                row[position] = value
+        return row
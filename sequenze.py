@@ -0,0 +1,247 @@
+"""
+Sequenze persistenti per il progressivo di invio e la numerazione delle fatture.
+
+I contatori sono in un database SQLite salvato accanto al file Excel. Ogni
+operazione apre una transazione BEGIN IMMEDIATE, che prende il lock di scrittura
+del file prima di leggere il contatore: due thread o processi non possono quindi
+ricevere lo stesso valore. reserve() assegna in una sola transazione un
+intervallo di valori consecutivi, per la generazione in serie.
+
+Il progressivo di invio (massimo 10 caratteri) è il contatore scritto in base 36
+su almeno 5 cifre, così è valido anche come progressivo nel nome del file SdI.
+"""
+import os
+import sqlite3
+from contextlib import closing
+
+
+# Sequenza del progressivo di invio
+PROGRESSIVO = "progressivo_invio"
+
+# Attesa massima del lock di scrittura (secondi)
+LOCK_TIMEOUT = 30
+
+_BASE36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sequenze (
+    nome TEXT PRIMARY KEY,
+    prossimo INTEGER NOT NULL
+);
+"""
+
+
+def sequence_path(excel_path=None):
+    """
+    Restituisce il percorso del database delle sequenze
+
+    Args:
+        excel_path: Percorso del database Excel (None per le sequenze dell'utente)
+
+    Returns:
+        str: Percorso del file SQLite
+    """
+    if excel_path:
+        return os.path.splitext(excel_path)[0] + ".sequenze.sqlite"
+    return os.path.join(os.path.expanduser("~"), ".fatturexml", "sequenze.sqlite")
+
+
+def number_sequence(year):
+    """Nome della sequenza dei numeri fattura di un anno"""
+    return f"numero/{year}"
+
+
+def format_progressivo(value):
+    """
+    Converte un valore della sequenza nel progressivo di invio
+
+    Args:
+        value: Valore della sequenza (da 0)
+
+    Returns:
+        str: Progressivo in base 36, almeno 5 e al massimo 10 caratteri
+
+    Raises:
+        ValueError: Se il valore non è rappresentabile in 10 caratteri
+    """
+    if not 0 <= value < 36 ** 10:
+        raise ValueError(f"Progressivo di invio fuori intervallo: {value}")
+    digits = ""
+    while value:
+        value, digit = divmod(value, 36)
+        digits = _BASE36[digit] + digits
+    return digits.rjust(5, "0")
+
+
+def parse_progressivo(text):
+    """
+    Converte un progressivo di invio nel valore della sequenza (inverso di format_progressivo)
+
+    Args:
+        text: Progressivo di invio letto da una fattura
+
+    Returns:
+        int: Valore in base 36, None se il progressivo non è alfanumerico
+    """
+    text = str(text or "").strip()
+    if not text or len(text) > 10 or not text.isalnum() or not text.isascii():
+        return None
+    return int(text, 36)
+
+
+class SequenceStore:
+    """
+    Contatori persistenti e atomici in un file SQLite
+    """
+
+    def __init__(self, db_path):
+        """
+        Apre (o crea) il database delle sequenze
+
+        Args:
+            db_path: Percorso del file SQLite
+        """
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        # Connessione per operazione: utilizzabile da qualsiasi thread, transazioni esplicite
+        return sqlite3.connect(self.db_path, timeout=LOCK_TIMEOUT, isolation_level=None)
+
+    def _update(self, name, start, sql, params, check=None):
+        """
+        Esegue una modifica del contatore nella stessa transazione in cui lo legge
+
+        Args:
+            check: Funzione opzionale chiamata con il valore corrente prima della
+                   modifica; un'eccezione annulla la transazione
+
+        Returns:
+            int: Valore del contatore prima della modifica
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR IGNORE INTO sequenze VALUES (?, ?)", (name, start))
+                current = conn.execute("SELECT prossimo FROM sequenze WHERE nome = ?", (name,)).fetchone()[0]
+                if check is not None:
+                    check(current)
+                conn.execute(sql, params + (name,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return current
+
+    def reserve(self, name, count=1, start=1):
+        """
+        Riserva valori consecutivi della sequenza
+
+        Args:
+            name: Nome della sequenza
+            count: Numero di valori
+            start: Primo valore se la sequenza non esiste ancora
+
+        Returns:
+            range: Valori riservati
+        """
+        if count < 1:
+            return range(0)
+        first = self._update(name, start, "UPDATE sequenze SET prossimo = prossimo + ? WHERE nome = ?",
+                             (count,))
+        return range(first, first + count)
+
+    def reserve_from(self, name, first, count=1):
+        """
+        Riserva valori consecutivi a partire da un valore indicato (ad esempio il
+        primo numero scelto per una serie); la sequenza prosegue dopo l'ultimo
+
+        Args:
+            name: Nome della sequenza
+            first: Primo valore da riservare
+            count: Numero di valori
+
+        Returns:
+            range: Valori riservati
+
+        Raises:
+            ValueError: Se first è già stato assegnato (precede il prossimo valore della sequenza)
+        """
+        if count < 1:
+            return range(0)
+
+        def check(current):
+            if first < current:
+                raise ValueError(f"Il valore {first} è già stato assegnato: il prossimo libero è {current}")
+
+        self._update(name, first, "UPDATE sequenze SET prossimo = ? WHERE nome = ?", (first + count,), check)
+        return range(first, first + count)
+
+    def next(self, name, start=1):
+        """
+        Restituisce il prossimo valore della sequenza, consumandolo
+
+        Args:
+            name: Nome della sequenza
+            start: Primo valore se la sequenza non esiste ancora
+
+        Returns:
+            int: Valore assegnato
+        """
+        return self.reserve(name, 1, start)[0]
+
+    def ensure_after(self, name, value):
+        """
+        Fa proseguire la sequenza dopo un valore già usato (ad esempio un numero
+        inserito a mano); non la fa mai tornare indietro
+
+        Args:
+            name: Nome della sequenza
+            value: Ultimo valore usato
+        """
+        self._update(name, value + 1, "UPDATE sequenze SET prossimo = MAX(prossimo, ?) WHERE nome = ?",
+                     (value + 1,))
+
+    def peek(self, name, start=1):
+        """
+        Restituisce il prossimo valore senza consumarlo
+
+        Args:
+            name: Nome della sequenza
+            start: Valore restituito se la sequenza non esiste ancora
+
+        Returns:
+            int: Prossimo valore
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT prossimo FROM sequenze WHERE nome = ?", (name,)).fetchone()
+        return row[0] if row else start
+
+    def exists(self, name):
+        """
+        Indica se la sequenza è già stata creata
+
+        Args:
+            name: Nome della sequenza
+
+        Returns:
+            bool: True se la sequenza esiste
+        """
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT 1 FROM sequenze WHERE nome = ?", (name,)).fetchone() is not None
+
+    def reserve_progressivi(self, count=1):
+        """
+        Riserva progressivi di invio consecutivi
+
+        Args:
+            count: Numero di progressivi
+
+        Returns:
+            list: Progressivi di invio (stringhe di 5-10 caratteri)
+        """
+        return [format_progressivo(value) for value in self.reserve(PROGRESSIVO, count, start=1)]
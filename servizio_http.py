@@ -0,0 +1,499 @@
+"""
+Servizio HTTP locale per creare, leggere e visualizzare le fatture senza l'interfaccia grafica.
+
+Il servizio espone le operazioni di ExcelXmlManager e la trasformazione XSL a
+strumenti interni (script, altri programmi) sulla macchina locale:
+
+    GET    /fatture                    elenco (parametri: testo, data_da, data_a, controparte,
+                                       tipo_documento, importo_min, importo_max, ordina,
+                                       decrescente, offset, limit)
+    GET    /fatture/<id>               dati della fattura (JSON)
+    GET    /fatture/<id>/xml           fattura XML generata dai dati Excel
+    GET    /fatture/<id>/html?xsl=...  fattura visualizzata con un foglio di stile
+    POST   /fatture                    salva una fattura (corpo: XML o XML.p7m)
+    PUT    /fatture/<id>               aggiorna una fattura (corpo: XML)
+    DELETE /fatture/<id>               elimina una fattura
+    POST   /visualizza?xsl=...         visualizza una fattura inviata nel corpo
+    GET    /fogli-stile                fogli di stile disponibili
+
+Concorrenza: le richieste sono servite da un thread ciascuna, ma il lavoro è
+eseguito da due pool. Tutte le modifiche del database passano da un'unica coda
+di scrittura (un solo thread, un solo ExcelXmlManager), quindi non si
+sovrappongono mai tra loro; il blocco del file (blocco_db.py) protegge dalle
+altre postazioni. Letture e trasformazioni sono eseguite da un pool di thread
+fissi, ognuno con il proprio ExcelXmlManager (le connessioni SQLite dell'indice
+di ricerca non passano da un thread all'altro) e i propri fogli di stile
+compilati (vedi rendering.py). I dati delle fatture restano in memoria finché il
+file Excel non cambia.
+
+Esempio:
+    python servizio_http.py --db FattureXML.xlsx --porta 8765
+"""
+import os
+import json
+import logging
+import argparse
+import datetime
+import threading
+import traceback
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+import openpyxl
+
+from excel_xml_manager import ExcelXmlManager
+from schema_fatture import MASTER_HEADERS, DETAIL_HEADERS, SUMMARY_HEADERS, ID_COLUMN, SheetLayout
+from ricerca_fatture import file_state
+from blocco_db import DatabaseLockedError
+from p7m import P7MError, extract_xml_from_p7m
+from rendering import find_stylesheets, render_html
+from instrumentation import span
+
+
+NS = {"p": "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"}
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Thread del pool di lettura e trasformazione
+READ_WORKERS = 4
+
+# Dimensione massima del corpo di una richiesta (byte)
+MAX_BODY = 20 * 1024 * 1024
+
+# Colonne dell'elenco restituito da ExcelXmlManager.query_invoices
+LIST_FIELDS = ("id", "numero", "data", "tipo", "importo", "cedente", "cessionario", "estratto")
+
+# Filtri dell'elenco accettati come parametri della richiesta
+LIST_FILTERS = ("testo", "data_da", "data_a", "controparte", "tipo_documento", "importo_min", "importo_max")
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceError(Exception):
+    """Errore da restituire al client con un codice HTTP"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(value):
+    """Serializza date e importi nelle risposte JSON"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def parse_invoice_body(data):
+    """
+    Analizza il corpo di una richiesta contenente una fattura
+
+    Args:
+        data: Byte della fattura, XML in chiaro o firmata (.xml.p7m)
+
+    Returns:
+        etree._ElementTree: Documento XML
+
+    Raises:
+        ServiceError: Se il corpo non è una fattura leggibile
+    """
+    try:
+        if not data.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<"):
+            data = extract_xml_from_p7m(data)
+        # Nessuna entità esterna né accesso alla rete durante l'analisi
+        parser = etree.XMLParser(resolve_entities=False, no_network=True)
+        return etree.fromstring(data, parser).getroottree()
+    except (P7MError, etree.XMLSyntaxError) as e:
+        raise ServiceError(HTTPStatus.BAD_REQUEST, f"Fattura non valida: {str(e)}")
+
+
+class InvoiceService:
+    """
+    Operazioni sul database Excel eseguite per conto del server HTTP
+    """
+
+    def __init__(self, excel_path, project_dir=PROJECT_DIR, read_workers=READ_WORKERS):
+        """
+        Args:
+            excel_path: Percorso del database Excel
+            project_dir: Cartella con i fogli di stile XSL
+            read_workers: Thread del pool di lettura e trasformazione
+        """
+        self.excel_path = os.path.abspath(excel_path)
+        self.stylesheets = {os.path.basename(path): path for path in find_stylesheets(project_dir)}
+
+        # Coda di scrittura: un solo thread e un solo manager per tutte le modifiche
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scrittura")
+        self._write_manager = self._new_manager()
+
+        # Pool di lettura: un manager per thread, creato al primo uso
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="lettura")
+        self._local = threading.local()
+
+        # Dati delle fatture in memoria: (stato del file, {ID: dati}), ricaricati quando il file cambia
+        self._snapshot = (None, {})
+        self._snapshot_lock = threading.Lock()
+
+    def log(self, message, level=logging.INFO):
+        """Log dei manager e del server"""
+        logger.log(level, message)
+
+    def _new_manager(self):
+        """Crea un manager sul database del servizio"""
+        manager = ExcelXmlManager(self, NS)
+        manager.excel_path = self.excel_path
+        return manager
+
+    def _reader(self):
+        """Restituisce il manager del thread di lettura corrente"""
+        manager = getattr(self._local, "manager", None)
+        if manager is None:
+            manager = self._local.manager = self._new_manager()
+        return manager
+
+    def _read(self, func, *args):
+        """Esegue una lettura nel pool di lettura e ne attende il risultato"""
+        return self._readers.submit(func, *args).result()
+
+    def _write(self, func, *args):
+        """Accoda una modifica del database e ne attende il risultato"""
+        return self._writer.submit(func, *args).result()
+
+    def close(self):
+        """Attende le operazioni in corso e chiude i pool"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+    # Letture
+
+    def _invoices(self):
+        """
+        Restituisce i dati delle fatture, rileggendo il file solo se è cambiato
+
+        Returns:
+            dict: ID -> {"master", "details", "summary", "structure"} con le righe
+                  nell'ordine canonico delle colonne
+        """
+        state = file_state(self.excel_path)
+        with self._snapshot_lock:
+            if self._snapshot[0] == state and state is not None:
+                return self._snapshot[1]
+
+            invoices = {}
+            if state is not None:
+                with span("servizio.caricamento"):
+                    invoices = self._load_invoices()
+            self._snapshot = (state, invoices)
+            return invoices
+
+    def _load_invoices(self):
+        """Legge in streaming tutte le fatture del database"""
+        manager = self._write_manager
+        wb = openpyxl.load_workbook(self.excel_path, read_only=True)
+        try:
+            structure = []
+            if manager.structure_sheet_name in wb.sheetnames:
+                seen = set()
+                for row in wb[manager.structure_sheet_name].iter_rows(min_row=2, max_col=3, values_only=True):
+                    tag, path, description = (tuple(row) + (None,) * 3)[:3]
+                    if tag and path and path not in seen:
+                        seen.add(path)
+                        structure.append((tag, path, description or ""))
+
+            invoices = {}
+            if manager.master_sheet_name not in wb.sheetnames:
+                return invoices
+
+            layout = SheetLayout.of(wb[manager.master_sheet_name], MASTER_HEADERS)
+            for row in wb[manager.master_sheet_name].iter_rows(min_row=2, values_only=True):
+                master = layout.to_canonical(row)
+                if master[0]:
+                    invoices[master[0]] = {"master": master, "details": [], "summary": [],
+                                           "structure": structure}
+
+            for sheet_name, headers, key in ((manager.details_sheet_name, DETAIL_HEADERS, "details"),
+                                             (manager.summary_sheet_name, SUMMARY_HEADERS, "summary")):
+                if sheet_name not in wb.sheetnames:
+                    continue
+                layout = SheetLayout.of(wb[sheet_name], headers)
+                for row in wb[sheet_name].iter_rows(min_row=2, values_only=True):
+                    invoice = invoices.get(layout.value(row, ID_COLUMN))
+                    if invoice is not None:
+                        invoice[key].append(layout.to_canonical(row))
+            return invoices
+        finally:
+            wb.close()
+
+    def _invoice(self, invoice_id):
+        """Restituisce i dati di una fattura o un errore 404"""
+        invoice = self._invoices().get(invoice_id)
+        if invoice is None:
+            raise ServiceError(HTTPStatus.NOT_FOUND, f"Fattura non trovata: {invoice_id}")
+        return invoice
+
+    def list_invoices(self, params):
+        """
+        Elenca le fatture con filtri e ordinamento
+
+        Args:
+            params: Parametri della richiesta (vedi LIST_FILTERS)
+
+        Returns:
+            dict: {"fatture": [...], "totale": n}
+        """
+        filters = {name: params[name] for name in LIST_FILTERS if params.get(name)}
+        try:
+            offset = int(params.get("offset", 0))
+            limit = min(int(params.get("limit", 100)), 1000)
+        except ValueError:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "offset e limit devono essere numeri interi")
+        sort_by = params.get("ordina", "data") or None
+        descending = params.get("decrescente", "1") not in ("0", "false", "no")
+
+        rows, total = self._read(lambda: self._reader().query_invoices(filters, sort_by, descending,
+                                                                       offset, limit))
+        return {"fatture": [dict(zip(LIST_FIELDS, row)) for row in rows], "totale": total}
+
+    def invoice_data(self, invoice_id):
+        """
+        Restituisce i dati di una fattura con i nomi delle colonne
+
+        Args:
+            invoice_id: ID della fattura
+
+        Returns:
+            dict: Dati principali, linee di dettaglio e riepiloghi
+        """
+        invoice = self._invoice(invoice_id)
+        return {"fattura": dict(zip(MASTER_HEADERS, invoice["master"])),
+                "linee": [dict(zip(DETAIL_HEADERS, line)) for line in invoice["details"]],
+                "riepilogo": [dict(zip(SUMMARY_HEADERS, item)) for item in invoice["summary"]]}
+
+    def invoice_xml(self, invoice_id):
+        """
+        Genera la fattura XML dai dati Excel (una volta per versione del file)
+
+        Args:
+            invoice_id: ID della fattura
+
+        Returns:
+            bytes: Fattura XML (UTF-8)
+        """
+        invoice = self._invoice(invoice_id)
+        xml = invoice.get("xml")
+        if xml is None:
+            def generate():
+                manager = self._reader()
+                return manager._serialize_invoice_xml(
+                    manager._generate_xml_from_invoice_data(invoice)).encode("utf-8")
+            # Il progressivo di invio assegnato resta quello della prima generazione
+            xml = invoice.setdefault("xml", self._read(generate))
+        return xml
+
+    def _stylesheet(self, name):
+        """Restituisce il percorso di un foglio di stile disponibile"""
+        if not name:
+            if not self.stylesheets:
+                raise ServiceError(HTTPStatus.NOT_FOUND, "Nessun foglio di stile disponibile")
+            return self.stylesheets[sorted(self.stylesheets)[0]]
+        path = self.stylesheets.get(name)
+        if path is None:
+            raise ServiceError(HTTPStatus.NOT_FOUND, f"Foglio di stile non trovato: {name}")
+        return path
+
+    def render(self, xml_data, stylesheet=None):
+        """
+        Trasforma una fattura in HTML nel pool di lettura
+
+        Args:
+            xml_data: Byte della fattura XML
+            stylesheet: Nome del foglio di stile (il primo disponibile se None)
+
+        Returns:
+            bytes: Pagina HTML
+        """
+        xsl_path = self._stylesheet(stylesheet)
+        return self._read(lambda: render_html(parse_invoice_body(xml_data), xsl_path))
+
+    def invoice_html(self, invoice_id, stylesheet=None):
+        """Visualizza in HTML una fattura del database"""
+        return self.render(self.invoice_xml(invoice_id), stylesheet)
+
+    # Modifiche (coda di scrittura)
+
+    def create_invoice(self, data):
+        """
+        Salva una nuova fattura (una fattura già presente non viene duplicata)
+
+        Args:
+            data: Byte della fattura
+
+        Returns:
+            dict: {"id": ID della fattura}
+        """
+        xml_doc = parse_invoice_body(data)
+
+        def create():
+            manager = self._write_manager
+            if not manager.export_xml_to_excel(xml_doc):
+                raise ServiceError(HTTPStatus.UNPROCESSABLE_ENTITY, "Fattura non salvata, vedi il log del servizio")
+            return manager.last_invoice_id
+        return {"id": self._write(create)}
+
+    def update_invoice(self, invoice_id, data):
+        """
+        Aggiorna una fattura mantenendone l'ID
+
+        Args:
+            invoice_id: ID della fattura
+            data: Byte della fattura aggiornata
+
+        Returns:
+            dict: {"id": ID della fattura}
+        """
+        xml_doc = parse_invoice_body(data)
+        self._invoice(invoice_id)
+        if not self._write(self._write_manager.update_invoice, invoice_id, xml_doc):
+            raise ServiceError(HTTPStatus.UNPROCESSABLE_ENTITY, "Fattura non aggiornata, vedi il log del servizio")
+        return {"id": invoice_id}
+
+    def delete_invoice(self, invoice_id):
+        """
+        Elimina una fattura
+
+        Args:
+            invoice_id: ID della fattura
+
+        Returns:
+            dict: {"id": ID della fattura eliminata}
+        """
+        self._invoice(invoice_id)
+        if not self._write(self._write_manager.delete_invoice, invoice_id):
+            raise ServiceError(HTTPStatus.UNPROCESSABLE_ENTITY, "Fattura non eliminata, vedi il log del servizio")
+        return {"id": invoice_id}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Traduce le richieste HTTP nelle operazioni di InvoiceService
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "FattureXML"
+    # Intestazioni e corpo sono scritti separatamente: senza TCP_NODELAY ogni risposta
+    # su connessione persistente attende l'ACK ritardato del client (circa 40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        self.server.service.log(format % args, logging.DEBUG)
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self._send(status, body, "application/json; charset=utf-8")
+
+    def _body(self):
+        """Legge il corpo della richiesta"""
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "Content-Length non valido")
+        if length > MAX_BODY:
+            raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Corpo della richiesta troppo grande")
+        return self.rfile.read(length)
+
+    def _dispatch(self):
+        service = self.server.service
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip("/").split("/") if part]
+        method = self.command
+
+        try:
+            with span("servizio.richiesta", metodo=method, percorso=parts[0] if parts else "/"):
+                if parts == ["fatture"] and method == "GET":
+                    return self._send_json(HTTPStatus.OK, service.list_invoices(params))
+                if parts == ["fatture"] and method == "POST":
+                    return self._send_json(HTTPStatus.CREATED, service.create_invoice(self._body()))
+                if len(parts) == 2 and parts[0] == "fatture":
+                    if method == "GET":
+                        return self._send_json(HTTPStatus.OK, service.invoice_data(parts[1]))
+                    if method == "PUT":
+                        return self._send_json(HTTPStatus.OK, service.update_invoice(parts[1], self._body()))
+                    if method == "DELETE":
+                        return self._send_json(HTTPStatus.OK, service.delete_invoice(parts[1]))
+                if len(parts) == 3 and parts[0] == "fatture" and method == "GET":
+                    if parts[2] == "xml":
+                        return self._send(HTTPStatus.OK, service.invoice_xml(parts[1]),
+                                          "application/xml; charset=utf-8")
+                    if parts[2] == "html":
+                        return self._send(HTTPStatus.OK, service.invoice_html(parts[1], params.get("xsl")),
+                                          "text/html; charset=utf-8")
+                if parts == ["visualizza"] and method == "POST":
+                    return self._send(HTTPStatus.OK, service.render(self._body(), params.get("xsl")),
+                                      "text/html; charset=utf-8")
+                if parts == ["fogli-stile"] and method == "GET":
+                    return self._send_json(HTTPStatus.OK, sorted(service.stylesheets))
+                raise ServiceError(HTTPStatus.NOT_FOUND, f"Risorsa non trovata: {method} {url.path}")
+
+        except ServiceError as e:
+            self._send_json(e.status, {"errore": str(e)})
+        except DatabaseLockedError as e:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"errore": str(e)})
+        except Exception as e:
+            service.log(f"Errore nella richiesta {method} {self.path}: {str(e)}", logging.ERROR)
+            traceback.print_exc()
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"errore": str(e)})
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _dispatch
+
+
+def create_server(excel_path, host="127.0.0.1", port=8765, project_dir=PROJECT_DIR):
+    """
+    Crea il server HTTP (da avviare con serve_forever())
+
+    Args:
+        excel_path: Percorso del database Excel
+        host: Indirizzo di ascolto (solo locale di default)
+        port: Porta di ascolto (0 per una porta libera qualsiasi)
+        project_dir: Cartella con i fogli di stile XSL
+
+    Returns:
+        ThreadingHTTPServer: Server con l'attributo service (InvoiceService)
+    """
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+    server.service = InvoiceService(excel_path, project_dir)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servizio HTTP locale delle fatture")
+    parser.add_argument("--db", required=True, help="Database Excel delle fatture")
+    parser.add_argument("--host", default="127.0.0.1", help="Indirizzo di ascolto")
+    parser.add_argument("--porta", type=int, default=8765, help="Porta di ascolto")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    server = create_server(args.db, args.host, args.porta)
+    logger.info(f"Servizio in ascolto su http://{args.host}:{server.server_address[1]}/fatture")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+
+
+if __name__ == "__main__":
+    main()
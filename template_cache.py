@@ -0,0 +1,165 @@
+"""
+Cache dei modelli di fattura XML.
+
+Un modello viene letto e analizzato una sola volta finché il file non cambia
+(dimensione e data di modifica): ogni nuova fattura è una copia dell'albero già
+pronto, fatta da libxml2 senza rileggere né riconvertire il file. Anche la
+struttura del modello (tag e percorsi, usata per il foglio StrutturaXML) viene
+calcolata una volta per versione del file.
+
+La cache è condivisa da tutto il processo e protetta da un lock, così può essere
+usata anche dai thread di lavoro (ad esempio nella creazione di fatture in serie).
+"""
+import os
+import copy
+import threading
+import collections
+
+from lxml import etree
+
+from instrumentation import span
+
+
+# Modello analizzato: impronta del file, albero originale (mai restituito), struttura
+_Entry = collections.namedtuple("_Entry", "stamp tree structure")
+
+
+def _file_stamp(path):
+    """Restituisce l'impronta di un file (dimensione, data di modifica in ns)"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _local_name(tag):
+    """Restituisce il nome di un tag senza namespace"""
+    return tag.split("}", 1)[1] if "}" in tag else tag
+
+
+def _structure(root):
+    """
+    Elenca gli elementi del modello in ordine di documento, senza percorsi ripetuti
+
+    Args:
+        root: Elemento radice del modello
+
+    Returns:
+        tuple: Coppie (tag, percorso) come "/FatturaElettronica/FatturaElettronicaHeader"
+    """
+    entries = []
+    seen = set()
+
+    def explore(element, path):
+        tag = _local_name(element.tag)
+        current_path = f"{path}/{tag}"
+        if current_path not in seen:
+            seen.add(current_path)
+            entries.append((tag, current_path))
+        for child in element.iterchildren(tag=etree.Element):
+            explore(child, current_path)
+
+    explore(root, "")
+    return tuple(entries)
+
+
+class TemplateCache:
+    """
+    Modelli XML analizzati, indicizzati per percorso assoluto
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, path):
+        """
+        Restituisce il modello analizzato, rileggendo il file solo se è cambiato
+
+        Args:
+            path: Percorso del file modello
+
+        Returns:
+            _Entry: Modello analizzato
+
+        Raises:
+            OSError: Se il file non esiste
+            etree.XMLSyntaxError: Se il file non è un XML valido
+        """
+        path = os.path.abspath(path)
+        stamp = _file_stamp(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.stamp == stamp:
+                return entry
+
+        with span("xml.parse", file=os.path.basename(path), cache="miss"):
+            tree = etree.parse(path)
+        entry = _Entry(stamp, tree, _structure(tree.getroot()))
+
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+    def new_document(self, path):
+        """
+        Crea un nuovo documento a partire dal modello
+
+        Args:
+            path: Percorso del file modello
+
+        Returns:
+            etree._ElementTree: Copia indipendente del modello (istruzioni di
+                                elaborazione e dichiarazione comprese)
+        """
+        return copy.deepcopy(self._entry(path).tree)
+
+    def new_documents(self, path, count):
+        """
+        Crea più documenti dallo stesso modello (ad esempio per la fatturazione periodica)
+
+        Args:
+            path: Percorso del file modello
+            count: Numero di documenti
+
+        Returns:
+            list: Copie indipendenti del modello
+        """
+        tree = self._entry(path).tree
+        with span("xml.modello.copia", documenti=count):
+            return [copy.deepcopy(tree) for _ in range(count)]
+
+    def structure(self, path):
+        """
+        Restituisce la struttura del modello
+
+        Args:
+            path: Percorso del file modello
+
+        Returns:
+            tuple: Coppie (tag, percorso) in ordine di documento
+        """
+        return self._entry(path).structure
+
+    def clear(self):
+        """Svuota la cache"""
+        with self._lock:
+            self._entries.clear()
+
+
+# Cache condivisa dal processo
+_default_cache = TemplateCache()
+
+
+def new_document(path):
+    """Crea un nuovo documento dal modello, vedi TemplateCache.new_document()"""
+    return _default_cache.new_document(path)
+
+
+def new_documents(path, count):
+    """Crea più documenti dal modello, vedi TemplateCache.new_documents()"""
+    return _default_cache.new_documents(path, count)
+
+
+def template_structure(path):
+    """Restituisce la struttura del modello, vedi TemplateCache.structure()"""
+    return _default_cache.structure(path)